@@ -9,17 +9,65 @@ DCM4CHEE MWL — Enostavna lokalna aplikacija (SL)
 ✔ SAMODEJNI Accession Number (ACCYYYYMMDD-####), privzeto vklopljeno
 """
 
-from flask import Flask, request, jsonify, Response, send_from_directory
+import sys, time, builtins
+
+# ---------- Profil zagona (--profile-startup) ----------
+# Merilnik mora biti nameščen pred vsemi ostalimi uvozi.
+_IMPORT_TIMES = {}      # modul -> [skupaj s, lastni s]
+_import_stack = []
+
+def _install_import_timer():
+    orig_import = builtins.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return orig_import(name, globals, locals, fromlist, level)
+        _import_stack.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            return orig_import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - t0
+            children = _import_stack.pop()
+            if _import_stack:
+                _import_stack[-1] += total
+            rec = _IMPORT_TIMES.setdefault(name, [0.0, 0.0])
+            rec[0] += total
+            rec[1] += total - children
+
+    builtins.__import__ = timed_import
+
+if "--profile-startup" in sys.argv:
+    _install_import_timer()
+_T_START = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, abort
 import requests
+import requests.adapters
 from requests.auth import HTTPBasicAuth
-from datetime import datetime
-import os, json, re, io
-import pdfplumber
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque, Counter
+import os, json, re, io, csv
+import hashlib, gzip, threading, time, atexit, bisect, fnmatch, queue, socketserver, socket, heapq
+import functools, hmac
 
 # utišaj opozorila za samopodpisan certifikat (po potrebi)
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# brotli je neobvezen; brez njega UI strežemo samo z gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# orjson je neobvezen; brez njega serializiramo s standardnim json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 
 # ---------- Privzeta nastavitev ----------
@@ -70,28 +118,96 @@ def _write_json_file(path, data):
         pass
 
 # ---------- Station AE ----------
-def load_station_aets():
+# Register postaj je v pomnilniku; datoteko zapišemo z zakasnitvijo (debounce),
+# da zaporedni vnosi ne prepisujejo datoteke ob vsakem klicu.
+STATION_SAVE_DELAY = 2.0   # sekunde
+
+_STATIONS = {}             # aet -> {"count": int, "lastSeen": "YYYY-MM-DDTHH:MM:SS"}
+_STATIONS_LOCK = threading.Lock()
+_stations_loaded = False
+_station_timer = None
+
+def _ensure_stations_loaded():
+    # kliče se pod _STATIONS_LOCK
+    global _stations_loaded
+    if _stations_loaded:
+        return
     data = _read_json_file(STATION_FILE, {"items": []})
-    items = data.get("items", [])
-    seen = set(); clean = []
-    for it in items:
+    if not isinstance(data, dict):
+        data = {}
+    stats = data.get("stats") or {}
+    for it in data.get("items", []):
         s = (it or "").strip()
-        if s and s not in seen:
-            seen.add(s); clean.append(s)
-    return clean
+        if s and s not in _STATIONS:
+            st = stats.get(s) or {}
+            _STATIONS[s] = {"count": int(st.get("count") or 0), "lastSeen": st.get("lastSeen") or ""}
+    _stations_loaded = True
 
-def save_station_aets(items):
-    uniq = sorted({(it or "").strip() for it in items if (it or "").strip()})
-    _write_json_file(STATION_FILE, {"items": uniq})
-    return uniq
+def _station_list():
+    # najpogosteje uporabljene postaje najprej
+    return sorted(_STATIONS, key=lambda k: (-_STATIONS[k]["count"], k))
+
+def load_station_aets():
+    with _STATIONS_LOCK:
+        _ensure_stations_loaded()
+        return _station_list()
+
+def flush_station_aets():
+    global _station_timer
+    with _STATIONS_LOCK:
+        _station_timer = None
+        if not _stations_loaded:
+            return
+        data = {"items": sorted(_STATIONS), "stats": {k: dict(v) for k, v in _STATIONS.items()}}
+        _write_json_file(STATION_FILE, data)
+
+def _schedule_station_save():
+    # kliče se pod _STATIONS_LOCK
+    global _station_timer
+    if _station_timer is not None:
+        _station_timer.cancel()
+    _station_timer = threading.Timer(STATION_SAVE_DELAY, flush_station_aets)
+    _station_timer.daemon = True
+    _station_timer.start()
 
-def add_station_aet(value):
+def save_station_aets(items):
+    with _STATIONS_LOCK:
+        _ensure_stations_loaded()
+        for it in items:
+            s = (it or "").strip()
+            if s and s not in _STATIONS:
+                _STATIONS[s] = {"count": 0, "lastSeen": ""}
+        _schedule_station_save()
+        return _station_list()
+
+def add_station_aet(value, used=False):
+    """Doda postajo; used=True pomeni dejansko uporabo (poveča števec)."""
     v = (value or "").strip()
-    if not v: return load_station_aets()
-    curr = load_station_aets()
-    if v not in curr:
-        curr.append(v); return save_station_aets(curr)
-    return curr
+    with _STATIONS_LOCK:
+        _ensure_stations_loaded()
+        if not v:
+            return _station_list()
+        st = _STATIONS.setdefault(v, {"count": 0, "lastSeen": ""})
+        if used:
+            st["count"] += 1
+            st["lastSeen"] = datetime.now().isoformat(timespec="seconds")
+        _schedule_station_save()
+        return _station_list()
+
+def seed_station_aets(values):
+    """Dopolni register z AE-ji (00400001), ki so že na delovni listi arhiva."""
+    with _STATIONS_LOCK:
+        _ensure_stations_loaded()
+        added = False
+        for it in values:
+            s = (it or "").strip()
+            if s and s not in _STATIONS:
+                _STATIONS[s] = {"count": 0, "lastSeen": ""}
+                added = True
+        if added:
+            _schedule_station_save()
+
+atexit.register(flush_station_aets)
 
 # ---------- Patient ID ----------
 def _load_counter():
@@ -100,30 +216,56 @@ def _load_counter():
 def _save_counter(obj):
     _write_json_file(COUNTER_FILE, obj)
 
+_COUNTER_LOCK = threading.Lock()   # števca PID/ACC (branje+zapis datoteke)
+
+def _allocate_block(load, save, n: int):
+    """Rezervira n zaporednih številk z enim branjem in zapisom števca."""
+    with _COUNTER_LOCK:
+        state = load()
+        today = datetime.now().strftime("%Y%m%d")
+        if state.get("date") != today:
+            state = {"date": today, "n": 0}
+        first = state["n"] + 1
+        state["n"] += n
+        save(state)
+    return today, range(first, first + n)
+
+def allocate_patient_ids(n: int):
+    today, nums = _allocate_block(_load_counter, _save_counter, n)
+    return [f"PID{today}-{i:04d}" for i in nums]
+
 def next_patient_id():
-    state = _load_counter()
-    today = datetime.now().strftime("%Y%m%d")
-    if state.get("date") != today:
-        state = {"date": today, "n": 0}
-    state["n"] += 1
-    _save_counter(state)
-    return f"PID{today}-{state['n']:04d}"
+    return allocate_patient_ids(1)[0]
+
+def _patient_id_free(pid: str) -> bool:
+    r = qido_find_patient_by_id(pid)
+    if r.ok:
+        try:
+            arr = r.json()
+            return not (isinstance(arr, list) and len(arr) > 0)
+        except Exception:
+            return True
+    return True
 
 def generate_unique_patient_id():
     for _ in range(1000):
         pid = next_patient_id()
-        r = qido_find_patient_by_id(pid)
-        if r.ok:
-            try:
-                arr = r.json()
-                if not (isinstance(arr, list) and len(arr) > 0):
-                    return pid
-            except Exception:
-                return pid
-        else:
+        if _patient_id_free(pid):
             return pid
     return f"PID{datetime.now().strftime('%Y%m%d')}-{datetime.now().strftime('%H%M%S')}"
 
+def generate_unique_patient_ids(n: int):
+    """
+    Blok n PID-ov. Števec je zaporeden, zato zadošča preveriti prvega v bloku;
+    če je zaseden (npr. ponastavljen števec), preidemo na preverjanje po enega.
+    """
+    if n <= 0:
+        return []
+    block = allocate_patient_ids(n)
+    if _patient_id_free(block[0]):
+        return block
+    return [generate_unique_patient_id() for _ in range(n)]
+
 # ---------- Accession Number ----------
 def _load_acc_counter():
     return _read_json_file(ACC_COUNTER_FILE, {"date": datetime.now().strftime("%Y%m%d"), "n": 0})
@@ -131,15 +273,79 @@ def _load_acc_counter():
 def _save_acc_counter(obj):
     _write_json_file(ACC_COUNTER_FILE, obj)
 
+def allocate_accession_numbers(n: int):
+    today, nums = _allocate_block(_load_acc_counter, _save_acc_counter, n)
+    return [f"ACC{today}-{i:04d}" for i in nums]
+
 def next_accession_number():
     """ACCYYYYMMDD-####, reset števca vsak dan."""
-    state = _load_acc_counter()
-    today = datetime.now().strftime("%Y%m%d")
-    if state.get("date") != today:
-        state = {"date": today, "n": 0}
-    state["n"] += 1
-    _save_acc_counter(state)
-    return f"ACC{today}-{state['n']:04d}"
+    return allocate_accession_numbers(1)[0]
+
+# ---------- SPS ID ----------
+# SPS ID je SH (največ 16 znakov): "S" + čas zagona v ms (base36, 8 znakov)
+# + števec v procesu (base36). Brez branja/pisanja datoteke, unikatno tudi
+# med ponovnimi zagoni, ker se predpona ob vsakem zagonu spremeni.
+_B36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def _base36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return out
+
+_SPS_PREFIX = "S" + _base36(int(time.time() * 1000))
+_SPS_SEQ = [0]
+_SPS_LOCK = threading.Lock()
+
+def allocate_sps_ids(n: int):
+    with _SPS_LOCK:
+        first = _SPS_SEQ[0]
+        _SPS_SEQ[0] += n
+    return [_SPS_PREFIX + _base36(i) for i in range(first, first + n)]
+
+def next_sps_id():
+    return allocate_sps_ids(1)[0]
+
+# ---------- Merjenje funkcij (/debug/profile) ----------
+# @_timed funkcije so privzeto nespremenjene (brez dodatnega klica); ob
+# vklopu se ime v modulu zamenja z ovojem, ki šteje klice in skupni čas.
+_TIMED = {}             # ime -> {"orig", "wrapped", "calls", "seconds"}
+_TIMED_LOCK = threading.Lock()
+
+def _timed(fn):
+    rec = {"orig": fn, "calls": 0, "seconds": 0.0}
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            dt = time.perf_counter() - t0
+            with _TIMED_LOCK:
+                rec["calls"] += 1
+                rec["seconds"] += dt
+
+    rec["wrapped"] = wrapper
+    _TIMED[fn.__name__] = rec
+    return fn
+
+def set_function_timing(enabled: bool, reset: bool = False):
+    g = globals()
+    with _TIMED_LOCK:
+        for name, rec in _TIMED.items():
+            g[name] = rec["wrapped"] if enabled else rec["orig"]
+            if reset:
+                rec["calls"], rec["seconds"] = 0, 0.0
+
+def function_timings() -> dict:
+    with _TIMED_LOCK:
+        return {name: {"enabled": globals()[name] is rec["wrapped"], "calls": rec["calls"],
+                       "total_ms": round(rec["seconds"] * 1000, 3),
+                       "mean_us": round(rec["seconds"] / rec["calls"] * 1e6, 2) if rec["calls"] else 0.0}
+                for name, rec in _TIMED.items()}
 
 # ---------- Pretvorbe datum/čas ----------
 DA_RE_1 = re.compile(r"^\s*(\d{2})\.(\d{2})\.(\d{4})\s*$")   # DD.MM.YYYY
@@ -150,6 +356,7 @@ TM_RE_1 = re.compile(r"^\s*(\d{2}):(\d{2})(?::(\d{2}))?\s*$") # HH:MM[:SS]
 TM_RE_2 = re.compile(r"^\s*\d{6}\s*$")                        # HHMMSS
 TM_RE_3 = re.compile(r"^\s*\d{4}\s*$")                        # HHMM -> HHMMSS
 
+@_timed
 def to_da(s: str | None) -> str:
     if not s: return ""
     s = s.strip()
@@ -173,6 +380,7 @@ def to_da(s: str | None) -> str:
         except Exception:
             return ""
 
+@_timed
 def to_tm(s: str | None) -> str:
     if not s: return ""
     s = s.strip()
@@ -196,35 +404,346 @@ def to_tm(s: str | None) -> str:
             return ""
 
 # ---------- HTTP helperji ----------
+# Vsi klici arhiva gredo skozi arc_request(): časovne omejitve iz opazovanih
+# zakasnitev, podvojeni (hedged) zahtevki za idempotentna branja in
+# varovalka (circuit breaker), ki ob nedosegljivem arhivu takoj vrne 503.
+ARC_TIMEOUT_DEFAULT = 15.0   # s, dokler ni dovolj meritev
+ARC_TIMEOUT_MIN = 2.0
+ARC_TIMEOUT_MAX = 30.0
+ARC_TIMEOUT_FACTOR = 3.0     # časovna omejitev = p99 * faktor
+ARC_CONNECT_TIMEOUT = 5.0
+ARC_MIN_SAMPLES = 20
+ARC_HEDGE_MIN_DELAY = 0.05   # s
+BREAKER_THRESHOLD = 5        # zaporednih napak do odprtja
+BREAKER_COOLDOWN = 30.0      # s odprtega stanja pred poskusnim zahtevkom
+
+HEDGED_OPS = {"list", "patient"}
+
+# Sprejem zahtevkov (admission control) na arhiv: vedro žetonov (ARC_RPS,
+# ARC_BURST) in največ ARC_MAX_INFLIGHT hkratnih zahtevkov. Presežek čaka v
+# vrsti do ARC_QUEUE_TIMEOUT; ko je vrsta polna ali čas potekel, zahtevek
+# takoj dobi 503, ki ne šteje kot napaka arhiva (varovalka ostane zaprta).
+ARC_RPS = float(os.environ.get("ARC_RPS", "50"))                 # 0 = brez omejitve
+ARC_BURST = float(os.environ.get("ARC_BURST", "20"))
+ARC_MAX_INFLIGHT = int(os.environ.get("ARC_MAX_INFLIGHT", "8"))   # 0 = brez omejitve
+ARC_QUEUE_MAX = int(os.environ.get("ARC_QUEUE_MAX", "200"))
+ARC_QUEUE_TIMEOUT = float(os.environ.get("ARC_QUEUE_TIMEOUT", "10"))
+
+_ARC_SESSION = requests.Session()
+_ARC_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_ARC_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="arc-hedge")
+
+_ARC_LOCK = threading.Lock()
+_ARC_LATENCY = {}            # op -> deque zadnjih trajanj (s)
+ARC_STATS = {"requests": 0, "failures": 0, "timeouts": 0, "hedged": 0, "hedgeWins": 0, "fastFails": 0, "shed": 0}
+_BREAKERS = {}               # server_base -> {"state", "failures", "openedAt"}
+_ADMISSION = {}              # server_base -> žetoni, hkratni zahtevki, metrike vrste
+_ADMISSION_COND = threading.Condition()
+
 def _verify_flag():
     return not CFG.get("allow_self_signed", True)
 
+def _arc_op(method: str, path: str) -> str:
+    if method == "GET":
+        if "/rs/mwlitems" in path:
+            return "list"
+        if "/rs/patients" in path:
+            return "patient"
+        return "get"
+    return method.lower()
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+def _arc_timeout(op: str) -> float:
+    with _ARC_LOCK:
+        samples = list(_ARC_LATENCY.get(op, ()))
+    if len(samples) < ARC_MIN_SAMPLES:
+        return ARC_TIMEOUT_DEFAULT
+    return min(ARC_TIMEOUT_MAX, max(ARC_TIMEOUT_MIN, _percentile(samples, 99) * ARC_TIMEOUT_FACTOR))
+
+def _arc_hedge_delay(op: str):
+    with _ARC_LOCK:
+        samples = list(_ARC_LATENCY.get(op, ()))
+    if len(samples) < ARC_MIN_SAMPLES:
+        return None
+    return max(ARC_HEDGE_MIN_DELAY, _percentile(samples, 95))
+
+def _synthetic_response(status: int, text: str, url: str = ""):
+    """Odgovor brez arhiva (varovalka, časovna omejitev); klicatelji ga obravnavajo kot vsak drug."""
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = text.encode("utf-8")
+    resp.encoding = "utf-8"
+    resp.headers["Content-Type"] = "text/plain; charset=utf-8"
+    resp.url = url
+    resp.arc_unavailable = True
+    return resp
+
+def _breaker(key):
+    # kliče se pod _ARC_LOCK
+    return _BREAKERS.setdefault(key, {"state": "closed", "failures": 0, "openedAt": 0.0})
+
+def _breaker_allow(key):
+    """False (zavrnjen), True ali "trial" (poskusni zahtevek polodprte varovalke)."""
+    with _ARC_LOCK:
+        b = _breaker(key)
+        if b["state"] == "open":
+            if time.monotonic() - b["openedAt"] < BREAKER_COOLDOWN:
+                ARC_STATS["fastFails"] += 1
+                return False
+            b["state"] = "half-open"     # en poskusni zahtevek
+            return "trial"
+        if b["state"] == "half-open":
+            ARC_STATS["fastFails"] += 1
+            return False
+        return True
+
+def _breaker_record(key, ok: bool):
+    with _ARC_LOCK:
+        b = _breaker(key)
+        if ok:
+            b.update({"state": "closed", "failures": 0})
+            return
+        b["failures"] += 1
+        if b["state"] == "half-open" or b["failures"] >= BREAKER_THRESHOLD:
+            b.update({"state": "open", "openedAt": time.monotonic()})
+
+def _breaker_return_trial(key):
+    # poskusni zahtevek ni prišel do arhiva: varovalka spet odprta, nov poskus po ohladitvi
+    with _ARC_LOCK:
+        b = _breaker(key)
+        if b["state"] == "half-open":
+            b.update({"state": "open", "openedAt": time.monotonic()})
+
+def _admission(key):
+    # kliče se pod _ADMISSION_COND
+    a = _ADMISSION.get(key)
+    if a is None:
+        a = _ADMISSION[key] = {"tokens": ARC_BURST, "refill": time.monotonic(), "inflight": 0,
+                               "queued": 0, "maxQueued": 0, "admitted": 0, "delayed": 0, "shed": 0,
+                               "waitTotal": 0.0, "waitMax": 0.0}
+    return a
+
+def _admit(key) -> bool:
+    """Počaka na žeton in prosto mesto; False, če je vrsta polna ali čakanje predolgo."""
+    t0 = time.monotonic()
+    deadline = t0 + ARC_QUEUE_TIMEOUT
+    with _ADMISSION_COND:
+        a = _admission(key)
+        if a["queued"] >= ARC_QUEUE_MAX:
+            a["shed"] += 1
+            return False
+        a["queued"] += 1
+        a["maxQueued"] = max(a["maxQueued"], a["queued"])
+        try:
+            while True:
+                now = time.monotonic()
+                if ARC_RPS > 0:
+                    a["tokens"] = min(ARC_BURST, a["tokens"] + (now - a["refill"]) * ARC_RPS)
+                    a["refill"] = now
+                has_token = ARC_RPS <= 0 or a["tokens"] >= 1
+                has_slot = ARC_MAX_INFLIGHT <= 0 or a["inflight"] < ARC_MAX_INFLIGHT
+                if has_token and has_slot:
+                    if ARC_RPS > 0:
+                        a["tokens"] -= 1
+                    a["inflight"] += 1
+                    a["admitted"] += 1
+                    waited = now - t0
+                    if waited > 0.001:
+                        a["delayed"] += 1
+                    a["waitTotal"] += waited
+                    a["waitMax"] = max(a["waitMax"], waited)
+                    return True
+                remaining = deadline - now
+                if remaining <= 0:
+                    a["shed"] += 1
+                    return False
+                # brez žetona čakamo do naslednjega, sicer do sprostitve mesta
+                _ADMISSION_COND.wait(remaining if has_token else min(remaining, (1 - a["tokens"]) / ARC_RPS))
+        finally:
+            a["queued"] -= 1
+
+def _admit_release(key):
+    with _ADMISSION_COND:
+        _admission(key)["inflight"] -= 1
+        _ADMISSION_COND.notify_all()
+
+def _admission_busy(key) -> bool:
+    with _ADMISSION_COND:
+        return _admission(key)["queued"] > 0
+
+def admission_stats() -> dict:
+    with _ADMISSION_COND:
+        return {k: {"inflight": a["inflight"], "queued": a["queued"], "maxQueued": a["maxQueued"],
+                    "admitted": a["admitted"], "delayed": a["delayed"], "shed": a["shed"],
+                    "tokens": round(a["tokens"], 2),
+                    "waitAvg_ms": round(a["waitTotal"] / a["admitted"] * 1000, 2) if a["admitted"] else 0.0,
+                    "waitMax_ms": round(a["waitMax"] * 1000, 1)} for k, a in _ADMISSION.items()}
+
+def arc_unhealthy(resp) -> bool:
+    """Odgovor pomeni nedosegljiv/preobremenjen arhiv (ne napake v podatkih)."""
+    return getattr(resp, "arc_unavailable", False) or resp.status_code in (502, 503, 504)
+
+def archive_available() -> bool:
+    """Ali bi varovalka zahtevek spustila: zaprta ali odprta s pretečeno ohladitvijo (poskus)."""
+    with _ARC_LOCK:
+        b = _breaker(CFG["server_base"].rstrip("/"))
+        if b["state"] == "open":
+            return time.monotonic() - b["openedAt"] >= BREAKER_COOLDOWN
+        return b["state"] == "closed"
+
+def _arc_send(op, method, url, timeout, base, **kw):
+    if not _admit(base):
+        resp = _synthetic_response(503, "Arhiv je preobremenjen, zahtevek ni bil poslan.", url)
+        resp.arc_shed = True
+        return resp
+    t0 = time.perf_counter()
+    try:
+        resp = _ARC_SESSION.request(method, url, auth=HTTPBasicAuth(CFG["username"], CFG["password"]),
+                                    verify=_verify_flag(), timeout=(min(ARC_CONNECT_TIMEOUT, timeout), timeout), **kw)
+    except requests.Timeout:
+        with _ARC_LOCK:
+            ARC_STATS["timeouts"] += 1
+        return _synthetic_response(504, f"Arhiv se ni odzval v {timeout:.1f} s.", url)
+    except requests.RequestException as e:
+        return _synthetic_response(502, f"Napaka povezave z arhivom: {e}", url)
+    finally:
+        _admit_release(base)
+    with _ARC_LOCK:
+        _ARC_LATENCY.setdefault(op, deque(maxlen=200)).append(time.perf_counter() - t0)
+    return resp
+
+def _arc_hedged(op, method, url, timeout, hedge_delay, base, **kw):
+    first = _HEDGE_POOL.submit(_arc_send, op, method, url, timeout, base, **kw)
+    done, _ = wait([first], timeout=hedge_delay)
+    if done:
+        return first.result()
+    if _admission_busy(base):
+        # ob polni vrsti podvojen zahtevek le še poveča obremenitev
+        return first.result()
+    with _ARC_LOCK:
+        ARC_STATS["hedged"] += 1
+    second = _HEDGE_POOL.submit(_arc_send, op, method, url, timeout, base, **kw)
+    pending = {first, second}
+    result = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            result = f.result()
+            if not getattr(result, "arc_unavailable", False):
+                if f is second:
+                    with _ARC_LOCK:
+                        ARC_STATS["hedgeWins"] += 1
+                return result
+    return result
+
+def arc_request(method: str, path: str, **kw):
+    base = CFG["server_base"].rstrip("/")
+    url = f"{base}{path}"
+    op = _arc_op(method, path)
+    allowed = _breaker_allow(base)
+    if not allowed:
+        return _synthetic_response(503, "Arhiv trenutno ni dosegljiv (varovalka odprta).", url)
+    with _ARC_LOCK:
+        ARC_STATS["requests"] += 1
+    timeout = _arc_timeout(op)
+    hedge_delay = _arc_hedge_delay(op) if op in HEDGED_OPS else None
+    if hedge_delay is not None and hedge_delay < timeout:
+        resp = _arc_hedged(op, method, url, timeout, hedge_delay, base, **kw)
+    else:
+        resp = _arc_send(op, method, url, timeout, base, **kw)
+    if getattr(resp, "arc_shed", False):
+        # zavrnili smo ga sami; o zdravju arhiva ne pove ničesar
+        with _ARC_LOCK:
+            ARC_STATS["shed"] += 1
+        if allowed == "trial":
+            _breaker_return_trial(base)
+        return resp
+    failed = arc_unhealthy(resp)
+    if failed:
+        with _ARC_LOCK:
+            ARC_STATS["failures"] += 1
+    _breaker_record(base, not failed)
+    return resp
+
+# ---------- Združevanje enakih hkratnih branj (single-flight) ----------
+# Enaki GET zahtevki (arhiv, AET, pot, poizvedba, Accept), ki so hkrati v
+# teku, počakajo na prvega in dobijo isti odgovor; telo je že prebrano,
+# zato je deljenje varno. ARC_SINGLEFLIGHT=0 izklopi združevanje.
+ARC_SINGLEFLIGHT = os.environ.get("ARC_SINGLEFLIGHT", "1") != "0"
+
+_SF_LOCK = threading.Lock()
+_SF_CALLS = {}               # ključ -> {"done": Event, "result"}
+SINGLEFLIGHT_STATS = {}      # vrsta -> {"calls": klici navzgor, "saved": prihranjeni}
+
+def singleflight(kind: str, key, fn):
+    """Izvede fn() enkrat za vse hkratne klicatelje z enakim ključem."""
+    with _SF_LOCK:
+        st = SINGLEFLIGHT_STATS.setdefault(kind, {"calls": 0, "saved": 0})
+        call = _SF_CALLS.get((kind, key))
+        if call is None:
+            call = _SF_CALLS[(kind, key)] = {"done": threading.Event(), "result": None, "error": None}
+            st["calls"] += 1
+            leader = True
+        else:
+            st["saved"] += 1
+            leader = False
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+    try:
+        call["result"] = fn()
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _SF_LOCK:
+            _SF_CALLS.pop((kind, key), None)
+        call["done"].set()
+
 def arc_get(path: str, headers: dict | None = None):
-    url = f"{CFG['server_base'].rstrip('/')}{path}"
-    return requests.get(url, headers=headers or {},
-                        auth=HTTPBasicAuth(CFG["username"], CFG["password"]),
-                        verify=_verify_flag())
-
-def arc_post_dicom(path: str, dicom_json: dict):
-    url = f"{CFG['server_base'].rstrip('/')}{path}"
-    return requests.post(url, json=dicom_json,
-                         headers={"Content-Type":"application/dicom+json","Accept":"application/json"},
-                         auth=HTTPBasicAuth(CFG["username"], CFG["password"]),
-                         verify=_verify_flag())
+    headers = headers or {}
+    if not ARC_SINGLEFLIGHT:
+        return arc_request("GET", path, headers=headers)
+    route, _, query = path.partition("?")
+    key = (CFG["server_base"].rstrip("/"), CFG["aet"], route, query, headers.get("Accept", ""))
+    return singleflight("get", key, lambda: arc_request("GET", path, headers=headers))
+
+def arc_post_dicom(path: str, dicom_json):
+    """dicom_json je slovar ali že kodirano telo (bytes, npr. iz encode_dicom_mwl)."""
+    body = dicom_json if isinstance(dicom_json, bytes) else dumps_bytes(dicom_json)
+    return arc_request("POST", path, data=body,
+                       headers={"Content-Type":"application/dicom+json","Accept":"application/json"})
 
 def arc_delete(path: str, headers: dict | None = None):
-    url = f"{CFG['server_base'].rstrip('/')}{path}"
-    return requests.delete(url, headers=headers or {"Accept":"application/json"},
-                           auth=HTTPBasicAuth(CFG["username"], CFG["password"]),
-                           verify=_verify_flag())
+    return arc_request("DELETE", path, headers=headers or {"Accept":"application/json"})
+
+@app.get('/api/archive/health')
+def archive_health():
+    with _ARC_LOCK:
+        lat = {op: list(v) for op, v in _ARC_LATENCY.items()}
+        breakers = {k: {"state": b["state"], "failures": b["failures"]} for k, b in _BREAKERS.items()}
+        stats = dict(ARC_STATS)
+    ops = {op: {"samples": len(v), "p50_ms": round(_percentile(v, 50) * 1000, 1),
+                "p95_ms": round(_percentile(v, 95) * 1000, 1), "p99_ms": round(_percentile(v, 99) * 1000, 1),
+                "timeout_s": round(_arc_timeout(op), 2)} for op, v in lat.items()}
+    with _SF_LOCK:
+        coalesced = {k: dict(v) for k, v in SINGLEFLIGHT_STATS.items()}
+    return jsonify({"available": archive_available(), "breakers": breakers, "ops": ops,
+                    "admission": admission_stats(), "singleflight": coalesced, **stats})
 
 # ---------- Pacient ----------
 def qido_find_patient_by_id(patient_id: str):
     path = f"/aets/{CFG['aet']}/rs/patients?PatientID={requests.utils.quote(patient_id)}"
-    url = f"{CFG['server_base'].rstrip('/')}{path}"
-    return requests.get(url, headers={"Accept": "application/json"},
-                        auth=HTTPBasicAuth(CFG["username"], CFG["password"]),
-                        verify=_verify_flag())
+    return arc_get(path, {"Accept": "application/json"})
 
 def create_patient_dicom_json(patient_id: str, patient_name: str, birth_date_da: str | None):
     ds = {
@@ -238,9 +757,17 @@ def create_patient_dicom_json(patient_id: str, patient_name: str, birth_date_da:
 
 def rs_create_patient(patient_id: str, patient_name: str, birth_date_da: str | None):
     path = f"/aets/{CFG['aet']}/rs/patients"
-    return arc_post_dicom(path, create_patient_dicom_json(patient_id, patient_name, birth_date_da))
+    return arc_post_dicom(path, encode_patient_dicom(patient_id, patient_name, birth_date_da))
 
 def ensure_patient_exists(patient_id: str, patient_name: str, birth_date_da: str | None):
+    """Hkratni klici za isti PID delijo eno preverjanje (in morebitno ustvarjanje)."""
+    if not ARC_SINGLEFLIGHT:
+        return _ensure_patient_exists(patient_id, patient_name, birth_date_da)
+    key = (CFG["server_base"].rstrip("/"), CFG["aet"], patient_id)
+    return singleflight("ensurePatient", key,
+                        lambda: _ensure_patient_exists(patient_id, patient_name, birth_date_da))
+
+def _ensure_patient_exists(patient_id: str, patient_name: str, birth_date_da: str | None):
     r = qido_find_patient_by_id(patient_id)
     if r.ok:
         try:
@@ -252,6 +779,168 @@ def ensure_patient_exists(patient_id: str, patient_name: str, birth_date_da: str
     r2 = rs_create_patient(patient_id, patient_name, birth_date_da)
     return r2.ok
 
+# ---------- Iskanje pacientov (trigrami) ----------
+# Lokalni indeks imen in datumov rojstva: napolni se s QIDO po straneh v
+# ozadju, dopolnjuje pa ob vsakem ustvarjenem pacientu in osvežitvi MWL.
+PATIENT_PAGE = 500
+PATIENT_INDEX_REFRESH_HOURS = float(os.environ.get("PATIENT_INDEX_REFRESH_HOURS", "12"))
+
+_NAME_MAP = str.maketrans({"Č": "C", "Ć": "C", "Ž": "Z", "Š": "S", "Đ": "D",
+                           "č": "c", "ć": "c", "ž": "z", "š": "s", "đ": "d", "^": " "})
+_PAT_LOCK = threading.Lock()
+# docs: pid -> podatki; names: normalizirano ime -> {pid}; grams: trigram -> {ime}
+# (trigrami kažejo na različna imena, ne na paciente, zato je točkovanje hitro)
+_PAT = {"key": None, "docs": {}, "names": {}, "grams": {}, "loaded": False, "loading": False, "loadedAt": 0.0}
+
+def normalize_name(s: str) -> str:
+    s = (s or "").translate(_NAME_MAP).upper()
+    s = re.sub(r"[^A-Z0-9 ]+", " ", s)
+    return " ".join(s.split())
+
+def _trigrams(norm: str) -> set:
+    out = set()
+    for tok in norm.split():
+        t = f"  {tok} "
+        out.update(t[i:i + 3] for i in range(len(t) - 2))
+    return out
+
+def _patient_index_reset_if_needed():
+    # kliče se pod _PAT_LOCK
+    key = _wl_key()
+    if _PAT["key"] != key:
+        _PAT.update({"key": key, "docs": {}, "names": {}, "grams": {}, "loaded": False, "loadedAt": 0.0})
+
+def patient_index_add(patient_id: str, patient_name: str, birth_da: str = ""):
+    pid = (patient_id or "").strip()
+    if not pid:
+        return
+    norm = normalize_name(patient_name)
+    with _PAT_LOCK:
+        _patient_index_reset_if_needed()
+        docs, names, grams = _PAT["docs"], _PAT["names"], _PAT["grams"]
+        old = docs.get(pid)
+        if old is not None:
+            if old["norm"] == norm and (old["birthDate"] == birth_da or not birth_da):
+                return
+            owners = names.get(old["norm"])
+            if owners is not None:
+                owners.discard(pid)
+                if not owners:
+                    del names[old["norm"]]
+                    for g in _trigrams(old["norm"]):
+                        grams.get(g, set()).discard(old["norm"])
+        docs[pid] = {"patientId": pid, "patientName": patient_name or "", "norm": norm,
+                     "birthDate": birth_da or (old or {}).get("birthDate", "")}
+        if norm not in names:
+            names[norm] = set()
+            for g in _trigrams(norm):
+                grams.setdefault(g, set()).add(norm)
+        names[norm].add(pid)
+
+def load_patient_index():
+    """Prebere vse paciente iz arhiva (QIDO, po straneh) v indeks."""
+    with _PAT_LOCK:
+        _patient_index_reset_if_needed()
+        if _PAT["loading"]:
+            return
+        _PAT["loading"] = True
+    try:
+        offset = 0
+        while True:
+            r = arc_get(f"/aets/{CFG['aet']}/rs/patients?limit={PATIENT_PAGE}&offset={offset}",
+                        {"Accept": "application/json"})
+            if not r.ok:
+                return
+            arr = r.json() if r.content.strip() else []
+            if not isinstance(arr, list) or not arr:
+                break
+            for ds in arr:
+                patient_index_add(_get_str(ds, "00100020"), _get_str(ds, "00100010"), _get_str(ds, "00100030"))
+            if len(arr) < PATIENT_PAGE:
+                break
+            offset += len(arr)
+        with _PAT_LOCK:
+            _PAT.update({"loaded": True, "loadedAt": time.time()})
+    except Exception:
+        pass
+    finally:
+        with _PAT_LOCK:
+            _PAT["loading"] = False
+
+def start_patient_index_loader():
+    def loop():
+        while True:
+            load_patient_index()
+            time.sleep(max(600.0, PATIENT_INDEX_REFRESH_HOURS * 3600))
+    t = threading.Thread(target=loop, name="patient-index", daemon=True)
+    t.start()
+    return t
+
+def search_patients(q: str, limit: int = 10) -> list:
+    q = (q or "").strip()
+    birth = ""
+    m = re.search(r"(\d{1,2})\.(\d{1,2})\.(\d{4})|\d{4}-\d{2}-\d{2}|\b\d{8}\b", q)
+    if m:
+        if m.group(1):
+            birth = f"{m.group(3)}{int(m.group(2)):02d}{int(m.group(1)):02d}"
+        else:
+            birth = to_da(m.group(0))
+        q = (q[:m.start()] + q[m.end():]).strip()
+    norm = normalize_name(q)
+    qgrams = _trigrams(norm)
+    with _PAT_LOCK:
+        docs, names, grams = _PAT["docs"], _PAT["names"], _PAT["grams"]
+        scored = []
+        if qgrams:
+            hits = Counter()
+            for g in qgrams:
+                hits.update(grams.get(g, ()))
+            for name, h in hits.items():
+                score = h / (len(qgrams) + len(_trigrams(name)) - h)
+                if name.startswith(norm):
+                    score += 0.5
+                if score < 0.2:
+                    continue
+                for pid in names.get(name, ()):
+                    d = docs[pid]
+                    if birth:
+                        if d["birthDate"] != birth:
+                            continue
+                        scored.append((score + 0.5, d))
+                    else:
+                        scored.append((score, d))
+            pid_q = q.upper()
+            if len(pid_q) >= 4 and pid_q in docs:
+                scored.append((2.0, docs[pid_q]))
+        elif birth:
+            scored = [(1.0, d) for d in docs.values() if d["birthDate"] == birth]
+        best = heapq.nsmallest(limit + 1, scored, key=lambda x: (-x[0], x[1]["norm"], x[1]["patientId"]))
+        out, seen = [], set()
+        for score, d in best:
+            if d["patientId"] in seen:
+                continue
+            seen.add(d["patientId"])
+            out.append({"patientId": d["patientId"], "patientName": d["patientName"],
+                        "birthDate": d["birthDate"], "score": round(score, 3)})
+            if len(out) >= limit:
+                break
+    return out
+
+@app.get('/api/patients/search')
+def api_patient_search():
+    q = request.args.get("q", "")
+    try:
+        limit = max(1, min(50, int(request.args.get("limit", "10"))))
+    except ValueError:
+        limit = 10
+    with _PAT_LOCK:
+        _patient_index_reset_if_needed()
+        start_load = not _PAT["loaded"] and not _PAT["loading"]
+        count, loaded = len(_PAT["docs"]), _PAT["loaded"]
+    if start_load:
+        threading.Thread(target=load_patient_index, name="patient-index-load", daemon=True).start()
+    return jsonify({"items": search_patients(q, limit), "loaded": loaded, "count": count})
+
 # ---------- DICOM JSON -> preprosto ----------
 def _get_str(ds, tag, default=""):
     try:
@@ -266,6 +955,7 @@ def _get_str(ds, tag, default=""):
     except Exception:
         return default
 
+@_timed
 def dicom_mwl_to_simple(ds):
     simple = {
         "patientName": _get_str(ds, "00100010"),
@@ -292,6 +982,7 @@ def dicom_mwl_to_simple(ds):
     return simple
 
 # ---------- Zgradi DICOM MWL ----------
+@_timed
 def build_dicom_mwl(form: dict, resolved_patient_id: str) -> dict:
     pn    = (form.get("patientName") or "NEZNANO").strip()
     pid   = resolved_patient_id.strip()
@@ -301,7 +992,7 @@ def build_dicom_mwl(form: dict, resolved_patient_id: str) -> dict:
     sdate = to_da(form.get("schedDate") or form.get("schedDate_da") or "")
     stime = to_tm(form.get("schedTime") or form.get("schedTime_tm") or "")
     saet  = (form.get("stationAET") or "").strip()
-    spsid = f"SPS_{pid}"
+    spsid = (form.get("spsId") or "").strip() or next_sps_id()
 
     dicom = {
         "00100010": {"vr": "PN", "Value": [{"Alphabetic": pn}]},
@@ -321,61 +1012,1026 @@ def build_dicom_mwl(form: dict, resolved_patient_id: str) -> dict:
     dicom["00400100"] = {"vr": "SQ", "Value": [sps_item]}
     return dicom
 
+# ---------- Predloge DICOM JSON (hitro kodiranje) ----------
+# Statični deli vsakega atributa ('"00100020":{"vr":"LO","Value":[' ...) so
+# serializirani enkrat ob zagonu; ob kodiranju vstavimo le vrednosti in
+# vse skupaj zlepimo v bytes, ki gredo neposredno v telo zahteve.
+def dumps_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _compile_dicom_template(attrs: list) -> list:
+    """attrs: [(oznaka, VR, ključ)] -> [(ključ, VR, predpona, pripona)], urejeno po oznaki."""
+    parts = []
+    for tag, vr, key in sorted(attrs):
+        head = f'"{tag}":{{"vr":"{vr}","Value":['.encode("ascii")
+        if vr == "PN":
+            parts.append((key, vr, head + b'{"Alphabetic":', b"}]}"))
+        else:
+            parts.append((key, vr, head, b"]}"))
+    return parts
+
+def _encode_dicom(parts: list, values: dict) -> bytes:
+    """Prazne vrednosti izpustimo; za SQ je vrednost seznam že kodiranih elementov."""
+    out = []
+    for key, vr, head, tail in parts:
+        v = values.get(key)
+        if not v:
+            continue
+        out.append(head + (b",".join(v) if vr == "SQ" else dumps_bytes(str(v))) + tail)
+    return b"{" + b",".join(out) + b"}"
+
+_PATIENT_TPL = _compile_dicom_template([
+    ("00100010", "PN", "patientName"),
+    ("00100020", "LO", "patientId"),
+    ("00100030", "DA", "birthDate"),
+])
+_SPS_TPL = _compile_dicom_template([
+    ("00080060", "CS", "modality"),
+    ("00400001", "AE", "stationAET"),
+    ("00400002", "DA", "schedDate"),
+    ("00400003", "TM", "schedTime"),
+    ("00400006", "PN", "performingPhysician"),
+    ("00400007", "LO", "stepDesc"),
+    ("00400009", "SH", "spsId"),
+    ("00400020", "CS", "status"),
+])
+_MWL_TPL = _compile_dicom_template([
+    ("00080050", "SH", "accession"),
+    ("00080090", "PN", "referringPhysician"),
+    ("00100010", "PN", "patientName"),
+    ("00100020", "LO", "patientId"),
+    ("0020000D", "UI", "studyUID"),
+    ("00321060", "LO", "procDesc"),
+    ("00400100", "SQ", "steps"),
+    ("00401001", "SH", "reqProcId"),
+    ("00401003", "SH", "priority"),
+])
+
+def encode_patient_dicom(patient_id: str, patient_name: str, birth_date_da: str | None) -> bytes:
+    """Kot create_patient_dicom_json, a neposredno v bytes."""
+    return _encode_dicom(_PATIENT_TPL, {
+        "patientName": patient_name or "NEZNANO",
+        "patientId": patient_id,
+        "birthDate": to_da(birth_date_da or ""),
+    })
+
+@_timed
+def encode_dicom_mwl(form: dict, resolved_patient_id: str) -> bytes:
+    """
+    Kot build_dicom_mwl, a iz predlog in neposredno v bytes. Poleg polj
+    obrazca podpira še 'steps' (seznam SPS; manjkajoča polja se vzamejo iz
+    obrazca) in atribute zahtevanega posega (reqProcId, priority,
+    referringPhysician, studyUID).
+    """
+    pid = resolved_patient_id.strip()
+    steps = form.get("steps") or [{}]
+    ids = iter(allocate_sps_ids(sum(1 for st in steps if not (st.get("spsId") or "").strip())))
+    items = []
+    for st in steps:
+        def f(key, alt=None):
+            return st.get(key) or st.get(alt or key) or form.get(key) or form.get(alt or key) or ""
+        items.append(_encode_dicom(_SPS_TPL, {
+            "modality": (f("modality") or "US").strip().upper(),
+            "stationAET": f("stationAET").strip(),
+            "schedDate": to_da(f("schedDate", "schedDate_da")),
+            "schedTime": to_tm(f("schedTime", "schedTime_tm")),
+            "performingPhysician": (st.get("performingPhysician") or "").strip(),
+            "stepDesc": (st.get("stepDesc") or "").strip(),
+            "spsId": (st.get("spsId") or "").strip() or next(ids),
+            "status": "SCHEDULED",
+        }))
+    return _encode_dicom(_MWL_TPL, {
+        "accession": (form.get("accession") or "").strip(),
+        "referringPhysician": (form.get("referringPhysician") or "").strip(),
+        "patientName": (form.get("patientName") or "NEZNANO").strip(),
+        "patientId": pid,
+        "studyUID": (form.get("studyUID") or "").strip(),
+        "procDesc": (form.get("procDesc") or "").strip(),
+        "steps": items,
+        "reqProcId": (form.get("reqProcId") or "").strip(),
+        "priority": (form.get("priority") or "").strip().upper(),
+    })
+
+# ---------- Predpomnilnik delovne liste (ETag / gzip) ----------
+GZIP_MIN_BYTES = 1024   # manjših odgovorov ne stiskamo
+
+WL_CACHE = {
+    "key": None,        # (server_base, aet), za katerega velja vsebina
+    "raw_hash": "",     # zgoščena vrednost surovega odgovora arhiva
+    "items": [],        # DICOM JSON elementi, kot jih vrne arhiv
+    "simple": [],       # poenostavljeni elementi (dicom_mwl_to_simple)
+    "body": b"",        # serializiran JSON za /api/list
+    "gz": None,         # gzip različica telesa (izračuna se ob prvi potrebi)
+    "index": None,      # build_worklist_index(items)
+    "views": {},        # filtrirani pogledi: ime -> {"body", "etag", "gz"}
+    "etag": "",
+    "rev": 0,           # poveča se ob vsaki spremembi vsebine (obnova ali popravek)
+    "ts": 0.0,          # čas zadnje uspešne osvežitve
+    "source": "",       # "archive" ali "snapshot" (naloženo z diska, še neusklajeno)
+}
+_WL_LOCK = threading.Lock()
+
+def _wl_key():
+    return (CFG["server_base"].rstrip("/"), CFG["aet"])
+
+def update_worklist_cache(raw: bytes):
+    """
+    Osveži predpomnilnik iz surovega odgovora /mwlitems.
+    Če se odgovor arhiva ni spremenil, ponovno razčlenjevanje preskočimo.
+    Vrne kopijo stanja ali None, če odgovor ni veljaven JSON.
+    """
+    raw_hash = hashlib.sha1(raw).hexdigest()
+    key = _wl_key()
+    with _WL_LOCK:
+        if WL_CACHE["key"] == key and WL_CACHE["raw_hash"] == raw_hash:
+            WL_CACHE["ts"] = time.time()
+            WL_CACHE["source"] = "archive"
+            return dict(WL_CACHE)
+    try:
+        arr = json.loads(raw) if raw.strip() else []   # 204 No Content = prazna lista
+        if not isinstance(arr, list):
+            arr = []
+    except Exception:
+        return None
+    state = _apply_worklist(arr, key, raw_hash, time.time(), "archive")
+    if state is not None:
+        schedule_worklist_snapshot()
+    return state
+
+def _apply_worklist(arr: list, key, raw_hash: str, ts: float, source: str):
+    try:
+        fields = _worklist_fields(arr)
+    except Exception:
+        return None
+    seed_station_aets(sps.get("scheduledStationAETitle") for it in fields["simple"] for sps in it["scheduledProcedureStep"])
+    for ds in arr:
+        if isinstance(ds, dict):
+            patient_index_add(_get_str(ds, "00100020"), _get_str(ds, "00100010"), _get_str(ds, "00100030"))
+    with _WL_LOCK:
+        _merge_pending_slots(key, fields["index"])
+        WL_CACHE.update(fields)
+        WL_CACHE.update({"key": key, "raw_hash": raw_hash, "ts": ts, "source": source, "rev": WL_CACHE["rev"] + 1})
+        state = dict(WL_CACHE)
+    stats_sync_index(key, fields["index"])
+    return state
+
+def _worklist_fields(arr: list) -> dict:
+    simple = [dicom_mwl_to_simple(ds) for ds in arr]
+    body = (app.json.dumps(simple) + "\n").encode("utf-8")
+    return {"items": arr, "simple": simple, "index": build_worklist_index(arr), "views": {},
+            "body": body, "gz": None, "etag": hashlib.sha1(body).hexdigest()[:20]}
+
+def patch_worklist_status(wanted: dict) -> int:
+    """
+    Lokalna sprememba stanja SPS (spsid -> stanje): popravi le prizadete
+    vrstice indeksa (by_sps/by_station/by_date si delijo isto vrstico),
+    termine in števce, brez obnove indeksa. Telo za /api/list se nato
+    serializira zunaj _WL_LOCK. Vrne število spremenjenih SPS.
+    """
+    changes = []
+    with _WL_LOCK:
+        idx = WL_CACHE["index"]
+        if WL_CACHE["key"] != _wl_key() or idx is None:
+            return 0
+        simple = WL_CACHE["simple"]
+        for spsid, st in wanted.items():
+            row = idx["by_sps"].get(spsid)
+            if row is None or row["status"] == st:
+                continue
+            old = row["status"]
+            row["sps"]["00400020"] = {"vr": "CS", "Value": [st]}
+            row["status"] = st
+            _slot_status_changed(idx, row, old)
+            # nov slovar namesto spremembe na mestu: kopije seznama ostanejo nespremenjene
+            simple[row["pos"]] = dicom_mwl_to_simple(row["ds"])
+            row.pop("_pydicom", None)       # C-FIND naj vidi novo stanje (_row_to_dataset)
+            changes.append(row)
+        if not changes:
+            return 0
+        WL_CACHE.update({"views": {}, "gz": None, "rev": WL_CACHE["rev"] + 1})
+        key, rev, snap = WL_CACHE["key"], WL_CACHE["rev"], list(simple)
+    stats_record_status(key, changes)
+    body = (app.json.dumps(snap) + "\n").encode("utf-8")
+    with _WL_LOCK:
+        if WL_CACHE["rev"] == rev:
+            WL_CACHE.update({"body": body, "gz": None, "views": {}, "etag": hashlib.sha1(body).hexdigest()[:20]})
+    schedule_worklist_snapshot()
+    return len(changes)
+
+# ---------- Posnetek delovne liste na disku ----------
+# Zadnja znana lista (DICOM JSON + ETag) se z zakasnitvijo zapiše v gzip
+# datoteko; ob zagonu jo naložimo takoj, arhiv pa uskladi v ozadju. Dokler
+# arhiv ni dosegljiv, /api/list streže posnetek z oznako X-Worklist-Stale.
+SNAPSHOT_FILE = "worklist_snapshot.json.gz"
+SNAPSHOT_SAVE_DELAY = 5.0  # sekunde
+
+_snapshot_timer = None
+_SNAPSHOT_LOCK = threading.Lock()
+
+def save_worklist_snapshot():
+    global _snapshot_timer
+    with _SNAPSHOT_LOCK:
+        _snapshot_timer = None
+    with _WL_LOCK:
+        if WL_CACHE["key"] is None or WL_CACHE["source"] != "archive":
+            return
+        # serializiramo pod ključavnico: patch_worklist_status spreminja elemente na mestu
+        raw = dumps_bytes({"key": list(WL_CACHE["key"]), "etag": WL_CACHE["etag"],
+                           "rawHash": WL_CACHE["raw_hash"], "ts": WL_CACHE["ts"], "items": WL_CACHE["items"]})
+    data = gzip.compress(raw, compresslevel=6, mtime=0)
+    tmp = SNAPSHOT_FILE + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, SNAPSHOT_FILE)
+    except OSError:
+        pass
+
+def schedule_worklist_snapshot():
+    global _snapshot_timer
+    with _SNAPSHOT_LOCK:
+        if _snapshot_timer is not None:
+            return
+        _snapshot_timer = threading.Timer(SNAPSHOT_SAVE_DELAY, save_worklist_snapshot)
+        _snapshot_timer.daemon = True
+        _snapshot_timer.start()
+
+def flush_worklist_snapshot():
+    with _SNAPSHOT_LOCK:
+        pending = _snapshot_timer is not None
+        if pending:
+            _snapshot_timer.cancel()
+    if pending:
+        save_worklist_snapshot()
+
+atexit.register(flush_worklist_snapshot)
+
+def load_worklist_snapshot() -> bool:
+    """Naloži posnetek, če velja za trenutni arhiv/AET in lokalna kopija še ni polna."""
+    try:
+        with open(SNAPSHOT_FILE, "rb") as f:
+            snap = json.loads(gzip.decompress(f.read()))
+    except (OSError, ValueError, EOFError):
+        return False
+    key = _wl_key()
+    if tuple(snap.get("key") or ()) != key or not isinstance(snap.get("items"), list):
+        return False
+    with _WL_LOCK:
+        if WL_CACHE["key"] == key:
+            return False
+    return _apply_worklist(snap["items"], key, snap.get("rawHash", ""), float(snap.get("ts") or 0), "snapshot") is not None
+
+def start_snapshot_reconcile():
+    """Uskladitev posnetka z arhivom v ozadju (ne zadrži zagona)."""
+    t = threading.Thread(target=refresh_worklist_cache, name="wl-reconcile", daemon=True)
+    t.start()
+    return t
+
+SPS_DONE_STATUSES = {"COMPLETED", "DISCONTINUED"}
+
+def _view_filter(name: str):
+    if name == "active":
+        # skrij elemente, pri katerih so vsi SPS opravljeni
+        return lambda it: not it["scheduledProcedureStep"] or any(
+            (s.get("scheduledProcedureStepStatus") or "").upper() not in SPS_DONE_STATUSES
+            for s in it["scheduledProcedureStep"])
+    return None
+
+def worklist_view(state: dict, name: str = "all"):
+    """(telo, etag) za pogled; filtrirani pogledi se izračunajo enkrat na različico."""
+    flt = _view_filter(name)
+    if flt is None:
+        return state["body"], state["etag"]
+    with _WL_LOCK:
+        if WL_CACHE["etag"] == state["etag"] and name in WL_CACHE["views"]:
+            v = WL_CACHE["views"][name]
+            return v["body"], v["etag"]
+    body = (app.json.dumps([it for it in state["simple"] if flt(it)]) + "\n").encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()[:20]
+    with _WL_LOCK:
+        if WL_CACHE["etag"] == state["etag"]:
+            WL_CACHE["views"][name] = {"body": body, "etag": etag, "gz": None}
+    return body, etag
+
+def worklist_cache_gzip(etag: str):
+    with _WL_LOCK:
+        if WL_CACHE["etag"] == etag:
+            holder = WL_CACHE
+        else:
+            holder = next((v for v in WL_CACHE["views"].values() if v["etag"] == etag), None)
+            if holder is None:
+                return None
+        if holder["gz"] is None:
+            holder["gz"] = gzip.compress(holder["body"], compresslevel=6, mtime=0)
+        return holder["gz"]
+
+def build_worklist_index(arr: list) -> dict:
+    """
+    Indeks lokalne kopije: ena vrstica na SPS element, dostop po postaji,
+    datumu (urejen seznam datumov za intervale) in SPS ID.
+    """
+    rows, by_station, by_date, by_sps = [], {}, {}, {}
+    for pos, ds in enumerate(arr):
+        if not isinstance(ds, dict):
+            continue
+        studyuid = _get_str(ds, "0020000D")
+        for item in (ds.get("00400100") or {}).get("Value") or []:
+            if not isinstance(item, dict):
+                continue
+            row = {
+                "ds": ds,
+                "pos": pos,         # mesto v items/simple
+                "sps": item,
+                "studyuid": studyuid,
+                "spsid": _get_str(item, "00400009"),
+                "station": _get_str(item, "00400001"),
+                "date": _get_str(item, "00400002"),
+                "time": _get_str(item, "00400003"),
+                "modality": _get_str(item, "00080060"),
+                "status": _get_str(item, "00400020"),
+            }
+            rows.append(row)
+            by_station.setdefault(row["station"], []).append(row)
+            by_date.setdefault(row["date"], []).append(row)
+            if row["spsid"]:
+                by_sps[row["spsid"]] = row
+    return {"rows": rows, "by_station": by_station, "by_date": by_date,
+            "dates": sorted(by_date), "by_sps": by_sps, "slots": build_slot_index(rows)}
+
+def cached_worklist_state():
+    """Zadnja znana kopija za trenutni arhiv ali None."""
+    with _WL_LOCK:
+        if WL_CACHE["key"] != _wl_key() or not WL_CACHE["etag"]:
+            return None
+        return dict(WL_CACHE)
+
+def worklist_index():
+    with _WL_LOCK:
+        if WL_CACHE["key"] != _wl_key():
+            return None
+        return WL_CACHE["index"]
+
+def refresh_worklist_cache():
+    """Prebere /mwlitems iz arhiva v lokalno kopijo; ob napaki vrne None."""
+    try:
+        r = arc_get(f"/aets/{CFG['aet']}/rs/mwlitems", {"Accept": "application/dicom+json"})
+    except requests.RequestException:
+        return None
+    if not r.ok:
+        return None
+    return update_worklist_cache(r.content)
+
+_wl_refresh_event = threading.Event()
+
+def request_worklist_refresh():
+    """Po spremembi (create/delete) zbudi osveževalnik, če teče."""
+    _wl_refresh_event.set()
+
+def _worklist_refresher(interval: float):
+    while True:
+        refresh_worklist_cache()
+        _wl_refresh_event.wait(interval)
+        _wl_refresh_event.clear()
+
+def start_worklist_refresher(interval: float = 30.0):
+    t = threading.Thread(target=_worklist_refresher, args=(interval,), name="wl-refresh", daemon=True)
+    t.start()
+    return t
+
+def send_cached_bytes(body: bytes, mimetype: str, etag: str, gz=None, br=None, cache_control="no-cache"):
+    """
+    Odgovor z (šibkim) ETagom: 304, če ga brskalnik že ima, sicer telo
+    (brotli/gzip, če ga odjemalec sprejme in je telo dovolj veliko).
+    `gz` in `br` sta bytes ali funkcija, ki vrne stisnjeno telo.
+    """
+    if etag and request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        data = body
+        encoding = None
+        if len(body) >= GZIP_MIN_BYTES:
+            for name, variant in (("br", br), ("gzip", gz)):
+                if variant is None or name not in request.accept_encodings:
+                    continue
+                enc_body = variant() if callable(variant) else variant
+                if enc_body is not None:
+                    data, encoding = enc_body, name
+                    break
+        resp = Response(data, mimetype=mimetype)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+    if etag:
+        resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = cache_control
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+# ---------- Statistika delovne liste ----------
+# Števci po postaji, modaliteti, stanju in dnevu se posodabljajo sproti:
+# ob osvežitvi kopije primerjamo nov indeks z zadnjim znanim (razlika po SPS),
+# create/delete pa števce popravita takoj. /api/stats tako nikoli ne bere
+# arhiva in ne preračunava cele liste; telo se serializira le ob spremembi.
+_STATS_LOCK = threading.Lock()
+WL_STATS = {
+    "key": None,            # (server_base, aet), za katerega veljajo števci
+    "rows": {},             # (studyuid, spsid) -> (postaja, modaliteta, datum, stanje)
+    "station": Counter(),
+    "modality": Counter(),
+    "status": Counter(),
+    "day": Counter(),
+    "day_station": Counter(),
+    "day_modality": Counter(),
+    "version": 0,
+    "ts": 0.0,
+    "body": None,           # (version, bytes, etag)
+}
+
+def _stats_row(station, modality, date, status):
+    return (station or "", (modality or "").upper(), date or "", (status or "SCHEDULED").upper())
+
+def _stats_add(key, row, sign):
+    # klicati pod _STATS_LOCK
+    station, modality, date, status = row
+    for name, k in (("station", station), ("modality", modality), ("status", status), ("day", date),
+                    ("day_station", (date, station)), ("day_modality", (date, modality))):
+        c = WL_STATS[name]
+        c[k] += sign
+        if c[k] <= 0:
+            del c[k]
+    if sign > 0:
+        WL_STATS["rows"][key] = row
+    else:
+        WL_STATS["rows"].pop(key, None)
+
+def _stats_reset(key):
+    WL_STATS["key"] = key
+    WL_STATS["rows"] = {}
+    for name in ("station", "modality", "status", "day", "day_station", "day_modality"):
+        WL_STATS[name] = Counter()
+
+def _stats_touch():
+    WL_STATS["version"] += 1
+    WL_STATS["ts"] = time.time()
+
+def stats_sync_index(key, idx):
+    """
+    Uskladi števce z indeksom nove kopije: odštejemo izginule SPS, prištejemo
+    nove, spremenjenim (npr. stanje) popravimo razliko. Vrne število sprememb.
+    """
+    if idx is None:
+        return 0
+    new = {(r["studyuid"], r["spsid"]): _stats_row(r["station"], r["modality"], r["date"], r["status"])
+           for r in idx["rows"]}
+    changed = 0
+    with _STATS_LOCK:
+        if WL_STATS["key"] != key:
+            _stats_reset(key)
+        old = WL_STATS["rows"]
+        for k in [k for k in old if k not in new]:
+            _stats_add(k, old[k], -1)
+            changed += 1
+        for k, row in new.items():
+            prev = old.get(k)
+            if prev == row:
+                continue
+            if prev is not None:
+                _stats_add(k, prev, -1)
+            _stats_add(k, row, +1)
+            changed += 1
+        if changed:
+            _stats_touch()
+    return changed
+
+def stats_record_create(studyuid: str, steps: list, sps_ids: list, modality: str):
+    """Takoj prišteje ustvarjene korake; osvežitev jih kasneje le potrdi."""
+    with _STATS_LOCK:
+        if WL_STATS["key"] != _wl_key():
+            return
+        for st, sid in zip(steps, sps_ids):
+            row = _stats_row(st["stationAET"], st.get("modality") or modality, st["schedDate"], "SCHEDULED")
+            _stats_add((studyuid, sid), row, +1)
+        _stats_touch()
+
+def stats_record_delete(pairs):
+    """Takoj odšteje izbrisane (studyuid, spsid) pare."""
+    with _STATS_LOCK:
+        if WL_STATS["key"] != _wl_key():
+            return
+        rows = WL_STATS["rows"]
+        for studyuid, spsid in pairs:
+            for k in ((studyuid, spsid), ("", spsid)):
+                if k in rows:
+                    _stats_add(k, rows[k], -1)
+        _stats_touch()
+
+def stats_record_status(key, rows):
+    """Popravi števce za vrstice indeksa, katerim se je spremenilo stanje."""
+    with _STATS_LOCK:
+        if WL_STATS["key"] != key:
+            return
+        for r in rows:
+            k = (r["studyuid"], r["spsid"])
+            if k in WL_STATS["rows"]:
+                _stats_add(k, WL_STATS["rows"][k], -1)
+            _stats_add(k, _stats_row(r["station"], r["modality"], r["date"], r["status"]), +1)
+        _stats_touch()
+
+def _stats_nested(counter):
+    out = {}
+    for (day, k), n in counter.items():
+        out.setdefault(day, {})[k] = n
+    return out
+
+def stats_body():
+    """(telo, etag) trenutnih števcev; serializira se le, če so se spremenili."""
+    with _STATS_LOCK:
+        cached = WL_STATS["body"]
+        if cached and cached[0] == WL_STATS["version"]:
+            return cached[1], cached[2]
+        doc = {
+            "ok": True,
+            "total": len(WL_STATS["rows"]),
+            "byStation": dict(WL_STATS["station"]),
+            "byModality": dict(WL_STATS["modality"]),
+            "byStatus": dict(WL_STATS["status"]),
+            "byDay": dict(sorted(WL_STATS["day"].items())),
+            "byDayStation": _stats_nested(WL_STATS["day_station"]),
+            "byDayModality": _stats_nested(WL_STATS["day_modality"]),
+            "updated": datetime.fromtimestamp(WL_STATS["ts"]).isoformat(timespec="seconds") if WL_STATS["ts"] else "",
+            "version": WL_STATS["version"],
+        }
+        body = dumps_bytes(doc)
+        etag = "s%d-%s" % (WL_STATS["version"], hashlib.sha1(body).hexdigest()[:12])
+        WL_STATS["body"] = (WL_STATS["version"], body, etag)
+        return body, etag
+
+# ---------- Termini: konflikti po postajah ----------
+# MWL ne hrani trajanja posega, zato vsak SPS zasede SLOT_MINUTES od začetka.
+# Za vsako (postaja, datum) hranimo urejen seznam (začetek, konec, ref) v
+# minutah; prekrivanje je tako dvojiško iskanje namesto pregleda cele liste.
+SLOT_MINUTES = max(1, int(os.environ.get("SLOT_MINUTES", "15")))
+SLOT_DAY_END = 24 * 60
+SLOT_FREE_STATUSES = {"DISCONTINUED", "CANCELED"}
+SLOT_HOLD_SECONDS = float(os.environ.get("SLOT_HOLD_SECONDS", "300"))
+
+# Rezervacije vpisov v teku: SPS ID -> {"key", "slot", "entry", "expires"}.
+# Ob vsaki obnovi indeksa iz arhiva se dodajo nazaj, dokler arhiv SPS ne
+# vrne (ali rezervacija ne poteče), da vzporedna vpisa ne dobita istega
+# termina. Dostop pod _WL_LOCK.
+_PENDING_SLOTS = {}
+
+def _tm_minutes(tm: str):
+    digits = re.sub(r"\D", "", (tm or "").split(".")[0])
+    if len(digits) < 4:
+        return None
+    h, m = int(digits[:2]), int(digits[2:4])
+    if h > 23 or m > 59:
+        return None
+    return h * 60 + m
+
+def _minutes_tm(minutes: int) -> str:
+    return f"{minutes // 60:02d}{minutes % 60:02d}00"
+
+def build_slot_index(rows: list) -> dict:
+    slots = {}
+    for row in rows:
+        if row["status"] in SLOT_FREE_STATUSES or not row["station"] or not row["date"]:
+            continue
+        start = _tm_minutes(row["time"])
+        if start is None:
+            continue
+        slots.setdefault((row["station"], row["date"]), []).append(
+            (start, start + SLOT_MINUTES, row["spsid"]))
+    for lst in slots.values():
+        lst.sort()
+    return slots
+
+def _slot_conflicts(lst: list, start: int) -> list:
+    """Termini, ki se prekrivajo z [start, start+SLOT_MINUTES)."""
+    lo = bisect.bisect_left(lst, (start - SLOT_MINUTES + 1,))
+    hi = bisect.bisect_left(lst, (start + SLOT_MINUTES,))
+    return lst[lo:hi]
+
+def _next_free_slot(lst: list, start: int):
+    while True:
+        hits = _slot_conflicts(lst, start)
+        if not hits:
+            return start if start + SLOT_MINUTES <= SLOT_DAY_END else None
+        start = hits[-1][1]
+
+def _slot_result(lst: list, start: int, date_da: str) -> dict:
+    hits = _slot_conflicts(lst, start)
+    out = {"ok": not hits,
+           "konflikti": [{"spsId": ref, "schedTime": _minutes_tm(s)} for s, _, ref in hits]}
+    if hits:
+        free = _next_free_slot(lst, start)
+        out["predlog"] = {"schedDate": date_da, "schedTime": _minutes_tm(free)} if free is not None else None
+    return out
+
+def _merge_pending_slots(key, idx):
+    # kliče se pod _WL_LOCK, z novim indeksom, preden ga namestimo
+    now = time.monotonic()
+    for ref, p in list(_PENDING_SLOTS.items()):
+        if p["expires"] <= now or ref in idx["by_sps"]:
+            del _PENDING_SLOTS[ref]
+        elif p["key"] == key:
+            lst = idx["slots"].setdefault(p["slot"], [])
+            if p["entry"] not in lst:
+                bisect.insort(lst, p["entry"])
+
+def _slot_status_changed(idx, row, old_status):
+    # kliče se pod _WL_LOCK: sprostitev ali ponovna zasedba termina ob spremembi stanja
+    freed, taken = old_status in SLOT_FREE_STATUSES, row["status"] in SLOT_FREE_STATUSES
+    start = _tm_minutes(row["time"])
+    if freed == taken or start is None or not row["station"] or not row["date"]:
+        return
+    slot, entry = (row["station"], row["date"]), (start, start + SLOT_MINUTES, row["spsid"])
+    lst = idx["slots"].setdefault(slot, [])
+    i = bisect.bisect_left(lst, entry)
+    if taken:
+        if i < len(lst) and lst[i] == entry:
+            del lst[i]
+        if not lst:
+            del idx["slots"][slot]
+    elif i >= len(lst) or lst[i] != entry:
+        lst.insert(i, entry)
+
+def _slot_index():
+    """Indeks terminov iz lokalne kopije; če je še ni, jo enkrat naloži."""
+    idx = worklist_index()
+    if idx is None and refresh_worklist_cache() is not None:
+        idx = worklist_index()
+    return idx
+
+def reserve_slot(station: str, date_da: str, tm: str, ref: str, force: bool = False):
+    """
+    Preveri termin in ga ob uspehu (ali force) takoj zabeleži v indeks, da
+    ga vidijo tudi vzporedni vpisi, preden osveževalnik prebere arhiv.
+    `ref` je SPS ID vpisa; rezervacija preživi obnovo indeksa (_PENDING_SLOTS).
+    Vrne None, če termina ni mogoče preveriti, sicer rezultat z "ok".
+    """
+    start = _tm_minutes(tm)
+    if not station or not date_da or start is None or _slot_index() is None:
+        return None
+    with _WL_LOCK:
+        idx = WL_CACHE["index"] if WL_CACHE["key"] == _wl_key() else None
+        if idx is None:
+            return None
+        lst = idx["slots"].setdefault((station, date_da), [])
+        res = _slot_result(lst, start, date_da)
+        if res["ok"] or force:
+            entry = (start, start + SLOT_MINUTES, ref)
+            bisect.insort(lst, entry)
+            _PENDING_SLOTS[ref] = {"key": WL_CACHE["key"], "slot": (station, date_da), "entry": entry,
+                                   "expires": time.monotonic() + SLOT_HOLD_SECONDS}
+    return res
+
+def release_slot(station: str, date_da: str, tm: str, ref: str):
+    start = _tm_minutes(tm)
+    with _WL_LOCK:
+        _PENDING_SLOTS.pop(ref, None)
+        idx = WL_CACHE["index"] if WL_CACHE["key"] == _wl_key() else None
+        lst = (idx or {}).get("slots", {}).get((station, date_da))
+        if lst and start is not None:
+            try:
+                lst.remove((start, start + SLOT_MINUTES, ref))
+            except ValueError:
+                pass
+
+def check_slots(entries: list) -> list:
+    """Paketno preverjanje; upošteva tudi prekrivanja med vrsticami paketa."""
+    idx = _slot_index()
+    with _WL_LOCK:
+        base = dict(idx["slots"]) if idx else {}
+    local = {}
+    results = []
+    for i, e in enumerate(entries):
+        station = (e.get("stationAET") or "").strip()
+        date_da = e.get("schedDate_da") or to_da(e.get("schedDate") or "")
+        start = _tm_minutes(e.get("schedTime_tm") or to_tm(e.get("schedTime") or ""))
+        if not station or not date_da or start is None:
+            results.append({"ok": True, "konflikti": [], "preverjeno": False})
+            continue
+        key = (station, date_da)
+        if key not in local:
+            with _WL_LOCK:
+                local[key] = list(base.get(key, ()))
+        res = _slot_result(local[key], start, date_da)
+        res["preverjeno"] = idx is not None
+        bisect.insort(local[key], (start, start + SLOT_MINUTES, f"vrstica {i + 1}"))
+        results.append(res)
+    return results
+
+@app.post("/api/slots/check")
+def api_slots_check():
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list):
+        return jsonify({"ok": False, "napaka": "Pričakujem seznam 'items'."}), 400
+    results = check_slots([e if isinstance(e, dict) else {} for e in items])
+    return jsonify({"ok": True, "trajanjeMin": SLOT_MINUTES,
+                    "konfliktov": sum(1 for r in results if not r["ok"]),
+                    "rezultati": results})
+
+
+# ---------- Revizijska sled (audit) ----------
+# Dogodki (vpis, brisanje, uvoz, nastavitve) gredo v vrsto; pisalnik v
+# ozadju jih v paketih doda v mesečni dnevnik audit/audit-YYYYMM.jsonl.
+# Ob vsakem zapisu doda še vrstico "datum<TAB>accession<TAB>PID<TAB>odmik"
+# v audit-YYYYMM.idx; indeks se ob prvi poizvedbi naloži v pomnilnik, zato
+# poizvedba prebere le zadetke (seek + readline), ne celega dnevnika.
+AUDIT_DIR = os.environ.get("AUDIT_DIR", "audit")
+AUDIT_QUEUE_MAX = 10000
+AUDIT_BATCH_MAX = 200
+AUDIT_FLUSH_SECONDS = 1.0
+AUDIT_QUERY_MAX = 1000
+
+_audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_MAX)
+_audit_worker = None
+_AUDIT_LOCK = threading.Lock()
+# pisalnik drži _AUDIT_WRITE_LOCK od zapisa datotek do posodobitve indeksa;
+# nalaganje indeksa vzame isto ključavnico, da zapisa ne vidi dvakrat
+_AUDIT_WRITE_LOCK = threading.Lock()
+AUDIT_STATS = {"written": 0, "dropped": 0, "batches": 0, "lastError": ""}
+# pomnilniški indeks: datum/accession/PID -> [(datum, mesec, odmik)]; refs: {(mesec, odmik)}
+_AUDIT_IDX = {"loaded": False, "date": {}, "acc": {}, "pid": {}, "dates": [], "refs": set()}
+
+def _audit_actor() -> str:
+    try:
+        return request.headers.get("X-User") or request.remote_addr or ""
+    except RuntimeError:        # zunaj HTTP zahtevka (HL7, čiščenje)
+        return ""
+
+def audit_log(action: str, **fields):
+    """Doda dogodek v vrsto; na poti zahtevka ni pisanja na disk."""
+    now = datetime.now()
+    rec = {"ts": now.isoformat(timespec="milliseconds"), "action": action,
+           "actor": fields.pop("actor", None) or _audit_actor()}
+    rec.update({k: v for k, v in fields.items() if v not in (None, "", [], {})})
+    try:
+        _audit_queue.put_nowait(rec)
+    except queue.Full:
+        with _AUDIT_LOCK:
+            AUDIT_STATS["dropped"] += 1
+        return
+    _ensure_audit_worker()
+
+def _audit_paths(month: str):
+    return (os.path.join(AUDIT_DIR, f"audit-{month}.jsonl"), os.path.join(AUDIT_DIR, f"audit-{month}.idx"))
+
+def _audit_index_add(da: str, month: str, acc: str, pid: str, offset: int):
+    # kliče se pod _AUDIT_LOCK
+    if (month, offset) in _AUDIT_IDX["refs"]:
+        return
+    _AUDIT_IDX["refs"].add((month, offset))
+    ref = (da, month, offset)
+    if da not in _AUDIT_IDX["date"]:
+        bisect.insort(_AUDIT_IDX["dates"], da)
+    _AUDIT_IDX["date"].setdefault(da, []).append(ref)
+    if acc:
+        _AUDIT_IDX["acc"].setdefault(acc, []).append(ref)
+    if pid:
+        _AUDIT_IDX["pid"].setdefault(pid, []).append(ref)
+
+def _write_audit_batch(batch: list):
+    with _AUDIT_WRITE_LOCK:
+        _write_audit_files(batch)
+
+def _write_audit_files(batch: list):
+    # kliče se pod _AUDIT_WRITE_LOCK
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    by_month = {}
+    for rec in batch:
+        by_month.setdefault(rec["ts"][:7].replace("-", ""), []).append(rec)
+    added = []
+    for month, recs in by_month.items():
+        log_path, idx_path = _audit_paths(month)
+        with open(log_path, "ab") as log, open(idx_path, "a", encoding="utf-8") as idx:
+            offset = log.seek(0, os.SEEK_END)
+            lines, idx_lines = [], []
+            for rec in recs:
+                line = dumps_bytes(rec) + b"\n"
+                da = rec["ts"][:10].replace("-", "")
+                acc, pid = str(rec.get("accession") or ""), str(rec.get("patientId") or "")
+                lines.append(line)
+                idx_lines.append(f"{da}\t{acc}\t{pid}\t{offset}\n")
+                added.append((da, month, acc, pid, offset))
+                offset += len(line)
+            log.write(b"".join(lines))
+            log.flush()
+            os.fsync(log.fileno())
+            # indeks za dnevnikom: ob prekinitvi kvečjemu manjka kak zadetek v indeksu
+            idx.write("".join(idx_lines))
+    with _AUDIT_LOCK:
+        if _AUDIT_IDX["loaded"]:
+            for item in added:
+                _audit_index_add(*item)
+        AUDIT_STATS["written"] += len(batch)
+        AUDIT_STATS["batches"] += 1
+
+def _audit_loop():
+    while True:
+        batch = [_audit_queue.get()]
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while len(batch) < AUDIT_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_audit_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _write_audit_batch(batch)
+        except Exception as e:
+            with _AUDIT_LOCK:
+                AUDIT_STATS["lastError"] = str(e)
+        finally:
+            for _ in batch:
+                _audit_queue.task_done()
+
+def _ensure_audit_worker():
+    global _audit_worker
+    with _AUDIT_LOCK:
+        if _audit_worker is None:
+            _audit_worker = threading.Thread(target=_audit_loop, name="audit-writer", daemon=True)
+            _audit_worker.start()
+
+def flush_audit(timeout: float = 5.0):
+    """Počaka, da pisalnik zapiše vse dogodke v vrsti (ob izhodu)."""
+    deadline = time.monotonic() + timeout
+    while _audit_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+atexit.register(flush_audit)
+
+def _load_audit_index():
+    with _AUDIT_LOCK:
+        if _AUDIT_IDX["loaded"]:
+            return
+    with _AUDIT_WRITE_LOCK, _AUDIT_LOCK:
+        if _AUDIT_IDX["loaded"]:
+            return
+        try:
+            names = sorted(n for n in os.listdir(AUDIT_DIR) if n.startswith("audit-") and n.endswith(".idx"))
+        except OSError:
+            names = []
+        for name in names:
+            month = name[6:-4]
+            with open(os.path.join(AUDIT_DIR, name), encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 4 and parts[3].isdigit():
+                        _audit_index_add(parts[0], month, parts[1], parts[2], int(parts[3]))
+        _AUDIT_IDX["loaded"] = True
+
+def query_audit(d_from: str = "", d_to: str = "", accession: str = "", patient_id: str = "",
+                action: str = "", limit: int = 200) -> list:
+    """Dogodki (najnovejši najprej); najprej izbere odmike iz indeksa, nato bere le te."""
+    _load_audit_index()
+    with _AUDIT_LOCK:
+        if accession or patient_id:
+            sets = [set(_AUDIT_IDX["acc"].get(accession, ())) if accession else None,
+                    set(_AUDIT_IDX["pid"].get(patient_id, ())) if patient_id else None]
+            refs = set.intersection(*[x for x in sets if x is not None])
+            if d_from or d_to:
+                refs = {r for r in refs if (not d_from or r[0] >= d_from) and (not d_to or r[0] <= d_to)}
+        else:
+            dates = _AUDIT_IDX["dates"]
+            lo = bisect.bisect_left(dates, d_from) if d_from else 0
+            hi = bisect.bisect_right(dates, d_to) if d_to else len(dates)
+            refs = [r for da in dates[lo:hi] for r in _AUDIT_IDX["date"][da]]
+    out = []
+    by_month = {}
+    for _, month, offset in sorted(refs, key=lambda r: (r[1], r[2]), reverse=True):
+        by_month.setdefault(month, []).append(offset)
+    for month in sorted(by_month, reverse=True):
+        with open(_audit_paths(month)[0], "rb") as f:
+            for offset in by_month[month]:
+                f.seek(offset)
+                try:
+                    rec = json.loads(f.readline())
+                except ValueError:
+                    continue
+                if action and rec.get("action") != action:
+                    continue
+                out.append(rec)
+                if len(out) >= limit:
+                    return out
+    return out
+
+@app.get('/api/audit')
+def api_audit():
+    """?date=&dateTo=&accession=&patientId=&action=&limit= ; brez filtrov velja današnji dan."""
+    accession = (request.args.get("accession") or "").strip()
+    patient_id = (request.args.get("patientId") or "").strip()
+    d_from = to_da(request.args.get("date") or "")
+    d_to = to_da(request.args.get("dateTo") or "") or d_from
+    if not (accession or patient_id or d_from):
+        d_from = d_to = datetime.now().strftime("%Y%m%d")
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 200), AUDIT_QUERY_MAX))
+    except ValueError:
+        limit = 200
+    t0 = time.perf_counter()
+    items = query_audit(d_from, d_to, accession, patient_id, (request.args.get("action") or "").strip(), limit)
+    with _AUDIT_LOCK:
+        stats = dict(AUDIT_STATS)
+    return jsonify({"ok": True, "count": len(items), "items": items, "pending": _audit_queue.qsize(),
+                    "query_ms": round((time.perf_counter() - t0) * 1000, 2), **stats})
+
+
 # ---------- BRISANJE ----------
 def delete_mwl_by_uid_and_sps(study_uid: str, sps_id: str):
     p = f"/aets/{CFG['aet']}/rs/mwlitems/{requests.utils.quote(study_uid)}/{requests.utils.quote(sps_id)}"
     r = arc_delete(p, {"Accept":"application/json"})
     return r
 
+DELETE_WORKERS = 4   # hkratni DELETE zahtevki (koraki ene zahteve, brisanje vseh)
+
+def _audit_delete(action: str, studyuid: str, spsid: str, resp, idx=None):
+    row = (idx or {}).get("by_sps", {}).get(spsid) if idx else None
+    ds = row["ds"] if row else {}
+    audit_log(action, studyuid=studyuid, spsid=spsid, patientId=_get_str(ds, "00100020"),
+              accession=_get_str(ds, "00080050"), patientName=_get_str(ds, "00100010"),
+              stationAET=row["station"] if row else "", ok=resp.ok, status=resp.status_code)
+
+def delete_mwl_steps(pairs: list, action: str = "delete"):
+    """
+    Vzporedno izbriše (studyuid, spsid) pare; arhiv nima skupnega brisanja,
+    zato en DELETE na SPS. Vrne (izbrisani, napake).
+    """
+    idx = worklist_index()     # PID/accession za revizijsko sled
+    def one(pair):
+        try:
+            return pair, delete_mwl_by_uid_and_sps(*pair)
+        except requests.RequestException as e:
+            return pair, _synthetic_response(502, str(e), "")
+
+    deleted, errors = [], []
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as ex:
+        for (studyuid, spsid), resp in ex.map(one, pairs):
+            _audit_delete(action, studyuid, spsid, resp, idx)
+            if resp.ok:
+                deleted.append({"studyuid": studyuid, "spsid": spsid})
+            else:
+                errors.append({"studyuid": studyuid, "spsid": spsid,
+                               "status": resp.status_code, "body": resp.text})
+    if deleted:
+        stats_record_delete([(d["studyuid"], d["spsid"]) for d in deleted])
+        request_worklist_refresh()
+    return deleted, errors
+
+def _sps_rows(spsid: str = "", studyuid: str = ""):
+    """SPS vrstice iz lokalne kopije (po SPS ID ali vsi koraki študije); ob zgrešitvi enkrat osveži."""
+    for attempt in range(2):
+        idx = worklist_index()
+        if idx is not None:
+            if spsid:
+                row = idx["by_sps"].get(spsid)
+                rows = [row] if row and (not studyuid or row["studyuid"] == studyuid) else []
+            else:
+                rows = [r for r in idx["rows"] if r["studyuid"] == studyuid and r["spsid"]]
+            if rows:
+                return rows
+        if attempt == 0 and refresh_worklist_cache() is None:
+            return None
+    return []
+
 @app.post('/api/remove')
 def api_remove():
     """
     Body JSON:
-      {"spsid":"SPS_...", "studyuid":"2.25...."}  # idealno
-    Če "studyuid" manjka, aplikacija sama prebere /mwlitems in poišče StudyInstanceUID.
+      {"spsid":"S...", "studyuid":"2.25...."}  # idealno
+      {"studyuid":"2.25...."}                 # vsi koraki zahteve
+    Če "studyuid" manjka, ga poiščemo v indeksu lokalne kopije po SPS ID.
     """
     data = request.get_json(silent=True) or {}
     spsid = (data.get("spsid") or "").strip()
     studyuid = (data.get("studyuid") or "").strip()
 
-    if not spsid:
-        return jsonify({"ok": False, "napaka": "Manjka 'spsid'."}), 400
+    if not spsid and not studyuid:
+        return jsonify({"ok": False, "napaka": "Manjka 'spsid' ali 'studyuid'."}), 400
 
-    # če nimamo studyuid, ga poiščemo
-    if not studyuid:
-        r = arc_get(f"/aets/{CFG['aet']}/rs/mwlitems", {"Accept":"application/dicom+json"})
-        if not r.ok:
-            return Response(r.text, status=r.status_code)
-        try:
-            arr = r.json()
-        except Exception:
-            return jsonify({"ok": False, "napaka": "Nepričakovan odgovor PACS.", "odgovor": r.text}), 502
-
-        if isinstance(arr, list):
-            for ds in arr:
-                sps_seq = (ds or {}).get("00400100", {})
-                items = sps_seq.get("Value") or []
-                cur_sps = None
-                if items:
-                    v = items[0]
-                    val = (v.get("00400009", {}) or {}).get("Value") or []
-                    cur_sps = str(val[0]) if val else ""
-                if cur_sps and cur_sps == spsid:
-                    val = (ds.get("0020000D", {}) or {}).get("Value") or []
-                    studyuid = str(val[0]) if val else ""
-                    if studyuid:
-                        break
-
-        if not studyuid:
+    if spsid and studyuid:
+        pairs = [(studyuid, spsid)]
+    else:
+        rows = _sps_rows(spsid, studyuid)
+        if rows is None:
+            return jsonify({"ok": False, "napaka": "Seznama MWL ni bilo mogoče prebrati iz arhiva."}), 502
+        if not rows:
             return jsonify({"ok": False, "napaka": "Ni bilo mogoče najti StudyInstanceUID za podani SPS ID."}), 404
+        pairs = [(r["studyuid"], r["spsid"]) for r in rows]
 
-    resp = delete_mwl_by_uid_and_sps(studyuid, spsid)
-    try:
-        body = resp.json()
-    except Exception:
-        body = resp.text
-
-    return jsonify({"ok": resp.ok, "status": resp.status_code, "response": body}), (200 if resp.ok else resp.status_code)
+    deleted, errors = delete_mwl_steps(pairs)
+    if len(pairs) == 1:
+        if errors:
+            e = errors[0]
+            return jsonify({"ok": False, "status": e["status"], "response": e["body"]}), e["status"]
+        return jsonify({"ok": True, "status": 200, "deleted": deleted})
+    return jsonify({"ok": not errors, "deleted": deleted, "errors": errors}), (200 if not errors else 207)
 
 
 # ---------- BRISANJE VSEH MWL ELEMENTOV ----------
@@ -397,60 +2053,35 @@ def api_remove_all():
     if not isinstance(arr, list):
         return jsonify({"ok": True, "deleted": [], "errors": []})
 
-    deleted = []
-    errors = []
-
+    pairs = []
     for ds in arr:
         if not isinstance(ds, dict):
             continue
-        # StudyInstanceUID
-        try:
-            val_uid = (ds.get("0020000D", {}) or {}).get("Value") or []
-            studyuid = str(val_uid[0]) if val_uid else ""
-        except Exception:
-            studyuid = ""
-
-        # ScheduledProcedureStepSequence (00400100)
-        sps_seq = (ds.get("00400100", {}) or {})
-        items = sps_seq.get("Value") or []
-        for item in items:
-            try:
-                val_sps = (item.get("00400009", {}) or {}).get("Value") or []
-                spsid = str(val_sps[0]) if val_sps else ""
-            except Exception:
-                spsid = ""
-
-            if not studyuid or not spsid:
-                continue
-
-            resp = delete_mwl_by_uid_and_sps(studyuid, spsid)
-            if resp.ok:
-                deleted.append({"studyuid": studyuid, "spsid": spsid})
-            else:
-                errors.append({
-                    "studyuid": studyuid,
-                    "spsid": spsid,
-                    "status": resp.status_code,
-                    "body": resp.text
-                })
+        studyuid = _get_str(ds, "0020000D")
+        for item in (ds.get("00400100") or {}).get("Value") or []:
+            spsid = _get_str(item, "00400009") if isinstance(item, dict) else ""
+            if studyuid and spsid:
+                pairs.append((studyuid, spsid))
 
+    deleted, errors = delete_mwl_steps(pairs, action="delete_all")
     return jsonify({
         "ok": len(errors) == 0,
         "deleted": deleted,
         "errors": errors
     }), (200 if len(errors) == 0 else 207)
 
-# ---------- API: UI, config, list, create ----------
-@app.route('/')
-def index():
-    return Response(INDEX_HTML, mimetype='text/html')
-
+# ---------- API: config, list, create ----------
 @app.post('/api/config')
 def set_config():
     data = request.json or {}
+    changed = {}
     for k in CFG.keys():
         if k in data:
+            if CFG[k] != data[k]:
+                changed[k] = "***" if k == "password" else data[k]
             CFG[k] = data[k]
+    if changed:
+        audit_log("config", changes=changed)
     return jsonify({"ok": True, "cfg": CFG})
 
 @app.get('/api/stations')
@@ -466,21 +2097,172 @@ def add_station():
 
 @app.get('/api/list')
 def list_mwl():
+    view = "active" if request.args.get("active") else "all"
     r = arc_get(f"/aets/{CFG['aet']}/rs/mwlitems", {"Accept":"application/dicom+json"})
     if not r.ok:
-        return Response(r.text, status=r.status_code)
-    try:
-        arr = r.json()
-        if not isinstance(arr, list):
-            return jsonify([])
-        simple = [dicom_mwl_to_simple(ds) for ds in arr]
-        return jsonify(simple)
-    except Exception:
+        # arhiv nedosegljiv: vrnemo zadnjo znano listo z oznako zastarelosti
+        state = cached_worklist_state() if arc_unhealthy(r) else None
+        if state is None:
+            return Response(r.text, status=r.status_code)
+        body, etag = worklist_view(state, view)
+        resp = send_cached_bytes(body, "application/json", etag, gz=lambda: worklist_cache_gzip(etag))
+        resp.headers["X-Worklist-Stale"] = datetime.fromtimestamp(state["ts"]).isoformat(timespec="seconds")
+        return resp
+    state = update_worklist_cache(r.content)
+    if state is None:
         return Response(r.text, status=200, mimetype="application/json")
+    body, etag = worklist_view(state, view)
+    return send_cached_bytes(body, "application/json", etag, gz=lambda: worklist_cache_gzip(etag))
+
+@app.get('/api/stats')
+def api_stats():
+    """
+    Števci delovne liste po postaji, modaliteti, stanju in dnevu. Bere le
+    sproti posodobljene agregate; arhiv prebere samo, če kopije še ni.
+    """
+    with _STATS_LOCK:
+        ready = WL_STATS["key"] == _wl_key()
+    if not ready:
+        refresh_worklist_cache()
+    body, etag = stats_body()
+    return send_cached_bytes(body, "application/json", etag)
+
+# ---------- Idempotentni vpis ----------
+# Ponovljen POST /api/create z istim ključem (dvojni klik, ponovitev brskalnika)
+# vrne prvotni odgovor, ne da bi porabil PID/ACC ali klical arhiv. Hranimo le
+# uspešne vpise (neuspešnega je varno ponoviti): zadnjih IDEMPOTENCY_MAX v
+# pomnilniku (LRU) in v datoteki JSONL, ki se ob rasti na novo zapiše.
+IDEMPOTENCY_FILE = "idempotency.jsonl"
+IDEMPOTENCY_MAX = max(1, int(os.environ.get("IDEMPOTENCY_MAX", "2000")))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24")) * 3600
+IDEMPOTENCY_KEY_MAX = 200
+_IDEM_VOLATILE = {"requestKey", "ignoreConflict", "source"}   # ne vplivajo na vsebino vpisa
+
+_IDEM = OrderedDict()      # ključ -> {"ts", "fp", "status", "body"}
+_IDEM_LOCK = threading.Lock()
+_idem_loaded = False
+_idem_lines = 0            # vrstic v datoteki (za stiskanje)
+
+def idempotency_key(simple: dict):
+    """Ključ iz glave ali telesa; "" brez ključa, None, če je predolg."""
+    key = (request.headers.get("Idempotency-Key") or str(simple.get("requestKey") or "")).strip()
+    return None if len(key) > IDEMPOTENCY_KEY_MAX else key
+
+def _idem_fingerprint(simple: dict) -> str:
+    doc = {k: v for k, v in simple.items() if k not in _IDEM_VOLATILE}
+    return hashlib.sha1(json.dumps(doc, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _ensure_idem_loaded():
+    # kliče se pod _IDEM_LOCK
+    global _idem_loaded, _idem_lines
+    if _idem_loaded:
+        return
+    _idem_loaded = True
+    cutoff = time.time() - IDEMPOTENCY_TTL
+    try:
+        with open(IDEMPOTENCY_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                _idem_lines += 1
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(rec, dict) or not rec.get("key") or float(rec.get("ts") or 0) < cutoff:
+                    continue
+                key = rec.pop("key")
+                _IDEM[key] = rec
+                _IDEM.move_to_end(key)
+    except OSError:
+        return
+    while len(_IDEM) > IDEMPOTENCY_MAX:
+        _IDEM.popitem(last=False)
+
+def _idem_compact():
+    # kliče se pod _IDEM_LOCK: datoteko zamenjamo z vsebino LRU
+    global _idem_lines
+    tmp = IDEMPOTENCY_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, rec in _IDEM.items():
+                f.write(json.dumps({"key": key, **rec}, ensure_ascii=False, default=str) + "\n")
+        os.replace(tmp, IDEMPOTENCY_FILE)
+        _idem_lines = len(_IDEM)
+    except OSError:
+        pass
+
+def idem_get(key: str):
+    with _IDEM_LOCK:
+        _ensure_idem_loaded()
+        rec = _IDEM.get(key)
+        if rec is None:
+            return None
+        if rec["ts"] < time.time() - IDEMPOTENCY_TTL:
+            del _IDEM[key]
+            return None
+        _IDEM.move_to_end(key)
+        return rec
+
+def idem_put(key: str, entry: dict):
+    global _idem_lines
+    rec = {"ts": time.time(), **entry}
+    with _IDEM_LOCK:
+        _ensure_idem_loaded()
+        _IDEM[key] = rec
+        _IDEM.move_to_end(key)
+        while len(_IDEM) > IDEMPOTENCY_MAX:
+            _IDEM.popitem(last=False)
+        try:
+            with open(IDEMPOTENCY_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, **rec}, ensure_ascii=False, default=str) + "\n")
+            _idem_lines += 1
+        except OSError:
+            pass
+        if _idem_lines > 2 * IDEMPOTENCY_MAX:
+            _idem_compact()
 
 @app.post('/api/create')
 def create_mwl():
+    """
+    Vpis iz obrazca. Z ključem (glava Idempotency-Key ali polje "requestKey")
+    ponovljen zahtevek vrne prvotni odgovor; hkratni ponovitvi počakata na prvega.
+    """
     simple = request.json or {}
+    key = idempotency_key(simple)
+    if key is None:
+        return jsonify({"ok": False, "napaka": "Ključ zahtevka je predolg."}), 400
+    if not key:
+        doc, status = _create_mwl(simple)
+        return jsonify(doc), status
+    fp = _idem_fingerprint(simple)
+    ran = []
+
+    def run():
+        ran.append(True)
+        hit = idem_get(key)
+        if hit is not None:
+            ran.clear()         # odgovor iz predpomnilnika, ne nov vpis
+            return hit
+        doc, status = _create_mwl(simple)
+        entry = {"fp": fp, "status": status, "body": doc}
+        if 200 <= status < 300:
+            idem_put(key, entry)
+        return entry
+
+    entry = singleflight("create", key, run)
+    replayed = not ran
+    if replayed and entry["fp"] != fp:
+        return jsonify({"ok": False, "napaka": "Ključ zahtevka je bil že uporabljen za drugačen vpis."}), 422
+    resp = jsonify(entry["body"])
+    resp.status_code = entry["status"]
+    if replayed:
+        resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+def _create_mwl(simple: dict):
+    """Vpis ene zahteve (z vsemi koraki); vrne (dokument odgovora, HTTP status)."""
+    if not archive_available():
+        # ne porabimo PID/ACC, ko vemo, da vpis ne bo uspel
+        return {"ok": False, "napaka": "Arhiv trenutno ni dosegljiv."}, 503
 
     surname  = (simple.get("patientSurname") or "").strip()
     given    = (simple.get("patientGiven") or "").strip()
@@ -491,55 +2273,112 @@ def create_mwl():
     auto_pid   = bool(simple.get("autoPID"))
     req_pid    = (simple.get("patientId") or "").strip()
 
+    birth_da = simple.get("birthDate_da") or to_da(simple.get("birthDate") or simple.get("birthDate_h") or "")
+    sched_da = simple.get("schedDate_da") or to_da(simple.get("schedDate") or simple.get("schedDate_h") or "")
+    sched_tm = simple.get("schedTime_tm") or to_tm(simple.get("schedTime") or simple.get("schedTime_h") or "")
+    station_aet = (simple.get("stationAET") or "").strip()
+
+    # --- Koraki (SPS): "steps" ali en korak iz polj obrazca ---
+    steps = []
+    for st in (simple.get("steps") if isinstance(simple.get("steps"), list) else None) or [{}]:
+        st = st if isinstance(st, dict) else {}
+        steps.append({
+            **st,
+            "stationAET": (st.get("stationAET") or station_aet).strip(),
+            "schedDate": st.get("schedDate_da") or to_da(st.get("schedDate") or "") or sched_da,
+            "schedTime": st.get("schedTime_tm") or to_tm(st.get("schedTime") or "") or sched_tm,
+        })
+
+    # --- Termini: preverimo pred dodelitvijo PID/ACC ---
+    ignore = bool(simple.get("ignoreConflict"))
+    sps_ids = allocate_sps_ids(len(steps))    # SPS ID je tudi oznaka rezervacije termina
+    reserved = []
+    for st, ref in zip(steps, sps_ids):
+        slot = reserve_slot(st["stationAET"], st["schedDate"], st["schedTime"], ref, force=ignore)
+        reserved.append((st["stationAET"], st["schedDate"], st["schedTime"], ref))
+        if slot is not None and not slot["ok"] and not ignore:
+            for args in reserved:
+                release_slot(*args)
+            return {"ok": False, "napaka": f"Termin na postaji {st['stationAET']} je že zaseden.",
+                            "konflikti": slot["konflikti"], "predlog": slot.get("predlog")}, 409
+
     # --- Accession: avtomatsko, če autoACC=True ali polje prazno ---
     auto_acc   = bool(simple.get("autoACC"))
     req_acc    = (simple.get("accession") or "").strip()
     accession  = next_accession_number() if (auto_acc or not req_acc) else req_acc
 
-    birth_da = simple.get("birthDate_da") or to_da(simple.get("birthDate") or simple.get("birthDate_h") or "")
-    sched_da = simple.get("schedDate_da") or to_da(simple.get("schedDate") or simple.get("schedDate_h") or "")
-    sched_tm = simple.get("schedTime_tm") or to_tm(simple.get("schedTime") or simple.get("schedTime_h") or "")
-
     pid = generate_unique_patient_id() if (auto_pid or not req_pid) else req_pid
 
-    station_aet = (simple.get("stationAET") or "").strip()
-    if station_aet:
-        add_station_aet(station_aet)
+    for aet in {st["stationAET"] for st in steps if st["stationAET"]}:
+        add_station_aet(aet, used=True)
 
     if not ensure_patient_exists(pid, raw_pn, birth_da):
-        return jsonify({"ok": False, "napaka": "Pacienta ni bilo mogoče ustvariti", "dodeljenID": pid}), 400
+        for args in reserved:
+            release_slot(*args)
+        if not archive_available():
+            # varovalka je zahtevek zavrnila (ali se je poskus ravno ponesrečil)
+            return {"ok": False, "napaka": "Arhiv trenutno ni dosegljiv."}, 503
+        return {"ok": False, "napaka": "Pacienta ni bilo mogoče ustvariti", "dodeljenID": pid}, 400
+    patient_index_add(pid, raw_pn, birth_da)
 
     payload = {
         **simple,
         "patientName": raw_pn,
-        "schedDate": sched_da,
-        "schedTime": sched_tm,
         "accession": accession,     # <-- uporabimo izračunani accession
+        "steps": [{**st, "spsId": sid} for st, sid in zip(steps, sps_ids)],
     }
-    r = arc_post_dicom(f"/aets/{CFG['aet']}/rs/mwlitems", build_dicom_mwl(payload, pid))
+    # vsi koraki gredo v enem POST (arhiv ustvari MWL element na SPS)
+    r = arc_post_dicom(f"/aets/{CFG['aet']}/rs/mwlitems", encode_dicom_mwl(payload, pid))
+    if not r.ok:
+        for args in reserved:
+            release_slot(*args)
+
+    audit_log("create", source=simple.get("source"), patientId=pid, accession=accession,
+              patientName=raw_pn, spsIds=sps_ids, stationAET=", ".join(st["stationAET"] for st in steps),
+              schedDate=steps[0]["schedDate"], schedTime=steps[0]["schedTime"], ok=r.ok, status=r.status_code)
 
     try:
         arch_json = r.json()
     except Exception:
         arch_json = r.text
+    if r.ok:
+        studyuid = _get_str(arch_json, "0020000D") if isinstance(arch_json, dict) else ""
+        stats_record_create(studyuid or (simple.get("studyUID") or "").strip(), steps, sps_ids,
+                            (simple.get("modality") or "US").strip())
+        request_worklist_refresh()
 
-    return jsonify({
+    return {
         "ok": r.ok,
         "status": r.status_code,
         "dodeljenID": pid,
         "dodeljenAccession": accession,    # <-- vrnemo v UI
+        "dodeljeniSPS": sps_ids,
         "odgovorPACS": arch_json
-    }), r.status_code
+    }, r.status_code
 
 
 # ---------- PDF Import endpoint ----------
+# pdfplumber (in pdfminer) se naloži šele ob prvem uvozu PDF ali ob
+# predgretju v ozadju, da je zagon .exe hitrejši.
+_pdfplumber = None
+_PDF_LOCK = threading.Lock()
+
+def get_pdfplumber():
+    global _pdfplumber
+    if _pdfplumber is None:
+        with _PDF_LOCK:
+            if _pdfplumber is None:
+                import pdfplumber
+                _pdfplumber = pdfplumber
+    return _pdfplumber
+
 @app.post('/api/import_pdf')
 def import_pdf():
     file = request.files.get("file")
     if not file:
         return jsonify({"ok": False, "error": "No file"}), 400
     try:
-        pdf = pdfplumber.open(io.BytesIO(file.read()))
+        pdf = get_pdfplumber().open(io.BytesIO(file.read()))
         lines = []
         for page in pdf.pages:
             text = page.extract_text() or ""
@@ -591,11 +2430,1455 @@ def import_pdf():
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.get('/logo.png')
-def logo_png():
-    """Serve logo.png from the same directory as this script."""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    return send_from_directory(base_dir, 'logo.png')
+# ---------- Izvoz dnevnega programa (CSV / PDF) ----------
+# Vrstice se tvorijo sproti (iz indeksa lokalne kopije ali po straneh iz
+# arhiva) in gredo v odgovor po delih; PDF je sestavljen ročno, stran za
+# stranjo, tabela xref pa se zapiše na koncu.
+EXPORT_PAGE = 200           # velikost strani pri branju iz arhiva
+EXPORT_PDF_ROWS = 40        # vrstic na PDF stran (A4 ležeče)
+EXPORT_CSV_FLUSH = 100      # vrstic na kos CSV odgovora
+
+EXPORT_HEADER = ["Datum", "Čas", "Postaja", "Pacient", "ID pacienta", "Datum rojstva",
+                 "Accession", "Preiskava", "Modaliteta", "Stanje", "SPS ID"]
+# (stolpec v EXPORT_HEADER, x v pt, največ znakov) za PDF
+_PDF_COLS = [(0, 30, 10), (1, 80, 5), (2, 110, 10), (3, 170, 30), (4, 310, 16), (5, 390, 10),
+             (6, 452, 18), (7, 545, 34), (8, 700, 5), (9, 755, 12)]
+
+def _human_da(da: str) -> str:
+    return f"{da[6:8]}.{da[4:6]}.{da[:4]}" if len(da) == 8 else da
+
+def _human_tm(tm: str) -> str:
+    return f"{tm[:2]}:{tm[2:4]}" if len(tm) >= 4 else tm
+
+def _export_rows(d_from: str, d_to: str, stations: set):
+    """SPS vrstice (kot v build_worklist_index) za razpon datumov, urejene po datumu in času."""
+    idx = worklist_index()
+    key = lambda r: (r["date"], r["time"], r["station"])
+    if idx is not None:
+        dates = idx["dates"]
+        for da in dates[bisect.bisect_left(dates, d_from):bisect.bisect_right(dates, d_to)]:
+            yield from sorted((r for r in idx["by_date"][da] if not stations or r["station"] in stations), key=key)
+        return
+    query = f"00400100.00400002={d_from}-{d_to}"
+    if len(stations) == 1:
+        query += f"&00400100.00400001={requests.utils.quote(next(iter(stations)))}"
+    offset = 0
+    while True:
+        r = arc_get(f"/aets/{CFG['aet']}/rs/mwlitems?{query}&limit={EXPORT_PAGE}&offset={offset}",
+                    {"Accept": "application/dicom+json"})
+        if not r.ok:
+            raise RuntimeError(f"PACS {r.status_code}")
+        arr = r.json() if r.content.strip() else []
+        if not isinstance(arr, list) or not arr:
+            return
+        yield from sorted((row for row in build_worklist_index(arr)["rows"]
+                           if d_from <= row["date"] <= d_to and (not stations or row["station"] in stations)), key=key)
+        if len(arr) < EXPORT_PAGE:
+            return
+        offset += len(arr)
+
+def export_records(d_from: str, d_to: str, stations: set):
+    """Zapisi za izvoz; ob napaki arhiva med tokom doda vrstico z opozorilom."""
+    try:
+        for row in _export_rows(d_from, d_to, stations):
+            ds = row["ds"]
+            yield [_human_da(row["date"]), _human_tm(row["time"]), row["station"],
+                   _get_str(ds, "00100010").replace("^", " ").strip(), _get_str(ds, "00100020"),
+                   _human_da(_get_str(ds, "00100030")), _get_str(ds, "00080050"),
+                   _get_str(row["sps"], "00400007") or _get_str(ds, "00321060"),
+                   row["modality"], row["status"], row["spsid"]]
+    except (requests.RequestException, RuntimeError, ValueError) as e:
+        yield ["", "", "", f"IZVOZ PREKINJEN: {e}"] + [""] * (len(EXPORT_HEADER) - 4)
+
+def stream_csv(records):
+    buf = io.StringIO()
+    w = csv.writer(buf, delimiter=";", lineterminator="\r\n")
+    buf.write("\ufeff")            # BOM, da Excel prepozna UTF-8
+    w.writerow(EXPORT_HEADER)
+    for n, rec in enumerate(records, start=1):
+        w.writerow(rec)
+        if n % EXPORT_CSV_FLUSH == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+# Helvetica z WinAnsi kodiranjem nima Č/č/Ć/ć/đ; preslikamo jih na
+# nezasedene kode cp1252 in glife določimo v /Differences.
+_PDF_EXTRA = {"Č": (0x81, "Ccaron"), "č": (0x8D, "ccaron"), "Ć": (0x8F, "Cacute"),
+              "ć": (0x90, "cacute"), "Đ": (0xD0, "Eth"), "đ": (0x9D, "dcroat")}
+_PDF_CODES = {ch: bytes([code]) for ch, (code, _) in _PDF_EXTRA.items()}
+_PDF_FONT = ("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding << /Type /Encoding "
+             "/BaseEncoding /WinAnsiEncoding /Differences ["
+             + " ".join(f"{code} /{glyph}" for code, glyph in _PDF_EXTRA.values() if code != 0xD0)
+             + "] >> >>").encode("ascii")
+
+def _pdf_str(text: str, limit: int = 0) -> bytes:
+    if limit and len(text) > limit:
+        text = text[:limit - 1] + "…"
+    data = b"".join(_PDF_CODES.get(ch) or ch.encode("cp1252", "replace") for ch in text)
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+def _pdf_page(title: bytes, recs: list, page_no: int) -> bytes:
+    out = [b"BT /F1 12 Tf 1 0 0 1 30 560 Tm " + title + b" Tj /F1 8 Tf"]
+    y = 540
+    for col, x, _ in _PDF_COLS:
+        out.append(b"1 0 0 1 %d %d Tm %s Tj" % (x, y, _pdf_str(EXPORT_HEADER[col])))
+    for rec in recs:
+        y -= 12
+        for col, x, limit in _PDF_COLS:
+            if rec[col]:
+                out.append(b"1 0 0 1 %d %d Tm %s Tj" % (x, y, _pdf_str(rec[col], limit)))
+    out.append(b"1 0 0 1 770 20 Tm %s Tj ET" % _pdf_str(f"Stran {page_no}"))
+    out.append(b"0.6 G 0.5 w 30 534 m 812 534 l S")
+    return b"\n".join(out)
+
+def stream_pdf(title: str, records):
+    pos = 0
+    offsets = {}
+
+    def obj(num: int, body: bytes) -> bytes:
+        nonlocal pos
+        chunk = b"%d 0 obj\n%s\nendobj\n" % (num, body)
+        offsets[num] = pos
+        pos += len(chunk)
+        return chunk
+
+    head = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    pos = len(head)
+    yield head
+    yield obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    yield obj(3, _PDF_FONT)
+    title_b = _pdf_str(title)
+    kids, num, recs = [], 4, []
+
+    def page():
+        nonlocal num
+        content = _pdf_page(title_b, recs, len(kids) + 1)
+        chunks = [obj(num, b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)),
+                  obj(num + 1, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 842 595] "
+                               b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % num)]
+        kids.append(num + 1)
+        num += 2
+        return b"".join(chunks)
+
+    for rec in records:
+        recs.append(rec)
+        if len(recs) == EXPORT_PDF_ROWS:
+            yield page()
+            recs = []
+    if recs or not kids:
+        yield page()
+    yield obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids)))
+    xref = [b"xref\n0 %d\n0000000000 65535 f \n" % num]
+    xref += [b"%010d 00000 n \n" % offsets[i] for i in range(1, num)]
+    yield b"".join(xref) + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (num, pos)
+
+@app.get('/api/export')
+def api_export():
+    """
+    ?date=DD.MM.YYYY[&dateTo=...][&station=UZ1,UZ2][&format=csv|pdf]
+    Brez datuma velja današnji dan, brez postaje vse postaje.
+    """
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in ("csv", "pdf"):
+        return jsonify({"ok": False, "napaka": "format mora biti csv ali pdf."}), 400
+    d_from = to_da(request.args.get("date") or "") or datetime.now().strftime("%Y%m%d")
+    d_to = to_da(request.args.get("dateTo") or "") or d_from
+    if d_to < d_from:
+        d_from, d_to = d_to, d_from
+    stations = {x.strip() for x in (request.args.get("station") or "").split(",") if x.strip()}
+
+    span = _human_da(d_from) + ("" if d_to == d_from else " – " + _human_da(d_to))
+    where = ", ".join(sorted(stations)) or "vse postaje"
+    name = f"mwl_{d_from}" + ("" if d_to == d_from else f"-{d_to}") + \
+           ("_" + "_".join(sorted(stations)) if stations else "")
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    records = export_records(d_from, d_to, stations)
+    if fmt == "pdf":
+        resp = Response(stream_pdf(f"Delovna lista {span} ({where})", records), mimetype="application/pdf")
+        resp.headers["Content-Disposition"] = f"inline; filename={name}.pdf"
+    else:
+        resp = Response(stream_csv(records), mimetype="text/csv; charset=utf-8")
+        resp.headers["Content-Disposition"] = f"attachment; filename={name}.csv"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+# ---------- Paketni vpis ----------
+BATCH_WORKERS = 4   # hkratni zahtevki proti arhivu pri paketnem vpisu
+
+def _batch_post_entry(entry: dict, patient_ok: bool):
+    pid = entry["patientId"]
+    res = {"dodeljenID": pid, "dodeljenAccession": entry.get("accession", ""),
+           "schedDate": entry.get("schedDate", ""), "schedTime": entry.get("schedTime", "")}
+    if not patient_ok:
+        return {**res, "ok": False, "status": 400, "korak": "patient", "napaka": "Pacienta ni bilo mogoče ustvariti"}
+    try:
+        r = arc_post_dicom(f"/aets/{CFG['aet']}/rs/mwlitems", encode_dicom_mwl(entry, pid))
+    except requests.RequestException as e:
+        return {**res, "ok": False, "status": 502, "napaka": str(e)}
+    out = {**res, "ok": r.ok, "status": r.status_code}
+    if not r.ok:
+        out["odgovorPACS"] = r.text
+    return out
+
+def submit_mwl_batch(entries: list, source: str = "batch") -> list:
+    """
+    Vpiše več MWL elementov. Vsak element mora že imeti 'patientId' in
+    'accession' (ter polja, ki jih bere encode_dicom_mwl). Vsak pacient se
+    preveri/ustvari le enkrat (pri 'newPatient' brez QIDO poizvedbe),
+    MWL elementi se pošiljajo vzporedno.
+    """
+    if not entries:
+        return []
+    patients = {}
+    for e in entries:
+        patients.setdefault(e["patientId"], e)
+
+    def ensure(e):
+        try:
+            if e.get("newPatient"):
+                return rs_create_patient(e["patientId"], e.get("patientName") or "NEZNANO", e.get("birthDate_da")).ok
+            return ensure_patient_exists(e["patientId"], e.get("patientName") or "NEZNANO", e.get("birthDate_da"))
+        except requests.RequestException:
+            return False
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as ex:
+        patient_ok = dict(zip(patients, ex.map(ensure, patients.values())))
+        for pid, e in patients.items():
+            if patient_ok[pid]:
+                patient_index_add(pid, e.get("patientName") or "NEZNANO", e.get("birthDate_da") or "")
+        results = list(ex.map(lambda e: _batch_post_entry(e, patient_ok[e["patientId"]]), entries))
+
+    for e, res in zip(entries, results):
+        if e.get("stationAET"):
+            add_station_aet(e["stationAET"], used=True)
+        audit_log("import", actor=_audit_actor() or source, source=source, patientId=res["dodeljenID"],
+                  accession=res["dodeljenAccession"], patientName=e.get("patientName"),
+                  stationAET=e.get("stationAET"), schedDate=res["schedDate"], schedTime=res["schedTime"],
+                  ok=res["ok"], status=res["status"])
+    if any(r["ok"] for r in results):
+        request_worklist_refresh()
+    return results
+
+# ---------- Usklajevanje uvoza z delovno listo ----------
+# Posodobljen dnevni program (PDF/CSV) primerjamo z obstoječimi SPS za iste
+# dneve in postaje. Vrstice in SPS se zgostijo po (ime, rojstni datum, datum,
+# ura, postaja, opis); enake ostanejo, isti pacient z drugačnim terminom se
+# prestavi, ostalo se ustvari oz. izbriše. Brišemo/prestavljamo le SPS, ki
+# še niso začeti (SCHEDULED). Načrt ima ID; apply načrt izračuna znova in ga
+# izvede le, če se ujema s tistim, ki ga je uporabnik potrdil.
+RECONCILE_MUTABLE = {"", "SCHEDULED"}
+
+def _reconcile_import_rows(rows: list):
+    out, skipped = [], []
+    for i, r in enumerate(rows):
+        if not isinstance(r, dict):
+            continue
+        surname, given = (r.get("surname") or "").strip(), (r.get("given") or "").strip()
+        rec = {
+            "row": i,
+            "patientName": f"{surname}^{given}" if (surname or given) else "NEZNANO",
+            "name": normalize_name(f"{surname} {given}"),
+            "birth": to_da(r.get("birthDate") or ""),
+            "date": to_da(r.get("examDate") or ""),
+            "time": to_tm(r.get("examTime") or "")[:4],
+            "station": (r.get("station") or "").strip(),
+            "desc": normalize_name(r.get("desc") or ""),
+            "procDesc": (r.get("desc") or "").strip(),
+            "modality": (r.get("modality") or "US").strip().upper(),
+        }
+        if not rec["date"] or not rec["time"]:
+            skipped.append({"row": i, "napaka": "Neveljaven datum ali čas preiskave."})
+        else:
+            out.append(rec)
+    return out, skipped
+
+def _reconcile_existing(row: dict) -> dict:
+    ds = row["ds"]
+    return {
+        "studyuid": row["studyuid"], "spsid": row["spsid"], "ds": ds, "sps": row["sps"],
+        "patientId": _get_str(ds, "00100020"),
+        "patientName": _get_str(ds, "00100010"),
+        "name": normalize_name(_get_str(ds, "00100010")),
+        "birth": _get_str(ds, "00100030"),
+        "date": row["date"], "time": row["time"][:4], "station": row["station"],
+        "desc": normalize_name(_get_str(ds, "00321060")),
+        "procDesc": _get_str(ds, "00321060"),
+        "status": (row["status"] or "").upper(),
+    }
+
+def _slot_view(x: dict) -> dict:
+    return {"date": x["date"], "time": x["time"], "stationAET": x["station"], "procDesc": x["procDesc"]}
+
+def plan_import_reconcile(rows: list, stations, idx) -> dict:
+    """Načrt uskladitve: unchanged / create / reschedule / delete / skipped."""
+    imp, skipped = _reconcile_import_rows(rows)
+    dates = sorted({r["date"] for r in imp})
+    scope = set(stations or ()) or {r["station"] for r in imp if r["station"]}
+    existing = [_reconcile_existing(row) for d in dates for row in idx["by_date"].get(d, ())
+                if row["spsid"] and row["station"] in scope]
+
+    def full(x, station=True):
+        return (x["name"], x["birth"], x["date"], x["time"], x["station"] if station else "", x["desc"])
+
+    # 1) enake vrstice (vrstica brez postaje se ujema s katerokoli postajo v obsegu)
+    free = {}
+    for e in existing:
+        free.setdefault(full(e), []).append(e)
+        free.setdefault(full(e, False), []).append(e)
+    used, unchanged, rest = set(), 0, []
+    for r in imp:
+        bucket = free.get(full(r, bool(r["station"]))) or []
+        hit = next((e for e in bucket if id(e) not in used), None)
+        if hit is None:
+            rest.append(r)
+        else:
+            used.add(id(hit))
+            unchanged += 1
+
+    # 2) isti pacient, drug termin: prestavitev (najprej isti opis, nato isti dan)
+    by_person = {}
+    for e in existing:
+        if id(e) not in used and e["status"] in RECONCILE_MUTABLE:
+            by_person.setdefault((e["name"], e["birth"]), []).append(e)
+    reschedule, create = [], []
+    for r in rest:
+        cands = [e for e in by_person.get((r["name"], r["birth"]), ()) if id(e) not in used]
+        if cands:
+            e = max(cands, key=lambda e: (e["desc"] == r["desc"], e["date"] == r["date"],
+                                          -abs((_tm_minutes(e["time"]) or 0) - (_tm_minutes(r["time"]) or 0))))
+            used.add(id(e))
+            to = {**r, "station": r["station"] or e["station"]}
+            reschedule.append({"row": r["row"], "studyuid": e["studyuid"], "spsid": e["spsid"],
+                               "patientName": e["patientName"], "from": _slot_view(e), "to": _slot_view(to)})
+        elif not r["station"]:
+            skipped.append({"row": r["row"], "napaka": "Ni izbrane postaje (AE)."})
+        else:
+            same = next((e for e in existing if (e["name"], e["birth"]) == (r["name"], r["birth"])), None)
+            create.append({"row": r["row"], "patientName": r["patientName"], "birthDate_da": r["birth"],
+                           "patientId": same["patientId"] if same else "",
+                           "stationAET": r["station"], "schedDate": r["date"], "schedTime": r["time"] + "00",
+                           "procDesc": r["procDesc"], "modality": r["modality"]})
+
+    # 3) nezačeti SPS, ki jih v programu ni več
+    delete = [{"studyuid": e["studyuid"], "spsid": e["spsid"], "patientName": e["patientName"], **_slot_view(e)}
+              for e in existing if id(e) not in used and e["status"] in RECONCILE_MUTABLE]
+    plan = {"dates": dates, "stations": sorted(scope), "unchanged": unchanged,
+            "create": create, "reschedule": reschedule, "delete": delete,
+            "skipped": sorted(skipped, key=lambda x: x["row"]),
+            "locked": sum(1 for e in existing if id(e) not in used and e["status"] not in RECONCILE_MUTABLE)}
+    plan["planId"] = hashlib.sha1(json.dumps(
+        [create, reschedule, delete], sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    return plan
+
+def _reschedule_payload(row: dict, to: dict) -> dict:
+    ds = dict(row["ds"])
+    item = dict(row["sps"])
+    item["00400001"] = {"vr": "AE", "Value": [to["stationAET"]]}
+    item["00400002"] = {"vr": "DA", "Value": [to["date"]]}
+    item["00400003"] = {"vr": "TM", "Value": [to["time"] + "00"]}
+    if to["procDesc"]:
+        ds["00321060"] = {"vr": "LO", "Value": [to["procDesc"]]}
+    ds["00400100"] = {"vr": "SQ", "Value": [item]}
+    return ds
+
+def apply_import_reconcile(plan: dict, idx) -> dict:
+    """Izvede načrt: brisanja in prestavitve vzporedno, nato paketni vpis novih."""
+    def move(m):
+        row = idx["by_sps"].get(m["spsid"])
+        if row is None or row["studyuid"] != m["studyuid"]:
+            return m, _synthetic_response(404, "SPS ni več v delovni listi.")
+        try:
+            return m, arc_post_dicom(f"/aets/{CFG['aet']}/rs/mwlitems", _reschedule_payload(row, m["to"]))
+        except requests.RequestException as e:
+            return m, _synthetic_response(502, str(e))
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        deleting = ex.submit(delete_mwl_steps, [(d["studyuid"], d["spsid"]) for d in plan["delete"]], "reconcile")
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as movers:
+            moved = list(movers.map(move, plan["reschedule"]))
+        deleted, del_errors = deleting.result()
+
+    errors = [{"akcija": "delete", **e} for e in del_errors]
+    rescheduled = 0
+    for m, resp in moved:
+        audit_log("reschedule", studyuid=m["studyuid"], spsid=m["spsid"], patientName=m["patientName"],
+                  stationAET=m["to"]["stationAET"], schedDate=m["to"]["date"], schedTime=m["to"]["time"],
+                  ok=resp.ok, status=resp.status_code)
+        if resp.ok:
+            rescheduled += 1
+        else:
+            errors.append({"akcija": "reschedule", "spsid": m["spsid"], "status": resp.status_code,
+                           "body": resp.text[:200]})
+
+    entries = [dict(c) for c in plan["create"]]
+    new = [e for e in entries if not e["patientId"]]
+    for e, pid in zip(new, generate_unique_patient_ids(len(new))):
+        e["patientId"], e["newPatient"] = pid, True
+    for e, acc in zip(entries, allocate_accession_numbers(len(entries))):
+        e["accession"] = acc
+    results = submit_mwl_batch(entries, source="reconcile")
+    for e, res in zip(entries, results):
+        if not res["ok"]:
+            errors.append({"akcija": "create", "row": e["row"], "status": res["status"],
+                           "body": str(res.get("napaka") or res.get("odgovorPACS") or "")[:200]})
+    if rescheduled:
+        request_worklist_refresh()
+    return {"deleted": len(deleted), "rescheduled": rescheduled,
+            "created": sum(1 for r in results if r["ok"]), "errors": errors}
+
+def _reconcile_request():
+    data = request.get_json(silent=True) or {}
+    rows = data.get("rows") if isinstance(data.get("rows"), list) else []
+    stations = [str(s).strip() for s in (data.get("stations") or []) if str(s).strip()]
+    return data, rows, stations
+
+@app.post('/api/import/reconcile')
+def reconcile_plan():
+    """
+    Body JSON: {"rows": [vrstice uvoza], "stations": ["UZ1", "UZ2"]}
+    Vrne načrt (brez sprememb v arhivu); "planId" se poda v /apply.
+    """
+    _, rows, stations = _reconcile_request()
+    if not rows:
+        return jsonify({"ok": False, "napaka": "Ni uvoženih vrstic."}), 400
+    if refresh_worklist_cache() is None or worklist_index() is None:
+        return jsonify({"ok": False, "napaka": "Seznama MWL ni bilo mogoče prebrati iz arhiva."}), 502
+    plan = plan_import_reconcile(rows, stations, worklist_index())
+    if not plan["stations"]:
+        return jsonify({"ok": False, "napaka": "Ni izbranih postaj (AE)."}), 400
+    return jsonify({"ok": True, **plan})
+
+@app.post('/api/import/reconcile/apply')
+def reconcile_apply():
+    """Isti body kot /api/import/reconcile in "planId" potrjenega načrta."""
+    data, rows, stations = _reconcile_request()
+    if not rows:
+        return jsonify({"ok": False, "napaka": "Ni uvoženih vrstic."}), 400
+    if not archive_available():
+        return jsonify({"ok": False, "napaka": "Arhiv trenutno ni dosegljiv."}), 503
+    if refresh_worklist_cache() is None or worklist_index() is None:
+        return jsonify({"ok": False, "napaka": "Seznama MWL ni bilo mogoče prebrati iz arhiva."}), 502
+    idx = worklist_index()
+    plan = plan_import_reconcile(rows, stations, idx)
+    if not plan["stations"]:
+        return jsonify({"ok": False, "napaka": "Ni izbranih postaj (AE)."}), 400
+    if data.get("planId") != plan["planId"]:
+        # delovna lista se je med pregledom spremenila: pokažemo nov načrt
+        return jsonify({"ok": False, "napaka": "Delovna lista se je spremenila; preglej nov načrt.", **plan}), 409
+    res = apply_import_reconcile(plan, idx)
+    return jsonify({"ok": not res["errors"], "planId": plan["planId"], "unchanged": plan["unchanged"], **res}), \
+        (200 if not res["errors"] else 207)
+
+# ---------- Predloge urnika ----------
+# Predloga opiše ponavljajoče se termine, npr.
+#   {"name": "US_ROOM1 dopoldne", "stationAET": "US_ROOM1", "modality": "US",
+#    "procDesc": "Doppler karotid", "start": "08:00", "end": "14:00", "intervalMin": 20,
+#    "dateFrom": "03.11.2025", "dateTo": "07.11.2025", "weekdays": [1,2,3,4,5]}
+# Za kontrolne preglede istega pacienta: "everyDays": 7 in podatki pacienta
+# (patientSurname, patientGiven, patientId, birthDate).
+TEMPLATE_FILE = "schedule_templates.json"
+TEMPLATE_MAX_ENTRIES = 2000
+
+def load_schedule_templates():
+    data = _read_json_file(TEMPLATE_FILE, {"items": []})
+    return [t for t in data.get("items", []) if isinstance(t, dict) and t.get("name")]
+
+def save_schedule_template(tpl: dict):
+    items = [t for t in load_schedule_templates() if t["name"] != tpl["name"]]
+    items.append(tpl)
+    items.sort(key=lambda t: t["name"])
+    _write_json_file(TEMPLATE_FILE, {"items": items})
+    return items
+
+def delete_schedule_template(name: str):
+    items = [t for t in load_schedule_templates() if t["name"] != name]
+    _write_json_file(TEMPLATE_FILE, {"items": items})
+    return items
+
+def _template_int(tpl: dict, key: str, default: int) -> int:
+    value = tpl.get(key)
+    if value in (None, ""):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{key}' mora biti celo število.") from None
+
+def expand_schedule_template(tpl: dict) -> list:
+    """
+    Razširi predlogo v seznam vnosov za build_dicom_mwl (brez PID/ACC).
+    Vrže ValueError pri neveljavni predlogi.
+    """
+    d_from = to_da(tpl.get("dateFrom") or tpl.get("date") or "")
+    d_to = to_da(tpl.get("dateTo") or "") or d_from
+    if not d_from:
+        raise ValueError("Manjka 'dateFrom'.")
+    start = to_tm(tpl.get("start") or "")
+    if not start:
+        raise ValueError("Manjka ali neveljaven 'start'.")
+    end = to_tm(tpl.get("end") or "") or start
+    t0, t1 = _tm_minutes(start), _tm_minutes(end)
+    if t0 is None:
+        raise ValueError("Neveljaven 'start' (pričakovan HH:MM).")
+    if t1 is None:
+        raise ValueError("Neveljaven 'end' (pričakovan HH:MM).")
+    if t1 < t0:
+        raise ValueError("'end' je pred 'start'.")
+    interval = _template_int(tpl, "intervalMin", 0)
+    if interval < 0:
+        raise ValueError("'intervalMin' ne sme biti negativen.")
+    every_days = _template_int(tpl, "everyDays", 1)
+    if every_days < 1:
+        raise ValueError("'everyDays' mora biti vsaj 1.")
+    weekdays = tpl.get("weekdays")
+    if weekdays in (None, []):
+        weekdays = [1, 2, 3, 4, 5] if every_days == 1 else range(1, 8)
+    elif not isinstance(weekdays, list) or not all(
+            isinstance(d, int) and not isinstance(d, bool) and 1 <= d <= 7 for d in weekdays):
+        raise ValueError("'weekdays' mora biti seznam dni 1-7 (1 = ponedeljek).")
+    weekdays = set(weekdays)
+    try:
+        day = datetime.strptime(d_from, "%Y%m%d")
+        last = datetime.strptime(d_to, "%Y%m%d")
+    except ValueError:
+        raise ValueError("Neveljaven 'dateFrom' ali 'dateTo'.") from None
+
+    if interval > 0:
+        slots = [_minutes_tm(m) for m in range(t0, t1, interval)] or [start]
+    else:
+        slots = [start]
+
+    surname = (tpl.get("patientSurname") or "").strip()
+    given = (tpl.get("patientGiven") or "").strip()
+    pn = (tpl.get("patientName") or "").strip() or ((surname or given) and f"{surname}^{given}") or "NEZNANO"
+    base = {
+        "patientName": pn,
+        "birthDate_da": to_da(tpl.get("birthDate") or ""),
+        "stationAET": (tpl.get("stationAET") or "").strip(),
+        "modality": (tpl.get("modality") or "US").strip().upper(),
+        "procDesc": (tpl.get("procDesc") or "").strip(),
+    }
+
+    out = []
+    while day <= last:
+        if day.isoweekday() in weekdays:
+            da = day.strftime("%Y%m%d")
+            for tm in slots:
+                out.append({**base, "schedDate": da, "schedTime": tm})
+                if len(out) > TEMPLATE_MAX_ENTRIES:
+                    raise ValueError(f"Predloga ustvari več kot {TEMPLATE_MAX_ENTRIES} vnosov.")
+        day += timedelta(days=every_days)
+    return out
+
+def _template_from_request(data: dict):
+    if data.get("template"):
+        return data["template"] if isinstance(data["template"], dict) else None
+    name = (data.get("name") or "").strip()
+    for t in load_schedule_templates():
+        if t["name"] == name:
+            return t
+    return None
+
+@app.get('/api/templates')
+def get_templates():
+    return jsonify({"items": load_schedule_templates()})
+
+@app.post('/api/templates')
+def add_template():
+    tpl = request.json or {}
+    if not (tpl.get("name") or "").strip():
+        return jsonify({"ok": False, "napaka": "Manjka 'name'."}), 400
+    try:
+        expand_schedule_template(tpl)
+    except ValueError as e:
+        return jsonify({"ok": False, "napaka": str(e)}), 400
+    return jsonify({"ok": True, "items": save_schedule_template(tpl)})
+
+@app.delete('/api/templates/<name>')
+def remove_template(name):
+    return jsonify({"ok": True, "items": delete_schedule_template(name)})
+
+@app.post('/api/templates/preview')
+def preview_template():
+    """Razširitev predloge brez klicev na arhiv in brez porabe števcev."""
+    tpl = _template_from_request(request.json or {})
+    if tpl is None:
+        return jsonify({"ok": False, "napaka": "Predloga ne obstaja."}), 404
+    try:
+        entries = expand_schedule_template(tpl)
+    except ValueError as e:
+        return jsonify({"ok": False, "napaka": str(e)}), 400
+    return jsonify({"ok": True, "count": len(entries), "items": entries})
+
+@app.post('/api/templates/apply')
+def apply_template():
+    """
+    Vpiše vse termine predloge. Termini, ki se prekrivajo z obstoječimi ali
+    med seboj, vrnejo 409 s seznamom konfliktov (kot /api/slots/check),
+    razen z "ignoreConflict"; zasedeni termini se rezervirajo kot pri /api/create.
+    """
+    data = request.json or {}
+    tpl = _template_from_request(data)
+    if tpl is None:
+        return jsonify({"ok": False, "napaka": "Predloga ne obstaja."}), 404
+    try:
+        entries = expand_schedule_template(tpl)
+    except ValueError as e:
+        return jsonify({"ok": False, "napaka": str(e)}), 400
+    if not entries:
+        return jsonify({"ok": True, "count": 0, "results": []})
+
+    # --- Termini: preverimo pred dodelitvijo PID/ACC ---
+    ignore = bool(data.get("ignoreConflict"))
+    if not ignore:
+        conflicts = [{"schedDate": e["schedDate"], "schedTime": e["schedTime"], "stationAET": e["stationAET"], **r}
+                     for e, r in zip(entries, check_slots(entries)) if not r["ok"]]
+        if conflicts:
+            return jsonify({"ok": False, "napaka": f"Zasedenih terminov: {len(conflicts)}.",
+                            "konfliktov": len(conflicts), "konflikti": conflicts}), 409
+    reserved = []
+    for e, ref in zip(entries, allocate_sps_ids(len(entries))):
+        e["steps"] = [{"spsId": ref}]       # SPS ID je tudi oznaka rezervacije termina
+        slot = reserve_slot(e["stationAET"], e["schedDate"], e["schedTime"], ref, force=ignore)
+        reserved.append((e["stationAET"], e["schedDate"], e["schedTime"], ref))
+        if slot is not None and not slot["ok"] and not ignore:
+            # vzporedni vpis je termin zasedel med preverjanjem in rezervacijo
+            for args in reserved:
+                release_slot(*args)
+            return jsonify({"ok": False, "napaka": f"Termin na postaji {e['stationAET']} je že zaseden.",
+                            "konfliktov": 1, "konflikti": [{"schedDate": e["schedDate"], "schedTime": e["schedTime"],
+                                                            "stationAET": e["stationAET"], **slot}]}), 409
+
+    # PID: ena za cel niz kontrol istega pacienta, sicer blok novih
+    fixed_pid = (tpl.get("patientId") or "").strip()
+    new_patients = not fixed_pid
+    if fixed_pid or tpl.get("patientSurname") or tpl.get("patientName"):
+        pids = [fixed_pid or generate_unique_patient_id()] * len(entries)
+    else:
+        pids = generate_unique_patient_ids(len(entries))
+    accs = allocate_accession_numbers(len(entries))
+    for e, pid, acc in zip(entries, pids, accs):
+        e["patientId"] = pid
+        e["accession"] = acc
+        e["newPatient"] = new_patients
+
+    results = submit_mwl_batch(entries, source="template")
+    for args, r in zip(reserved, results):
+        if not r["ok"]:
+            release_slot(*args)
+    ok = all(r["ok"] for r in results)
+    return jsonify({"ok": ok, "count": len(results), "results": results}), (200 if ok else 207)
+
+# ---------- HL7 ORM (MLLP) ----------
+# Neobvezen MLLP poslušalec za naročila ORM^O01 iz RIS/HIS. Sporočilo se
+# razčleni, potrdi (ACK) takoj, vpis v arhiv pa poteka paketno v ozadju.
+# Ker pošiljatelj po AA ne pošlje znova, neuspel vpis (arhiv nedosegljiv)
+# ponavljamo z naraščajočim zamikom; trajno neuspela naročila se zapišejo v
+# HL7_DEAD_LETTER_FILE in so vidna na /api/hl7/failed.
+# Vklop s HL7_PORT (npr. 2575).
+HL7_QUEUE_MAX = int(os.environ.get("HL7_QUEUE_MAX", "1000"))      # omejitev pomnilnika
+HL7_BATCH_MAX = int(os.environ.get("HL7_BATCH_MAX", "50"))
+HL7_BATCH_WAIT = float(os.environ.get("HL7_BATCH_WAIT", "0.5"))   # s, zbiranje paketa
+HL7_DEFAULT_STATION = os.environ.get("HL7_DEFAULT_STATION", "")
+HL7_MAX_FRAME = 1024 * 1024
+HL7_MAX_ATTEMPTS = max(1, int(os.environ.get("HL7_MAX_ATTEMPTS", "6")))
+HL7_RETRY_BASE = float(os.environ.get("HL7_RETRY_BASE", "5"))     # s, podvoji se ob vsakem poskusu
+HL7_RETRY_MAX = 600.0
+HL7_DEAD_LETTER_FILE = "hl7_failed.jsonl"
+
+MLLP_START, MLLP_END = b"\x0b", b"\x1c\x0d"
+
+_hl7_queue = queue.Queue(maxsize=HL7_QUEUE_MAX)
+_hl7_retry = []            # kopica (rok, zaporedna št., naročilo) za ponovni vpis
+HL7_STATS = {"received": 0, "queued": 0, "rejected": 0, "ignored": 0, "submitted": 0,
+             "retried": 0, "failed": 0}
+_HL7_STATS_LOCK = threading.Lock()
+
+def _hl7_count(key, n=1):
+    with _HL7_STATS_LOCK:
+        HL7_STATS[key] += n
+
+def parse_hl7(text: str) -> dict:
+    """Sporočilo -> {"MSH": [polja], "PID": [...], ...} (prva pojavitev segmenta)."""
+    segs = {}
+    for ln in re.split(r"[\r\n]+", text):
+        if len(ln) < 3:
+            continue
+        name = ln[:3]
+        if name == "MSH":
+            sep = ln[3:4] or "|"
+            fields = ["MSH", sep] + ln[4:].split(sep)   # MSH-n = fields[n]
+        else:
+            fields = ln.split(segs["MSH"][1] if "MSH" in segs else "|")
+        segs.setdefault(name, fields)
+    if "MSH" not in segs:
+        raise ValueError("Manjka segment MSH.")
+    return segs
+
+def _hl7_field(segs, seg, n, comp=1):
+    fields = segs.get(seg) or []
+    if n >= len(fields):
+        return ""
+    enc = (segs["MSH"][2] if len(segs["MSH"]) > 2 else "^~\\&")
+    comp_sep, rep_sep = enc[0:1] or "^", enc[1:2] or "~"
+    val = fields[n].split(rep_sep)[0]
+    parts = val.split(comp_sep)
+    return parts[comp - 1].strip() if comp - 1 < len(parts) else ""
+
+def hl7_orm_to_form(segs) -> dict:
+    """ORM^O01 -> slovar, ki ga bere build_dicom_mwl (kot pri /api/create)."""
+    surname = _hl7_field(segs, "PID", 5, 1)
+    given = _hl7_field(segs, "PID", 5, 2)
+    sched = (_hl7_field(segs, "TQ1", 7) or _hl7_field(segs, "OBR", 27, 4) or
+             _hl7_field(segs, "ORC", 7, 4) or _hl7_field(segs, "OBR", 36) or _hl7_field(segs, "OBR", 7))
+    digits = re.sub(r"\D", "", sched)
+    return {
+        "patientId": _hl7_field(segs, "PID", 3),
+        "patientName": ((surname or given) and f"{surname}^{given}") or "NEZNANO",
+        "birthDate_da": re.sub(r"\D", "", _hl7_field(segs, "PID", 7))[:8],
+        "accession": _hl7_field(segs, "OBR", 18) or _hl7_field(segs, "ORC", 2) or _hl7_field(segs, "OBR", 2),
+        "procDesc": _hl7_field(segs, "OBR", 4, 2) or _hl7_field(segs, "OBR", 4, 1),
+        "modality": _hl7_field(segs, "OBR", 24) or "US",
+        "schedDate": digits[:8],
+        "schedTime": (digits[8:14] + "0000")[:6] if len(digits) >= 12 else "",
+        "stationAET": _hl7_field(segs, "OBR", 21) or HL7_DEFAULT_STATION,
+    }
+
+def hl7_ack(segs, code: str, text: str = "") -> str:
+    msh = segs.get("MSH") or ["MSH", "|", "^~\\&"]
+    fld = lambda n: msh[n] if n < len(msh) else ""
+    enc = fld(2) or "^~\\&"
+    ts = datetime.now().strftime("%Y%m%d%H%M%S")
+    ctrl = fld(10)
+    ack = [
+        f"MSH|{enc}|{fld(5)}|{fld(6)}|{fld(3)}|{fld(4)}|{ts}||ACK^O01|ACK{ctrl}|P|{fld(12) or '2.5'}",
+        f"MSA|{code}|{ctrl}" + (f"|{text}" if text else ""),
+    ]
+    return "\r".join(ack) + "\r"
+
+def handle_hl7_message(raw: bytes) -> bytes:
+    """Razčleni, uvrsti v vrsto in vrne ACK (AA/AE/AR)."""
+    _hl7_count("received")
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = raw.decode("cp1250", errors="replace")
+    try:
+        segs = parse_hl7(text)
+    except ValueError as e:
+        return hl7_ack({}, "AE", str(e)).encode("utf-8")
+    msg_type = _hl7_field(segs, "MSH", 9, 1)
+    order_ctl = _hl7_field(segs, "ORC", 1)
+    if msg_type != "ORM" or (order_ctl and order_ctl != "NW"):
+        _hl7_count("ignored")
+        return hl7_ack(segs, "AA", "Sporočilo ni obdelano (podprt je samo ORM NW).").encode("utf-8")
+    try:
+        _hl7_queue.put(hl7_orm_to_form(segs), timeout=2.0)
+    except queue.Full:
+        _hl7_count("rejected")
+        return hl7_ack(segs, "AR", "Vrsta je polna, poskusi znova.").encode("utf-8")
+    _hl7_count("queued")
+    return hl7_ack(segs, "AA").encode("utf-8")
+
+class _MLLPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        buf = b""
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return
+            buf += chunk
+            while True:
+                end = buf.find(MLLP_END)
+                if end < 0:
+                    break
+                start = buf.find(MLLP_START)
+                frame = buf[start + 1:end] if 0 <= start < end else buf[:end]
+                buf = buf[end + len(MLLP_END):]
+                self.request.sendall(MLLP_START + handle_hl7_message(frame) + MLLP_END)
+            if len(buf) > HL7_MAX_FRAME:
+                return
+
+class _MLLPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def _hl7_assign_ids(forms):
+    missing_pid = [f for f in forms if not f["patientId"]]
+    for f, pid in zip(missing_pid, generate_unique_patient_ids(len(missing_pid))):
+        f["patientId"] = pid
+        f["newPatient"] = True
+    missing_acc = [f for f in forms if not f["accession"]]
+    for f, acc in zip(missing_acc, allocate_accession_numbers(len(missing_acc))):
+        f["accession"] = acc
+
+def _hl7_retryable(res: dict) -> bool:
+    # napake arhiva (nedosegljiv, preobremenjen) so prehodne, napake podatkov ne;
+    # neuspelega koraka pacienta ne ločimo, zato ga ponovimo (omejeno s HL7_MAX_ATTEMPTS)
+    return (res["status"] in (0, 408, 429) or res["status"] >= 500 or res.get("korak") == "patient"
+            or not archive_available())
+
+def _hl7_dead_letter(form: dict, res: dict):
+    rec = {"ts": datetime.now().isoformat(timespec="seconds"), "attempts": form.get("_attempts", 1),
+           "status": res.get("status"), "napaka": str(res.get("napaka") or res.get("odgovorPACS") or "")[:500],
+           "order": {k: v for k, v in form.items() if not k.startswith("_")}}
+    try:
+        with open(HL7_DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+    _hl7_count("failed")
+
+def process_hl7_batch(batch: list):
+    """Vpiše paket naročil; prehodno neuspela se vrnejo v vrsto ponovitev."""
+    try:
+        _hl7_assign_ids(batch)
+        results = submit_mwl_batch(batch, source="hl7")
+    except Exception as e:
+        results = [{"ok": False, "status": 0, "napaka": str(e)}] * len(batch)
+    transient = [not res["ok"] and _hl7_retryable(res) for res in results]
+    now = time.monotonic()
+    with _HL7_STATS_LOCK:
+        for form, res, retry in zip(batch, results, transient):
+            if res["ok"]:
+                HL7_STATS["submitted"] += 1
+                continue
+            attempts = form.get("_attempts", 1)
+            if attempts < HL7_MAX_ATTEMPTS and retry:
+                form["_attempts"] = attempts + 1
+                form["newPatient"] = False   # pacient je morda že nastal: preveri s QIDO
+                delay = min(HL7_RETRY_MAX, HL7_RETRY_BASE * 2 ** (attempts - 1))
+                heapq.heappush(_hl7_retry, (now + delay, id(form), form))
+                HL7_STATS["retried"] += 1
+            else:
+                form["_attempts"] = attempts
+                form["_result"] = res
+    for form in batch:
+        if "_result" in form:
+            _hl7_dead_letter(form, form.pop("_result"))
+
+def _hl7_due_retries(limit: int) -> list:
+    now = time.monotonic()
+    out = []
+    with _HL7_STATS_LOCK:
+        while _hl7_retry and _hl7_retry[0][0] <= now and len(out) < limit:
+            out.append(heapq.heappop(_hl7_retry)[2])
+    return out
+
+def _hl7_retry_wait():
+    with _HL7_STATS_LOCK:
+        return max(0.0, _hl7_retry[0][0] - time.monotonic()) if _hl7_retry else None
+
+def _hl7_worker():
+    while True:
+        batch = _hl7_due_retries(HL7_BATCH_MAX)
+        queued = 0
+        if not batch:
+            try:
+                batch.append(_hl7_queue.get(timeout=_hl7_retry_wait()))
+                queued = 1
+            except queue.Empty:
+                continue
+        deadline = time.monotonic() + HL7_BATCH_WAIT
+        while len(batch) < HL7_BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(_hl7_queue.get(timeout=left))
+                queued += 1
+            except queue.Empty:
+                break
+        try:
+            process_hl7_batch(batch)
+        finally:
+            for _ in range(queued):
+                _hl7_queue.task_done()
+
+def read_hl7_dead_letters(limit: int = 200) -> list:
+    try:
+        with open(HL7_DEAD_LETTER_FILE, "r", encoding="utf-8") as f:
+            lines = deque(f, maxlen=limit)
+    except OSError:
+        return []
+    out = []
+    for ln in lines:
+        try:
+            out.append(json.loads(ln))
+        except ValueError:
+            continue
+    return out[::-1]
+
+def start_hl7_listener(port: int, host: str = "0.0.0.0"):
+    server = _MLLPServer((host, port), _MLLPHandler)
+    threading.Thread(target=server.serve_forever, name="hl7-mllp", daemon=True).start()
+    threading.Thread(target=_hl7_worker, name="hl7-batch", daemon=True).start()
+    return server
+
+@app.get('/api/hl7/status')
+def hl7_status():
+    with _HL7_STATS_LOCK:
+        stats = dict(HL7_STATS)
+        retrying = len(_hl7_retry)
+    return jsonify({**stats, "inQueue": _hl7_queue.qsize(), "queueMax": HL7_QUEUE_MAX, "retrying": retrying})
+
+@app.get('/api/hl7/failed')
+def hl7_failed():
+    """Trajno neuspela naročila (najnovejša najprej), za ročni vpis."""
+    try:
+        limit = max(1, min(1000, int(request.args.get("limit") or 200)))
+    except ValueError:
+        limit = 200
+    items = read_hl7_dead_letters(limit)
+    return jsonify({"count": len(items), "items": items})
+
+# ---------- Stanje SPS (MPPS / REST) ----------
+# Napredek postopka (MPPS N-CREATE/N-SET ali POST /api/status) takoj posodobi
+# lokalno kopijo; zapis v arhiv (ponovni POST MWL elementa s 00400020) poteka
+# paketno v ozadju, zadnje stanje posameznega SPS prevlada.
+STATUS_FLUSH_SECONDS = float(os.environ.get("STATUS_FLUSH_SECONDS", "2"))
+STATUS_MAX_ATTEMPTS = 3
+
+SPS_STATUSES = {"SCHEDULED", "ARRIVED", "READY", "STARTED", "DEPARTED", "COMPLETED", "DISCONTINUED", "CANCELED"}
+MPPS_TO_SPS = {"IN PROGRESS": "STARTED", "COMPLETED": "COMPLETED", "DISCONTINUED": "DISCONTINUED"}
+
+_status_pending = {}       # spsid -> (studyuid, status, poskusi)
+_STATUS_LOCK = threading.Lock()
+_status_event = threading.Event()
+_status_worker = None
+STATUS_STATS = {"received": 0, "applied": 0, "failed": 0, "unknown": 0}
+
+def normalize_sps_status(value) -> str:
+    v = str(value or "").strip().upper().replace("_", " ")
+    v = MPPS_TO_SPS.get(v, v)
+    return v if v in SPS_STATUSES else ""
+
+def ingest_sps_status(updates) -> int:
+    """updates: [(studyuid, spsid, status)]; vrne število sprejetih posodobitev."""
+    wanted = {}
+    for studyuid, spsid, status in updates:
+        st = normalize_sps_status(status)
+        if spsid and st:
+            wanted[spsid] = (studyuid or "", st)
+    if not wanted:
+        return 0
+
+    patch_worklist_status({spsid: st for spsid, (_, st) in wanted.items()})
+    with _STATUS_LOCK:
+        STATUS_STATS["received"] += len(wanted)
+        for spsid, (studyuid, st) in wanted.items():
+            _status_pending[spsid] = (studyuid, st, 0)
+    _ensure_status_worker()
+    _status_event.set()
+    return len(wanted)
+
+def _status_payload(row, status):
+    ds = dict(row["ds"])
+    item = dict(row["sps"])
+    item["00400020"] = {"vr": "CS", "Value": [status]}
+    ds["00400100"] = {"vr": "SQ", "Value": [item]}
+    return ds
+
+def flush_status_updates():
+    with _STATUS_LOCK:
+        batch = dict(_status_pending)
+        _status_pending.clear()
+    if not batch:
+        return
+    idx = worklist_index() or {"by_sps": {}}
+    tasks, retry = [], {}
+    for spsid, (studyuid, st, attempts) in batch.items():
+        row = idx["by_sps"].get(spsid)
+        if row is None or (studyuid and row["studyuid"] != studyuid):
+            retry[spsid] = (studyuid, st, attempts + 1)
+        else:
+            tasks.append((spsid, row, st, attempts))
+
+    def post(task):
+        spsid, row, st, _ = task
+        try:
+            r = arc_post_dicom(f"/aets/{CFG['aet']}/rs/mwlitems", _status_payload(row, st))
+            return r.ok
+        except requests.RequestException:
+            return False
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as ex:
+        results = list(ex.map(post, tasks))
+
+    with _STATUS_LOCK:
+        for (spsid, row, st, attempts), ok in zip(tasks, results):
+            if ok:
+                STATUS_STATS["applied"] += 1
+            elif attempts + 1 < STATUS_MAX_ATTEMPTS:
+                retry[spsid] = (row["studyuid"], st, attempts + 1)
+            else:
+                STATUS_STATS["failed"] += 1
+        for spsid, val in retry.items():
+            if val[2] >= STATUS_MAX_ATTEMPTS:
+                STATUS_STATS["unknown"] += 1
+            else:
+                _status_pending.setdefault(spsid, val)   # novejše stanje ima prednost
+    if retry:
+        request_worklist_refresh()   # neznan SPS je morda samo nov v arhivu
+
+def _status_loop():
+    while True:
+        _status_event.wait(STATUS_FLUSH_SECONDS)
+        _status_event.clear()
+        time.sleep(0.2)   # zberi še sočasne posodobitve v isti paket
+        try:
+            flush_status_updates()
+        except Exception:
+            pass
+
+def _ensure_status_worker():
+    global _status_worker
+    with _STATUS_LOCK:
+        if _status_worker is None:
+            _status_worker = threading.Thread(target=_status_loop, name="sps-status", daemon=True)
+            _status_worker.start()
+
+@app.post('/api/status')
+def post_status():
+    """
+    Body JSON:
+      {"spsid": "...", "studyuid": "...", "status": "COMPLETED"}
+      ali {"items": [ ... ]}; sprejme tudi MPPS stanja (IN PROGRESS, ...).
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("items") if isinstance(data.get("items"), list) else [data]
+    updates = [((it.get("studyuid") or ""), (it.get("spsid") or "").strip(), it.get("status"))
+               for it in items if isinstance(it, dict)]
+    n = ingest_sps_status(updates)
+    if not n:
+        return jsonify({"ok": False, "napaka": "Ni veljavnih posodobitev (spsid + status)."}), 400
+    return jsonify({"ok": True, "accepted": n})
+
+@app.get('/api/status')
+def get_status_stats():
+    with _STATUS_LOCK:
+        return jsonify({**STATUS_STATS, "pending": len(_status_pending)})
+
+# ---------- Čiščenje starih MWL elementov ----------
+# Periodično brisanje elementov, katerih načrtovani datum (00400002) je starejši
+# od RETENTION_DAYS. Arhiv vprašamo samo po starih elementih (datumski obseg,
+# po straneh), brišemo vzporedno in med delovnim časom ambulante upočasnjeno.
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "0") or 0)        # 0 = izklopljeno
+RETENTION_INTERVAL_HOURS = float(os.environ.get("RETENTION_INTERVAL_HOURS", "6"))
+RETENTION_WORKERS = int(os.environ.get("RETENTION_WORKERS", "2"))
+RETENTION_CLINIC_HOURS = os.environ.get("RETENTION_CLINIC_HOURS", "07:00-15:00")
+RETENTION_CLINIC_RPS = float(os.environ.get("RETENTION_CLINIC_RPS", "2"))   # brisanj/s med delovnim časom
+RETENTION_PAGE = 500
+RETENTION_REPORT_MAX = 200
+
+RETENTION_STATE = {"running": False, "lastRun": "", "cutoff": "", "found": 0,
+                   "deletedCount": 0, "deleted": [], "errors": [], "dryRun": False}
+_RETENTION_LOCK = threading.Lock()
+
+class _RateLimiter:
+    """Največ `rps` dovoljenj na sekundo (0 = brez omejitve)."""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next, now)
+            self.next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+def _in_clinic_hours(now=None) -> bool:
+    m = re.match(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$", RETENTION_CLINIC_HOURS or "")
+    if not m:
+        return False
+    now = now or datetime.now()
+    h1, m1, h2, m2 = map(int, m.groups())
+    cur = now.hour * 60 + now.minute
+    return h1 * 60 + m1 <= cur < h2 * 60 + m2
+
+def find_stale_mwl_items(cutoff_da: str):
+    """(studyuid, spsid, datum) za SPS z datumom do vključno cutoff_da, po straneh."""
+    out, offset = [], 0
+    while True:
+        path = (f"/aets/{CFG['aet']}/rs/mwlitems?00400100.00400002=-{cutoff_da}"
+                f"&limit={RETENTION_PAGE}&offset={offset}")
+        r = arc_get(path, {"Accept": "application/dicom+json"})
+        if not r.ok:
+            raise RuntimeError(f"PACS {r.status_code}: {r.text[:200]}")
+        arr = r.json() if r.content.strip() else []
+        if not isinstance(arr, list) or not arr:
+            break
+        for ds in arr:
+            studyuid = _get_str(ds, "0020000D")
+            for item in ((ds or {}).get("00400100") or {}).get("Value") or []:
+                spsid, da = _get_str(item, "00400009"), _get_str(item, "00400002")
+                if studyuid and spsid and da and da <= cutoff_da:
+                    out.append((studyuid, spsid, da))
+        if len(arr) < RETENTION_PAGE:
+            break
+        offset += len(arr)
+    return out
+
+def run_retention(days: int, dry_run: bool = False) -> dict:
+    with _RETENTION_LOCK:
+        if RETENTION_STATE["running"]:
+            return dict(RETENTION_STATE)
+        RETENTION_STATE["running"] = True
+    return _retention_pass(days, dry_run)
+
+def _retention_pass(days: int, dry_run: bool) -> dict:
+    # klicatelj je že nastavil RETENTION_STATE["running"] pod _RETENTION_LOCK
+    try:
+        cutoff = (datetime.now() - timedelta(days=days + 1)).strftime("%Y%m%d")
+        report = {"lastRun": datetime.now().isoformat(timespec="seconds"), "cutoff": cutoff,
+                  "found": 0, "deletedCount": 0, "deleted": [], "errors": [], "dryRun": dry_run}
+        try:
+            targets = find_stale_mwl_items(cutoff)
+        except Exception as e:
+            report["errors"].append({"napaka": str(e)})
+            targets = []
+        report["found"] = len(targets)
+        if dry_run:
+            report["deleted"] = [{"studyuid": u, "spsid": s, "date": d} for u, s, d in targets[:RETENTION_REPORT_MAX]]
+        elif targets:
+            limiter = _RateLimiter(RETENTION_CLINIC_RPS)
+
+            def delete(t):
+                if _in_clinic_hours():
+                    limiter.wait()
+                try:
+                    return t, delete_mwl_by_uid_and_sps(t[0], t[1])
+                except requests.RequestException as e:
+                    return t, e
+
+            idx = worklist_index()
+            with ThreadPoolExecutor(max_workers=max(1, RETENTION_WORKERS)) as ex:
+                for (studyuid, spsid, da), resp in ex.map(delete, targets):
+                    if not isinstance(resp, Exception):
+                        _audit_delete("retention", studyuid, spsid, resp, idx)
+                    if isinstance(resp, Exception) or not resp.ok:
+                        if len(report["errors"]) < RETENTION_REPORT_MAX:
+                            report["errors"].append({"studyuid": studyuid, "spsid": spsid,
+                                                     "status": getattr(resp, "status_code", 0),
+                                                     "body": getattr(resp, "text", str(resp))[:200]})
+                        continue
+                    report["deletedCount"] += 1
+                    stats_record_delete([(studyuid, spsid)])
+                    if len(report["deleted"]) < RETENTION_REPORT_MAX:
+                        report["deleted"].append({"studyuid": studyuid, "spsid": spsid, "date": da})
+            if report["deletedCount"]:
+                request_worklist_refresh()
+        with _RETENTION_LOCK:
+            RETENTION_STATE.update(report)
+        return report
+    finally:
+        with _RETENTION_LOCK:
+            RETENTION_STATE["running"] = False
+
+def _retention_loop():
+    while True:
+        try:
+            run_retention(RETENTION_DAYS)
+        except Exception:
+            pass
+        time.sleep(max(60.0, RETENTION_INTERVAL_HOURS * 3600))
+
+def start_retention_worker():
+    t = threading.Thread(target=_retention_loop, name="retention", daemon=True)
+    t.start()
+    return t
+
+@app.get('/api/retention')
+def get_retention():
+    with _RETENTION_LOCK:
+        return jsonify({**RETENTION_STATE, "days": RETENTION_DAYS})
+
+@app.post('/api/retention/run')
+def post_retention_run():
+    """
+    Body JSON (neobvezno): {"days": 30, "dryRun": true}
+    Čiščenje teče v ozadju (202); stanje in poročilo vrne GET /api/retention.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        days = int(data.get("days") or RETENTION_DAYS)
+    except (TypeError, ValueError):
+        days = 0
+    if days <= 0:
+        return jsonify({"ok": False, "napaka": "Manjka ali neveljaven 'days'."}), 400
+    with _RETENTION_LOCK:
+        if RETENTION_STATE["running"]:
+            return jsonify({"ok": False, "napaka": "Čiščenje že teče."}), 409
+        RETENTION_STATE["running"] = True
+    dry_run = bool(data.get("dryRun"))
+    threading.Thread(target=_retention_pass, args=(days, dry_run), name="retention-run", daemon=True).start()
+    # potek in poročilo: GET /api/retention
+    return jsonify({"ok": True, "running": True, "days": days, "dryRun": dry_run}), 202
+
+# ---------- MWL SCP (C-FIND) ----------
+# Neobvezen DICOM MWL strežnik: modalitete poizvedujejo lokalno kopijo delovne
+# liste namesto arhiva; isti AE sprejema tudi MPPS (N-CREATE/N-SET).
+# Vklop z MWL_SCP_PORT (npr. 11112), AET z MWL_SCP_AET.
+# Preizkus: findscu -W -k ScheduledProcedureStepSequence[0].ScheduledStationAETitle=UZ1 127.0.0.1 11112
+MWL_SCP_AET = os.environ.get("MWL_SCP_AET", "MWL_APP")
+
+def _dicom_wildcard_match(pattern: str, value: str) -> bool:
+    if not pattern or pattern == "*":
+        return True
+    if "*" in pattern or "?" in pattern:
+        return fnmatch.fnmatchcase(value.upper(), pattern.upper())
+    return value == pattern
+
+def _date_bounds(query: str):
+    """DA ujemanje: 'YYYYMMDD', 'A-B', '-B' ali 'A-' -> (od, do)."""
+    q = (query or "").strip()
+    if not q:
+        return None
+    if "-" in q:
+        lo, hi = q.split("-", 1)
+        return (lo.strip() or "00000000", hi.strip() or "99999999")
+    return (q, q)
+
+def find_worklist_rows(station="", date="", modality="", patient_id="", accession="", patient_name=""):
+    """Ujemanje vrstic lokalne kopije po ključih MWL poizvedbe."""
+    idx = worklist_index()
+    if not idx:
+        return []
+    bounds = _date_bounds(date)
+    if station and "*" not in station and "?" not in station:
+        cand = idx["by_station"].get(station, [])
+    elif bounds:
+        lo = bisect.bisect_left(idx["dates"], bounds[0])
+        hi = bisect.bisect_right(idx["dates"], bounds[1])
+        cand = [row for d in idx["dates"][lo:hi] for row in idx["by_date"][d]]
+    else:
+        cand = idx["rows"]
+    out = []
+    for row in cand:
+        if bounds and not (bounds[0] <= row["date"] <= bounds[1]):
+            continue
+        if not _dicom_wildcard_match(station, row["station"]):
+            continue
+        if modality and not _dicom_wildcard_match(modality, row["modality"]):
+            continue
+        if patient_id and not _dicom_wildcard_match(patient_id, _get_str(row["ds"], "00100020")):
+            continue
+        if accession and not _dicom_wildcard_match(accession, _get_str(row["ds"], "00080050")):
+            continue
+        if patient_name and not _dicom_wildcard_match(patient_name, _get_str(row["ds"], "00100010")):
+            continue
+        out.append(row)
+    return out
+
+def _row_to_dataset(row):
+    """DICOM JSON vrstice -> pydicom Dataset z enim SPS elementom (shrani se v vrstico)."""
+    cached = row.get("_pydicom")
+    if cached is None:
+        from pydicom.dataset import Dataset
+        ds_json = {k: v for k, v in row["ds"].items() if k != "00400100"}
+        ds_json["00400100"] = {"vr": "SQ", "Value": [row["sps"]]}
+        cached = row["_pydicom"] = Dataset.from_json(ds_json)
+    return cached
+
+def _empty_element(elem):
+    # zahtevan ključ, ki ga element nima: prazna vrednost, ne vrednost iz poizvedbe
+    from pydicom.dataelem import DataElement
+    return DataElement(elem.tag, elem.VR, [] if elem.VR == "SQ" else None)
+
+def _mwl_response(identifier, row):
+    """Odgovor vsebuje samo ključe, ki jih je SCU zahteval (manjkajoči so prazni)."""
+    from pydicom.dataset import Dataset
+    full = _row_to_dataset(row)
+    rsp = Dataset()
+    for elem in identifier:
+        if elem.tag == 0x00400100 and "ScheduledProcedureStepSequence" in full:
+            req_items = elem.value or []
+            src = full.ScheduledProcedureStepSequence[0]
+            if not req_items:
+                rsp.ScheduledProcedureStepSequence = [src]
+                continue
+            item = Dataset()
+            for sub in req_items[0]:
+                item.add(src[sub.tag] if sub.tag in src else _empty_element(sub))
+            rsp.ScheduledProcedureStepSequence = [item]
+        elif elem.tag in full:
+            rsp.add(full[elem.tag])
+        else:
+            rsp.add(_empty_element(elem))
+    return rsp
+
+def _handle_mwl_find(event):
+    ident = event.identifier
+    sps = None
+    if "ScheduledProcedureStepSequence" in ident and ident.ScheduledProcedureStepSequence:
+        sps = ident.ScheduledProcedureStepSequence[0]
+
+    def key(ds, name):
+        v = ds.get(name, "") if ds is not None else ""
+        return str(v or "").strip()
+
+    rows = find_worklist_rows(
+        station=key(sps, "ScheduledStationAETitle"),
+        date=key(sps, "ScheduledProcedureStepStartDate"),
+        modality=key(sps, "Modality"),
+        patient_id=key(ident, "PatientID"),
+        accession=key(ident, "AccessionNumber"),
+        patient_name=key(ident, "PatientName"),
+    )
+    for row in rows:
+        if event.is_cancelled:
+            yield (0xFE00, None)
+            return
+        yield (0xFF00, _mwl_response(ident, row))
+
+# MPPS SOP Instance UID -> [(studyuid, spsid)], da N-SET ve, na kaj se nanaša
+MPPS_MAX_INSTANCES = 5000
+_mpps_refs = OrderedDict()
+_MPPS_LOCK = threading.Lock()
+
+def _handle_mpps_create(event):
+    uid = event.request.AffectedSOPInstanceUID
+    if not uid:
+        return 0x0106, None
+    ds = event.attribute_list
+    refs = []
+    for item in ds.get("ScheduledStepAttributesSequence", None) or []:
+        spsid = str(item.get("ScheduledProcedureStepID", "") or "")
+        if spsid:
+            refs.append((str(item.get("StudyInstanceUID", "") or ""), spsid))
+    with _MPPS_LOCK:
+        _mpps_refs[str(uid)] = refs
+        while len(_mpps_refs) > MPPS_MAX_INSTANCES:
+            _mpps_refs.popitem(last=False)
+    status = ds.get("PerformedProcedureStepStatus", "IN PROGRESS")
+    ingest_sps_status([(studyuid, spsid, status) for studyuid, spsid in refs])
+    return 0x0000, ds
+
+def _handle_mpps_set(event):
+    uid = str(event.request.RequestedSOPInstanceUID or "")
+    with _MPPS_LOCK:
+        refs = _mpps_refs.get(uid)
+    if refs is None:
+        return 0x0112, None   # No such SOP Instance
+    mod = event.modification_list
+    status = mod.get("PerformedProcedureStepStatus", "")
+    if status:
+        ingest_sps_status([(studyuid, spsid, status) for studyuid, spsid in refs])
+    return 0x0000, mod
+
+def start_mwl_scp(port: int, ae_title: str = MWL_SCP_AET):
+    """Zažene C-FIND (MWL) in MPPS SCP v ozadju (potrebuje pynetdicom)."""
+    from pynetdicom import AE, evt
+    from pynetdicom.sop_class import ModalityWorklistInformationFind, ModalityPerformedProcedureStep
+    ae = AE(ae_title=ae_title)
+    ae.add_supported_context(ModalityWorklistInformationFind)
+    ae.add_supported_context(ModalityPerformedProcedureStep)
+    return ae.start_server(("0.0.0.0", port), block=False,
+                           evt_handlers=[(evt.EVT_C_FIND, _handle_mwl_find),
+                                         (evt.EVT_N_CREATE, _handle_mpps_create),
+                                         (evt.EVT_N_SET, _handle_mpps_set)])
+
+# ---------- Profiliranje (/debug/profile) ----------
+# Vzorčni profiler: v rednih presledkih prebere sklade vseh niti
+# (sys._current_frames) in jih prešteje v "collapsed" obliki, ki jo
+# neposredno berejo flamegraph.pl, speedscope in podobna orodja.
+# Dostop le z žetonom iz MWL_DEBUG_TOKEN; brez njega končne točke ne obstajajo.
+DEBUG_TOKEN = os.environ.get("MWL_DEBUG_TOKEN", "")
+PROFILE_MAX_SECONDS = 60
+# niti, ki samo čakajo (osveževalniki, strežniške zanke), privzeto izpustimo
+_IDLE_LEAVES = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+                ("selectors.py", "select"), ("socketserver.py", "serve_forever"),
+                ("thread.py", "_worker")}
+_PROFILE_LOCK = threading.Lock()
+
+def _debug_allowed() -> bool:
+    if not DEBUG_TOKEN:
+        return False
+    token = request.headers.get("X-Debug-Token") or request.args.get("token") or ""
+    return hmac.compare_digest(token.encode("utf-8"), DEBUG_TOKEN.encode("utf-8"))
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds: float, interval: float, include_idle: bool = False):
+    """Vrne (Counter 'nit;okvir;...;list' -> vzorci, število vzorčenj)."""
+    me = threading.get_ident()
+    counts = Counter()
+    ticks = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            leaf = frame.f_code
+            if not include_idle and (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)).replace(";", ","))
+            counts[";".join(reversed(stack))] += 1
+        ticks += 1
+        time.sleep(interval)
+    return counts, ticks
+
+@app.get('/debug/profile')
+def debug_profile():
+    """
+    ?seconds=10&interval_ms=5&format=collapsed|json&idle=0
+    Med vzorčenjem je vklopljeno tudi merjenje @_timed funkcij.
+    """
+    if not _debug_allowed():
+        abort(404)
+    try:
+        seconds = min(max(float(request.args.get("seconds", "10")), 0.1), PROFILE_MAX_SECONDS)
+        interval = max(float(request.args.get("interval_ms", "5")), 1.0) / 1000.0
+    except ValueError:
+        return jsonify({"ok": False, "napaka": "Neveljaven 'seconds' ali 'interval_ms'."}), 400
+    if not _PROFILE_LOCK.acquire(blocking=False):
+        return jsonify({"ok": False, "napaka": "Profiliranje že teče."}), 409
+    was_on = any(v["enabled"] for v in function_timings().values())
+    try:
+        set_function_timing(True, reset=not was_on)
+        t0 = time.perf_counter()
+        counts, ticks = sample_stacks(seconds, interval, request.args.get("idle") == "1")
+        elapsed = time.perf_counter() - t0
+    finally:
+        if not was_on:
+            set_function_timing(False)
+        _PROFILE_LOCK.release()
+
+    if request.args.get("format") == "json":
+        return jsonify({"ok": True, "seconds": round(elapsed, 3), "ticks": ticks,
+                        "samples": sum(counts.values()),
+                        "stacks": dict(counts.most_common()),
+                        "functions": function_timings()})
+    text = "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+    resp = Response(text, mimetype="text/plain")
+    resp.headers["Content-Disposition"] = "inline; filename=profile.collapsed"
+    return resp
+
+@app.route('/debug/profile/functions', methods=["GET", "POST"])
+def debug_profile_functions():
+    """GET: skupni časi @_timed funkcij; POST {"enabled": bool, "reset": bool}."""
+    if not _debug_allowed():
+        abort(404)
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        set_function_timing(bool(data.get("enabled")), reset=bool(data.get("reset")))
+    return jsonify({"ok": True, "functions": function_timings()})
+
 
 # ---------- HTML (SL) ----------
 INDEX_HTML = """
@@ -603,30 +3886,11 @@ INDEX_HTML = """
 <meta charset="utf-8"/>
 <meta name="viewport" content="width=device-width,initial-scale=1"/>
 <title>DCM4CHEE MWL — Lokalni odjemalec</title>
-<style>
-body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Arial;margin:0;background:#0b1020;color:#e8edf2}
-header{padding:16px 20px;border-bottom:1px solid #223056}
-h1{margin:0;font-size:18px}
-main{max-width:1100px;margin:0 auto;padding:16px}
-.card{background:#131a33;border:1px solid #223056;border-radius:12px;padding:16px;margin:12px 0}
-label{display:block;margin:8px 0 4px;color:#97a1b3}
-input,button,select,datalist{border-radius:10px;border:1px solid #223056;background:#0e1630;color:#e8edf2;padding:10px;width:100%}
-.row{display:grid;grid-template-columns:1fr 1fr;gap:12px}
-.btn{cursor:pointer;background:#5aa3ff;border:0;color:#041227;font-weight:600}
-.btn.alt{background:#2b3561;color:#e8edf2}
-.btn.danger{background:#ff5a7a;color:#041227}
-table{width:100%;border-collapse:collapse;margin-top:12px}
-th,td{border-bottom:1px solid #223056;padding:8px;text-align:left}th{color:#97a1b3}
-.muted{color:#97a1b3}.ok{color:#35c56a}.err{color:#ff5a7a}
-small{color:#97a1b3}
-.inline{display:flex;gap:8px;align-items:center}
-.flex{display:flex;gap:8px;align-items:center;flex-wrap:wrap}
-.badge{display:inline-block;padding:2px 8px;border:1px solid #223056;border-radius:999px;background:#0e1630;color:#97a1b3;font-size:12px}
-.hint{font-size:12px;color:#97a1b3}
-</style></head><body>
+<link rel="stylesheet" href="__APP_CSS__"/>
+</head><body>
 <header style="display:flex;justify-content:space-between;align-items:center;">
   <h1>WORKLIST - Lokalni odjemalec</h1>
-  <img src="/logo.png" alt="Logo" style="height:90px;"/>
+  <img src="__LOGO_URL__" alt="Logo" style="height:90px;"/>
 </header><main>
 
 <section class="card">
@@ -654,7 +3918,9 @@ small{color:#97a1b3}
 <div class="flex" style="margin-top:10px">
  <button class="btn" onclick="saveCfg()">Shrani</button>
  <button class="btn alt" onclick="listItems()">Prikaži MWL elemente</button>
+ <label class="inline" style="width:auto;margin:0"><input type="checkbox" id="hideDone" checked style="width:auto" onchange="listItems()"/><small>Skrij opravljene</small></label>
  <span class="badge">Stanje: <span id="statusText">Pripravljeno</span></span>
+ <span class="badge stale-badge" id="staleBadge" style="display:none"></span>
 </div></section>
 
 <section class="card">
@@ -663,6 +3929,7 @@ small{color:#97a1b3}
 <div class="flex" style="margin-top:10px">
   <button class="btn" onclick="openImportDialog()">Uvozi CSV / PDF</button>
   <button class="btn alt" onclick="writeImportedRows()">Vpiši</button>
+  <button class="btn alt create-btn" onclick="reconcileImportedRows()" title="Primerjaj z obstoječo delovno listo in vpiši le razlike">Uskladi</button>
 </div>
 <div id="importInfo" class="hint" style="margin-top:8px">Ni uvoženih podatkov.</div>
 <div id="importTable" style="margin-top:10px;overflow:auto"></div>
@@ -673,8 +3940,9 @@ small{color:#97a1b3}
 <h3>Ustvari nov MWL element</h3>
 <div class="row">
  <div>
-  <label>Priimek</label><input id="surname" value="NOVAK"/>
-  <label>Ime</label><input id="given" value="MIHA"/>
+  <label>Priimek</label><input id="surname" value="NOVAK" oninput="onNameInput()" autocomplete="off"/>
+  <label>Ime</label><input id="given" value="MIHA" oninput="onNameInput()" autocomplete="off"/>
+  <div id="patientSuggest"></div>
 
   <label class="inline">
     <span>ID pacienta</span>
@@ -713,15 +3981,51 @@ small{color:#97a1b3}
 </div>
 <label>Opis postopka / preiskave</label><input id="procDesc" value="Doppler karotid"/>
 <div class="flex" style="margin-top:10px">
- <button class="btn" onclick="createItem()">Ustvari MWL</button>
+ <button class="btn create-btn" onclick="createItem()">Ustvari MWL</button>
 </div></section>
 
 <section class="card"><h3>Rezultati</h3>
+  <div class="flex" style="margin-bottom:10px">
+    <input id="exportDate" placeholder="DD.MM.YYYY (danes)" style="width:160px"/>
+    <input id="exportStation" list="stationList" placeholder="vse postaje" style="width:160px"/>
+    <button class="btn alt" style="width:auto" onclick="exportDay('pdf')">Natisni PDF</button>
+    <button class="btn alt" style="width:auto" onclick="exportDay('csv')">Izvozi CSV</button>
+  </div>
   <div id="out" class="muted">Pripravljeno.</div>
 </section>
 </main>
 
-<script>
+<script src="__APP_JS__"></script>
+</body></html>
+"""
+
+INDEX_CSS = """
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Arial;margin:0;background:#0b1020;color:#e8edf2}
+header{padding:16px 20px;border-bottom:1px solid #223056}
+h1{margin:0;font-size:18px}
+main{max-width:1100px;margin:0 auto;padding:16px}
+.card{background:#131a33;border:1px solid #223056;border-radius:12px;padding:16px;margin:12px 0}
+label{display:block;margin:8px 0 4px;color:#97a1b3}
+input,button,select,datalist{border-radius:10px;border:1px solid #223056;background:#0e1630;color:#e8edf2;padding:10px;width:100%}
+.row{display:grid;grid-template-columns:1fr 1fr;gap:12px}
+.btn{cursor:pointer;background:#5aa3ff;border:0;color:#041227;font-weight:600}
+.btn.alt{background:#2b3561;color:#e8edf2}
+.btn.danger{background:#ff5a7a;color:#041227}
+table{width:100%;border-collapse:collapse;margin-top:12px}
+th,td{border-bottom:1px solid #223056;padding:8px;text-align:left}th{color:#97a1b3}
+.muted{color:#97a1b3}.ok{color:#35c56a}.err{color:#ff5a7a}
+small{color:#97a1b3}
+.inline{display:flex;gap:8px;align-items:center}
+.flex{display:flex;gap:8px;align-items:center;flex-wrap:wrap}
+.badge{display:inline-block;padding:2px 8px;border:1px solid #223056;border-radius:999px;background:#0e1630;color:#97a1b3;font-size:12px}
+.stale-badge{border-color:#8a6d1f;color:#f2c14e}
+body.stale .btn.danger,body.stale .create-btn{opacity:.45;pointer-events:none}
+.hint{font-size:12px;color:#97a1b3}
+.suggest{cursor:pointer;padding:6px 10px;border:1px solid #223056;border-top:0;background:#0e1630;font-size:13px}
+.suggest:hover{background:#223056}
+"""
+
+INDEX_JS = """
 // ---- helpers ----
 var CFG_PRESETS = {
   pacs1: {
@@ -772,6 +4076,7 @@ function log(msg, cls){
   var out = $('out');
   if(out){
     out.innerHTML = '<div class="'+(cls||'')+'">'+msg+'</div>';
+    out.removeAttribute('data-etag');
   }
   var st = $('statusText');
   if(st){
@@ -1056,6 +4361,116 @@ function writeImportedRows(){
     return;
   }
 
+  // Pred vpisom preverimo zasedenost terminov za cel uvoz naenkrat
+  var checkItems = rowsToWrite.map(function(r){
+    return {stationAET: r.station, schedDate_da: toDA(r.examDate || ''), schedTime_tm: toTM(r.examTime || '')};
+  });
+  fetch('/api/slots/check', {
+    method:'POST',
+    headers:{'Content-Type':'application/json'},
+    body: JSON.stringify({items: checkItems})
+  })
+    .then(function(r){ return r.ok ? r.json() : null; })
+    .then(function(j){
+      var ignore = false;
+      if(j && j.konfliktov){
+        var lines = [];
+        j.rezultati.forEach(function(res, i){
+          if(res.ok) return;
+          var r = rowsToWrite[i];
+          lines.push((r.surname || '') + ' ' + (r.given || '') + ', ' + r.station + ' ' + (r.examTime || '')
+            + (res.predlog ? ' (prost: ' + fmtTime(res.predlog.schedTime) + ')' : ''));
+        });
+        if(!confirm('Zasedeni termini (' + j.konfliktov + '):\\n' + lines.join('\\n') + '\\n\\nVseeno vpišem vse vrstice?')){
+          log('Uvoz preklican: ' + j.konfliktov + ' vrstic ima zaseden termin.', 'err');
+          return;
+        }
+        ignore = true;
+      }
+      writeRows(rowsToWrite, ignore);
+    })
+    .catch(function(){ writeRows(rowsToWrite, false); });
+}
+
+// Usklajevanje: strežnik primerja uvoz z delovno listo za iste dneve in
+// postaje; načrt pokažemo, ob potrditvi se izvede v enem zahtevku
+var RECONCILE_STATIONS = ['UZ1', 'UZ2'];
+
+function reconcileLine(r){
+  return (r.date ? daToHuman(r.date) + ' ' : '') + fmtTime(r.time) + ' ' + r.stationAET + (r.procDesc ? ', ' + r.procDesc : '');
+}
+
+function reconcileImportedRows(){
+  if(!importedRows.length){
+    log('Ni uvoženih vrstic za uskladitev.', 'err');
+    return;
+  }
+  var body = {rows: importedRows, stations: RECONCILE_STATIONS};
+  fetch('/api/import/reconcile', {
+    method:'POST',
+    headers:{'Content-Type':'application/json'},
+    body: JSON.stringify(body)
+  })
+    .then(function(r){ return r.json(); })
+    .then(function(plan){
+      if(!plan.ok){
+        log('Uskladitev ni mogoča: ' + esc(plan.napaka || 'neznana napaka'), 'err');
+        return;
+      }
+      confirmReconcile(body, plan);
+    })
+    .catch(function(e){ log('Napaka pri uskladitvi: ' + esc(String(e)), 'err'); });
+}
+
+function confirmReconcile(body, plan){
+  var name = function(x){ return String(x.patientName || '').replace(/\\^/g, ' '); };
+  var lines = [];
+  plan.create.forEach(function(c){
+    lines.push('+ ' + name(c) + ', ' + reconcileLine({date: c.schedDate, time: c.schedTime, stationAET: c.stationAET, procDesc: c.procDesc}));
+  });
+  plan.reschedule.forEach(function(m){
+    lines.push('~ ' + name(m) + ', ' + reconcileLine(m.from) + ' -> ' + reconcileLine(m.to));
+  });
+  plan.delete.forEach(function(d){ lines.push('- ' + name(d) + ', ' + reconcileLine(d)); });
+  var summary = 'Nespremenjenih: ' + plan.unchanged + ', novih: ' + plan.create.length
+    + ', prestavljenih: ' + plan.reschedule.length + ', za brisanje: ' + plan.delete.length
+    + (plan.skipped.length ? ', preskočenih: ' + plan.skipped.length : '')
+    + (plan.locked ? ', začetih (ne spreminjamo): ' + plan.locked : '') + '.';
+  $('importInfo').textContent = 'Načrt uskladitve (' + plan.dates.map(daToHuman).join(', ') + '): ' + summary;
+  if(!lines.length){
+    log('Delovna lista se že ujema z uvozom. ' + esc(summary), 'ok');
+    return;
+  }
+  var shown = lines.slice(0, 25).join('\\n') + (lines.length > 25 ? '\\n… še ' + (lines.length - 25) : '');
+  if(!confirm(summary + '\\n\\n' + shown + '\\n\\nIzvedem uskladitev?')){
+    log('Uskladitev preklicana.', 'err');
+    return;
+  }
+  fetch('/api/import/reconcile/apply', {
+    method:'POST',
+    headers:{'Content-Type':'application/json'},
+    body: JSON.stringify({rows: body.rows, stations: body.stations, planId: plan.planId})
+  })
+    .then(function(r){ return r.json().then(function(j){ return {status: r.status, j: j}; }); })
+    .then(function(res){
+      var j = res.j;
+      if(res.status === 409 && j.planId){
+        log('Delovna lista se je medtem spremenila, preglej nov načrt.', 'err');
+        confirmReconcile(body, j);
+        return;
+      }
+      if(j.napaka){
+        log('Uskladitev ni uspela: ' + esc(j.napaka), 'err');
+        return;
+      }
+      log('Uskladitev: novih ' + j.created + ', prestavljenih ' + j.rescheduled + ', izbrisanih ' + j.deleted
+        + (j.errors.length ? ', napak ' + j.errors.length : '') + '.', j.errors.length ? 'err' : 'ok');
+      listItems();
+    })
+    .catch(function(e){ log('Napaka pri uskladitvi: ' + esc(String(e)), 'err'); });
+}
+
+function writeRows(rowsToWrite, ignoreConflict){
   var idx = 0;
   function processNext(){
     if(idx >= rowsToWrite.length){
@@ -1084,7 +4499,7 @@ function writeImportedRows(){
       createItem(function(){
         idx++;
         processNext();
-      });
+      }, {ignoreConflict: ignoreConflict, source: 'import'});
     } else {
       log('Funkcija createItem ni definirana.', 'err');
     }
@@ -1093,6 +4508,50 @@ function writeImportedRows(){
   processNext();
 }
 
+// ---- Iskanje obstoječih pacientov med tipkanjem ----
+var suggestTimer = null;
+var lastSuggest = [];
+
+function onNameInput(){
+  if(suggestTimer) clearTimeout(suggestTimer);
+  suggestTimer = setTimeout(searchPatients, 150);
+}
+
+function searchPatients(){
+  var box = $('patientSuggest');
+  if(!box) return;
+  var q = (($('surname').value||'') + ' ' + ($('given').value||'')).trim();
+  if(q.length < 3){ box.innerHTML = ''; lastSuggest = []; return; }
+  fetch('/api/patients/search?limit=8&q=' + encodeURIComponent(q))
+    .then(function(r){ return r.json(); })
+    .then(function(j){
+      lastSuggest = j.items || [];
+      var html = '';
+      for(var i=0; i<lastSuggest.length; i++){
+        var p = lastSuggest[i];
+        html += '<div class="suggest" onclick="pickPatient('+i+')">'
+          + esc(String(p.patientName||'').replace(/\^/g,' '))
+          + ' · ' + esc(daToHuman(p.birthDate||''))
+          + ' · <span class="muted">' + esc(p.patientId||'') + '</span></div>';
+      }
+      box.innerHTML = html;
+    })
+    .catch(function(){ box.innerHTML = ''; });
+}
+
+function pickPatient(i){
+  var p = lastSuggest[i];
+  if(!p) return;
+  var parts = String(p.patientName||'').split('^');
+  if($('surname'))     $('surname').value = parts[0] || '';
+  if($('given'))       $('given').value = parts[1] || '';
+  if($('birthDate_h')) $('birthDate_h').value = daToHuman(p.birthDate||'');
+  if($('patientId'))   $('patientId').value = p.patientId || '';
+  if($('autoPID'))     $('autoPID').checked = false;
+  $('patientSuggest').innerHTML = '';
+  lastSuggest = [];
+}
+
 // ---- Pretvorbe DA/TM (klient) za pošiljanje ----
 function toDA(h){
   if(!h) return '';
@@ -1249,42 +4708,57 @@ function deleteAllItems(){
 function listItems(){
   var st = $('statusText');
   if(st) st.textContent = 'Pridobivanje...';
-  fetch('/api/list')
+  // brskalnik sam pošlje If-None-Match; nespremenjenega seznama ne izrisujemo ponovno
+  var hide = $('hideDone') && $('hideDone').checked;
+  fetch(hide ? '/api/list?active=1' : '/api/list')
     .then(function(r){
       return r.text().then(function(txt){
         if(!r.ok) throw new Error(txt);
-        return txt;
+        return {txt:txt, etag:r.headers.get('ETag') || '', stale:r.headers.get('X-Worklist-Stale') || ''};
       });
     })
-    .then(function(txt){
+    .then(function(res){
+      var txt = res.txt;
+      var out = $('out');
+      showStale(res.stale);
+      if(res.etag && out && out.getAttribute('data-etag') === res.etag){
+        if(st) st.textContent = 'OK';
+        return;
+      }
       try{
         var j = JSON.parse(txt);
         if(!Array.isArray(j) || !j.length){
           log('<span class="muted">Ni najdenih MWL elementov.</span>', 'ok');
           return;
         }
-        var html = '<table><tr><th>Pacient</th><th>ID</th><th>Opis postopka / preiskave</th><th>Datum</th><th>Čas</th><th>Postaja</th><th>Briši</th></tr>';
+        var html = '<table><tr><th>Pacient</th><th>ID</th><th>Opis postopka / preiskave</th><th>Datum</th><th>Čas</th><th>Postaja</th><th>Stanje</th><th>Briši</th></tr>';
         for(var i=0; i<j.length; i++){
           var it = j[i];
           var spsArr = it.scheduledProcedureStep || [];
-          var s = spsArr[0] || {};
-          var dHuman = daToHuman(s.scheduledProcedureStepStartDate||'');
-          var tHuman = fmtTime(s.scheduledProcedureStepStartTime||'');
-          var sps = s.scheduledProcedureStepID || '';
+          if(!spsArr.length) spsArr = [{}];
           var suid = it.studyInstanceUID || '';
-          html += '<tr>'
-            + '<td>'+esc(String(it.patientName||'').replace(/\\^/g,' '))+'</td>'
-            + '<td>'+esc(it.patientId||'')+'</td>'
-            + '<td>'+esc(it.procedureDescription||'')+'</td>'
-            + '<td>'+esc(dHuman)+'</td>'
-            + '<td>'+esc(tHuman)+'</td>'
-            + '<td>'+esc(s.scheduledStationAETitle||'')+'</td>'
-            + '<td>'+(sps?('<button class="btn danger" onclick="deleteItem(\\''+esc(sps)+'\\', \\''+esc(suid)+'\\')">Briši</button>'):'')+'</td>'
-            + '</tr>';
+          // ena vrstica na korak (SPS); zahteva z več koraki ima več vrstic
+          for(var k=0; k<spsArr.length; k++){
+            var s = spsArr[k] || {};
+            var dHuman = daToHuman(s.scheduledProcedureStepStartDate||'');
+            var tHuman = fmtTime(s.scheduledProcedureStepStartTime||'');
+            var sps = s.scheduledProcedureStepID || '';
+            html += '<tr>'
+              + '<td>'+esc(String(it.patientName||'').replace(/\\^/g,' '))+'</td>'
+              + '<td>'+esc(it.patientId||'')+'</td>'
+              + '<td>'+esc(it.procedureDescription||'')+'</td>'
+              + '<td>'+esc(dHuman)+'</td>'
+              + '<td>'+esc(tHuman)+'</td>'
+              + '<td>'+esc(s.scheduledStationAETitle||'')+'</td>'
+              + '<td>'+esc(s.scheduledProcedureStepStatus||'')+'</td>'
+              + '<td>'+(sps?('<button class="btn danger" onclick="deleteItem(\\''+esc(sps)+'\\', \\''+esc(suid)+'\\')">Briši</button>'):'')+'</td>'
+              + '</tr>';
+          }
         }
         html += '</table>';
         html += '<div style="margin-top:10px;text-align:right;"><button class="btn danger" onclick="deleteAllItems()">Briši vse</button></div>';
         log(html,'ok');
+        if(res.etag && out) out.setAttribute('data-etag', res.etag);
       }catch(e){
         log('<pre>'+esc(txt)+'</pre>', 'err');
       }
@@ -1294,6 +4768,30 @@ function listItems(){
     });
 }
 
+// Izvoz dnevnega programa (strežnik ga pošilja po delih)
+function exportDay(fmt){
+  var d = toDA(($('exportDate') && $('exportDate').value) || '');
+  var st = (($('exportStation') && $('exportStation').value) || '').trim();
+  var url = '/api/export?format=' + fmt + (d ? '&date=' + encodeURIComponent(d) : '')
+          + (st ? '&station=' + encodeURIComponent(st) : '');
+  window.open(url, '_blank');
+}
+
+// Arhiv nedosegljiv: lista je zadnja znana kopija, vpis in brisanje sta onemogočena
+function showStale(ts){
+  var b = $('staleBadge');
+  document.body.classList.toggle('stale', !!ts);
+  if(!b) return;
+  if(ts){
+    // ISO čas strežnika: YYYY-MM-DDTHH:MM:SS
+    var when = daToHuman(ts.slice(0,10).replace(/-/g,'')) + ' ' + fmtTime(ts.slice(11,16));
+    b.textContent = 'Arhiv ni dosegljiv – prikaz stanja ob ' + when + ' (samo branje)';
+    b.style.display = '';
+  }else{
+    b.style.display = 'none';
+  }
+}
+
 function clearPatientForm(){
   if($('surname'))     $('surname').value = '';
   if($('given'))       $('given').value = '';
@@ -1306,7 +4804,17 @@ function clearPatientForm(){
   // modality in stationAET pustimo, ker sta običajno stalni za serijo vnosov
 }
 // ---- Ustvarjanje MWL (po uspehu samodejno osveži seznam) ----
-function createItem(done){
+// ključ vpisa ostane enak do odgovora strežnika: dvojni klik ali ponovitev
+// po prekinjeni povezavi tako ne ustvari dveh elementov
+var createKey = '';
+function newRequestKey(){
+  if(window.crypto && crypto.randomUUID){ return crypto.randomUUID(); }
+  return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}
+
+function createItem(done, opts){
+  opts = opts || {};
+  var key = opts.key || createKey || (createKey = newRequestKey());
   var surname = ($('surname').value||'').trim();
   var given   = ($('given').value||'').trim();
 
@@ -1339,17 +4847,20 @@ function createItem(done){
     schedDate_da:   sched_da,
     schedTime_tm:   sched_tm,
     stationAET:     stationAETVal,
-    autoPID:        autoPIDVal
+    autoPID:        autoPIDVal,
+    ignoreConflict: !!opts.ignoreConflict,
+    source:         opts.source || 'form'
   };
 
   fetch('/api/create',{
     method:'POST',
-    headers:{'Content-Type':'application/json'},
+    headers:{'Content-Type':'application/json', 'Idempotency-Key': key},
     body: JSON.stringify(body)
   })
     .then(function(r){
+      if(createKey === key){ createKey = ''; }
       return r.text().then(function(t){
-        return {ok:r.ok, t:t};
+        return {ok:r.ok, status:r.status, t:t};
       });
     })
     .then(function(res){
@@ -1358,14 +4869,26 @@ function createItem(done){
       var pid = '';
       var acc = '';
       var msg = '';
+      var j = null;
       try{
-        var j = JSON.parse(t);
+        j = JSON.parse(t);
         pid = j.dodeljenID || '';
         acc = j.dodeljenAccession || '';
         if(j && j.odgovorPACS){
           msg = String(j.odgovorPACS);
         }
       }catch(e){}
+      if(res.status === 409 && j && j.konflikti){
+        var zasedeno = j.konflikti.map(function(k){ return fmtTime(k.schedTime); }).join(', ');
+        var predlog = j.predlog ? (' Prvi prost termin: ' + fmtTime(j.predlog.schedTime) + '.') : '';
+        if(confirm('Postaja ' + stationAETVal + ' je ob tem času že zasedena (' + zasedeno + ').' + predlog + ' Vseeno vpišem?')){
+          createItem(done, {ignoreConflict:true, source: opts.source, key: key});
+          return;
+        }
+        log('Vpis preklican: termin je zaseden (' + esc(zasedeno) + ').' + esc(predlog), 'err');
+        if(typeof done === 'function'){ done(); }
+        return;
+      }
       if(!ok){
         // PACS (dcm4chee) je vrnil napako, npr. 500 Internal Server Error
         if(msg && msg.indexOf('Internal Server Error') !== -1){
@@ -1391,13 +4914,281 @@ function createItem(done){
       if(typeof done === 'function'){ done(); }
     });
 }
-</script>
-</body></html>
 """
 
+# ---------- Statične datoteke UI ----------
+# CSS/JS/HTML se pomanjšajo in stisnejo enkrat ob zagonu; imena sredstev
+# vsebujejo zgoščeno vrednost vsebine, zato jih brskalnik lahko hrani za vedno.
+STATIC_MAX_AGE = "public, max-age=31536000, immutable"
+STATIC_ASSETS = {}   # ime -> {"body", "gz", "br", "etag", "mimetype"}
+PAGE = {}            # pripravljen index.html
+LOGO = {}            # logo.png v pomnilniku
+
+def _minify_css(src: str) -> str:
+    out = re.sub(r"\s+", " ", src)
+    out = re.sub(r"\s*([{};:,>])\s*", r"\1", out)
+    return out.replace(";}", "}").strip()
+
+def _minify_lines(src: str, comment: str | None = None) -> str:
+    # konzervativno: odstrani zamike in prazne vrstice (ter celovrstične komentarje)
+    out = []
+    for ln in src.split("\n"):
+        ln = ln.strip()
+        if not ln or (comment and ln.startswith(comment)):
+            continue
+        out.append(ln)
+    return "\n".join(out)
+
+def _prepare_asset(body: bytes, mimetype: str) -> dict:
+    return {
+        "body": body,
+        "gz": gzip.compress(body, compresslevel=9, mtime=0),
+        "br": brotli.compress(body, quality=11) if brotli is not None else None,
+        "etag": hashlib.sha1(body).hexdigest()[:20],
+        "mimetype": mimetype,
+    }
+
+def _load_logo():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.path.join(base_dir, "logo.png"), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def build_static_assets():
+    STATIC_ASSETS.clear()
+    urls = {}
+    for key, src, ext, mimetype in (
+        ("__APP_CSS__", _minify_css(INDEX_CSS), "css", "text/css"),
+        ("__APP_JS__", _minify_lines(INDEX_JS, "//"), "js", "application/javascript"),
+    ):
+        asset = _prepare_asset(src.encode("utf-8"), mimetype)
+        name = f"app.{asset['etag'][:10]}.{ext}"
+        STATIC_ASSETS[name] = asset
+        urls[key] = f"/assets/{name}"
+
+    LOGO.clear()
+    logo = _load_logo()
+    if logo is not None:
+        LOGO.update({"body": logo, "etag": hashlib.sha1(logo).hexdigest()[:20]})
+        urls["__LOGO_URL__"] = f"/logo.png?v={LOGO['etag'][:10]}"
+    else:
+        urls["__LOGO_URL__"] = "/logo.png"
+
+    html = _minify_lines(INDEX_HTML)
+    for key, url in urls.items():
+        html = html.replace(key, url)
+    PAGE.clear()
+    PAGE.update(_prepare_asset(html.encode("utf-8"), "text/html"))
+
+@app.route('/')
+def index():
+    return send_cached_bytes(PAGE["body"], PAGE["mimetype"], PAGE["etag"], gz=PAGE["gz"], br=PAGE["br"])
+
+@app.get('/assets/<name>')
+def static_asset(name):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        abort(404)
+    return send_cached_bytes(asset["body"], asset["mimetype"], asset["etag"],
+                             gz=asset["gz"], br=asset["br"], cache_control=STATIC_MAX_AGE)
+
+@app.get('/logo.png')
+def logo_png():
+    """logo.png iz pomnilnika (prebran ob zagonu iz mape skripte)."""
+    if not LOGO:
+        abort(404)
+    return send_cached_bytes(LOGO["body"], "image/png", LOGO["etag"], cache_control=STATIC_MAX_AGE)
+
+build_static_assets()
+
+# ---------- Jutranje predgretje ----------
+# Ob nastavljenih urah (PREWARM_TIMES, npr. "07:00,07:25") pred začetkom
+# ambulante: odpremo povezave v bazen seje (TLS), osvežimo lokalno kopijo
+# delovne liste s pripravljenimi pogledi in gzip telesi, indeks pacientov in
+# naložimo pdfplumber. Prvi uporabniki tako zadenejo že ogreto pot.
+PREWARM_TIMES = os.environ.get("PREWARM_TIMES", "07:00,07:25")
+PREWARM_CONNECTIONS = max(1, min(16, int(os.environ.get("PREWARM_CONNECTIONS", "4"))))   # <= pool_maxsize
+
+PREWARM_STATE = {"running": False, "lastRun": "", "reason": "", "steps": {}, "errors": [], "next": ""}
+_PREWARM_LOCK = threading.Lock()
+
+def _prewarm_minutes() -> list:
+    return sorted({m for m in (_tm_minutes(t) for t in PREWARM_TIMES.split(",")) if m is not None})
+
+def next_prewarm_time(now=None):
+    """Naslednji termin predgretja ali None, če ni nastavljenih ur."""
+    now = now or datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in (0, 1):
+        for m in _prewarm_minutes():
+            at = midnight + timedelta(days=day, minutes=m)
+            if at > now:
+                return at
+    return None
+
+def warm_archive_connections(n: int = PREWARM_CONNECTIONS) -> int:
+    """n hkratnih lahkih zahtevkov odpre (in pusti v bazenu) n povezav; vrne uspešne."""
+    path = f"/aets/{CFG['aet']}/rs/patients?limit=1"
+
+    def ping(_):
+        try:
+            return arc_request("GET", path, headers={"Accept": "application/json"}).ok
+        except requests.RequestException:
+            return False
+
+    with ThreadPoolExecutor(max_workers=n) as ex:
+        return sum(ex.map(ping, range(n)))
+
+def _prewarm_worklist() -> bool:
+    state = refresh_worklist_cache()
+    if state is None:
+        return False
+    for view in ("all", "active"):
+        _, etag = worklist_view(state, view)
+        worklist_cache_gzip(etag)
+    return True
+
+def _prewarm_patients() -> bool:
+    load_patient_index()
+    with _PAT_LOCK:
+        return _PAT["loaded"]
+
+def run_prewarm(reason: str = "schedule") -> dict:
+    with _PREWARM_LOCK:
+        if PREWARM_STATE["running"]:
+            return dict(PREWARM_STATE)
+        PREWARM_STATE["running"] = True
+    return _prewarm_pass(reason)
+
+def _prewarm_pass(reason: str) -> dict:
+    # klicatelj je že nastavil PREWARM_STATE["running"] pod _PREWARM_LOCK
+    steps, errors = {}, []
+    try:
+        for name, fn in (("connections", warm_archive_connections), ("worklist", _prewarm_worklist),
+                         ("patients", _prewarm_patients), ("pdf", prewarm_heavy_imports)):
+            t0 = time.perf_counter()
+            try:
+                ok = fn() is not False
+            except Exception as e:
+                ok = False
+                errors.append({"korak": name, "napaka": str(e)})
+            steps[name] = {"ok": ok, "ms": round((time.perf_counter() - t0) * 1000, 1)}
+    finally:
+        nxt = next_prewarm_time()
+        with _PREWARM_LOCK:
+            PREWARM_STATE.update({"running": False, "lastRun": datetime.now().isoformat(timespec="seconds"),
+                                  "reason": reason, "steps": steps, "errors": errors,
+                                  "next": nxt.isoformat(timespec="minutes") if nxt else ""})
+            return dict(PREWARM_STATE)
+
+def _prewarm_loop():
+    while True:
+        at = next_prewarm_time()
+        if at is None:
+            return
+        with _PREWARM_LOCK:
+            PREWARM_STATE["next"] = at.isoformat(timespec="minutes")
+        # po kosih, da premik ure ali mirovanje računalnika ne zamakne termina
+        wait = (at - datetime.now()).total_seconds()
+        while wait > 0:
+            time.sleep(min(wait, 60.0))
+            wait = (at - datetime.now()).total_seconds()
+        try:
+            run_prewarm()
+        except Exception:
+            pass
+
+def start_prewarm_scheduler():
+    t = threading.Thread(target=_prewarm_loop, name="prewarm-schedule", daemon=True)
+    t.start()
+    return t
+
+@app.get('/api/prewarm')
+def get_prewarm():
+    with _PREWARM_LOCK:
+        return jsonify({**PREWARM_STATE, "times": PREWARM_TIMES, "connections": PREWARM_CONNECTIONS})
+
+@app.post('/api/prewarm/run')
+def post_prewarm_run():
+    """Predgretje teče v ozadju (202); stanje in poročilo vrne GET /api/prewarm."""
+    with _PREWARM_LOCK:
+        if PREWARM_STATE["running"]:
+            return jsonify({"ok": False, "napaka": "Predgretje že teče."}), 409
+        PREWARM_STATE["running"] = True
+    threading.Thread(target=_prewarm_pass, args=("manual",), name="prewarm-run", daemon=True).start()
+    return jsonify({"ok": True, "running": True}), 202
+
 # ---------- Zagon ----------
+def prewarm_heavy_imports():
+    try:
+        get_pdfplumber()
+    except ImportError:
+        pass
+
+def start_prewarm(port: int, timeout: float = 30.0):
+    """Ko strežnik že sprejema povezave, v ozadju naloži težke module."""
+    def run():
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        prewarm_heavy_imports()
+    t = threading.Thread(target=run, name="prewarm", daemon=True)
+    t.start()
+    return t
+
+def print_startup_profile(top: int = 30):
+    t_ready = time.perf_counter() - _T_START
+    t0 = time.perf_counter()
+    prewarm_heavy_imports()
+    t_pdf = time.perf_counter() - t0
+    print(f"\nZagon modula (uvozi + priprava): {t_ready * 1000:8.1f} ms")
+    print(f"Leni uvoz pdfplumber:            {t_pdf * 1000:8.1f} ms\n")
+    print(f"{'modul':<40}{'skupaj ms':>12}{'lastni ms':>12}")
+    rows = sorted(_IMPORT_TIMES.items(), key=lambda kv: -kv[1][0])[:top]
+    for name, (total, own) in rows:
+        print(f"{name:<40}{total * 1000:>12.1f}{own * 1000:>12.1f}")
+
 if __name__ == "__main__":
+    if "--profile-startup" in sys.argv:
+        print_startup_profile()
+        sys.exit(0)
     port = int(os.environ.get("PORT", "5000"))
+    if os.environ.get("MWL_PROFILE_FUNCTIONS") == "1":
+        set_function_timing(True)
+    if os.environ.get("MWL_SNAPSHOT", "1") != "0" and load_worklist_snapshot():
+        start_snapshot_reconcile()
+    # lokalna kopija se osvežuje v ozadju (tudi brez SCP), da create/delete/
+    # stanja SPS prek request_worklist_refresh() takoj sprožijo branje arhiva
+    refresh_seconds = float(os.environ.get("MWL_REFRESH_SECONDS", "30") or 0)
+    if refresh_seconds > 0:
+        start_worklist_refresher(refresh_seconds)
+    scp_port = int(os.environ.get("MWL_SCP_PORT", "0") or 0)
+    if scp_port:
+        try:
+            start_mwl_scp(scp_port)
+            print(f"MWL SCP ({MWL_SCP_AET}) posluša na vratih {scp_port}")
+        except ImportError:
+            print("MWL SCP ni na voljo (manjka pynetdicom).")
+    if os.environ.get("MWL_PATIENT_INDEX", "1") != "0":
+        start_patient_index_loader()
+    if RETENTION_DAYS > 0:
+        start_retention_worker()
+        print(f"Čiščenje MWL starejših od {RETENTION_DAYS} dni je vklopljeno.")
+    hl7_port = int(os.environ.get("HL7_PORT", "0") or 0)
+    if hl7_port:
+        start_hl7_listener(hl7_port)
+        print(f"HL7 MLLP poslušalec na vratih {hl7_port}")
     print(f"\nAplikacija DCM4CHEE MWL deluje na http://127.0.0.1:{port}")
     print("Odpri ta naslov v brskalniku. Za izhod pritisni Ctrl+C.\n")
+    if os.environ.get("MWL_PREWARM", "1") != "0":
+        start_prewarm(port)
+        if _prewarm_minutes():
+            start_prewarm_scheduler()
+            print(f"Predgretje ob {PREWARM_TIMES}.")
     app.run(host="127.0.0.1", port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Lokalni nadomestek dcm4chee arhiva + merjenje zmogljivosti mwl_app
+✔ /rs/patients (GET/POST) in /rs/mwlitems (GET/POST/DELETE) v istem procesu
+✔ nastavljiva zakasnitev, vbrizgane napake in velikost podatkov
+✔ poročilo: op/s, p50/p99 zakasnitev, klici arhiva na operacijo
+✔ kodiranje MWL teles brez arhiva: slovar+json proti predlogam (--ops encode)
+
+Primer:
+  python mwl_bench.py --ops create,list,remove --n 200 --concurrency 4 --latency-ms 5
+"""
+
+from flask import Flask, request, jsonify, Response
+from werkzeug.serving import make_server
+from concurrent.futures import ThreadPoolExecutor
+import argparse, io, json, logging, os, random, socket, statistics, tempfile, threading, time, uuid
+
+import mwl_app
+
+
+# ---------- Nadomestni arhiv ----------
+class StubArchive:
+    """
+    Minimalni dcm4chee REST v pomnilniku. Hrani paciente in MWL elemente,
+    šteje klice po (metoda, vrsta poti) in po potrebi doda zakasnitev/napake.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, slow_rate=0.0, slow_ms=0.0, seed=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.patients = {}     # PatientID -> DICOM JSON
+        self.mwl = {}          # (StudyInstanceUID, SPS ID) -> DICOM JSON
+        self.calls = {}        # (metoda, vrsta) -> število
+        self.app = self._make_app()
+        self.server = None
+
+    # --- podatki ---
+    def seed_worklist(self, n, station_aets=("UZ1", "UZ2"), date=None):
+        date = date or time.strftime("%Y%m%d")
+        with self.lock:
+            for i in range(n):
+                pid = f"SEED{i:06d}"
+                self.patients[pid] = {
+                    "00100020": {"vr": "LO", "Value": [pid]},
+                    "00100010": {"vr": "PN", "Value": [{"Alphabetic": f"PACIENT^{i}"}]},
+                    "00100030": {"vr": "DA", "Value": ["19800101"]},
+                }
+                uid = f"2.25.{uuid.uuid4().int}"
+                sps = f"SPS_{pid}"
+                self.mwl[(uid, sps)] = {
+                    "00100010": {"vr": "PN", "Value": [{"Alphabetic": f"PACIENT^{i}"}]},
+                    "00100020": {"vr": "LO", "Value": [pid]},
+                    "00100030": {"vr": "DA", "Value": ["19800101"]},
+                    "00080050": {"vr": "SH", "Value": [f"ACCSEED-{i:06d}"]},
+                    "00321060": {"vr": "LO", "Value": ["Doppler karotid"]},
+                    "0020000D": {"vr": "UI", "Value": [uid]},
+                    "00400100": {"vr": "SQ", "Value": [{
+                        "00080060": {"vr": "CS", "Value": ["US"]},
+                        "00400001": {"vr": "AE", "Value": [station_aets[i % len(station_aets)]]},
+                        "00400002": {"vr": "DA", "Value": [date]},
+                        "00400003": {"vr": "TM", "Value": [f"{8 + (i // 3) % 8:02d}{(i % 3) * 20:02d}00"]},
+                        "00400009": {"vr": "SH", "Value": [sps]},
+                        "00400020": {"vr": "CS", "Value": ["SCHEDULED"]},
+                    }]},
+                }
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    # --- obnašanje ---
+    def _enter(self, method, kind):
+        with self.lock:
+            self.calls[(method, kind)] = self.calls.get((method, kind), 0) + 1
+            r_err = self.rnd.random()
+            r_slow = self.rnd.random()
+            jitter = self.rnd.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+        delay = self.latency_ms + jitter
+        if self.slow_rate and r_slow < self.slow_rate:
+            delay += self.slow_ms
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if self.error_rate and r_err < self.error_rate:
+            return Response("Injected error", status=503)
+        return None
+
+    @staticmethod
+    def _val(ds, tag):
+        v = (ds.get(tag) or {}).get("Value") or []
+        return v[0] if v else ""
+
+    def _match_mwl(self, ds, args):
+        # podprto: <tag>=vrednost in 00400100.<tag>=vrednost (DA obseg "A-B")
+        for key, want in args.items():
+            if key in ("limit", "offset", "includefield"):
+                continue
+            if "." in key:
+                seq, tag = key.split(".", 1)
+                items = (ds.get(seq) or {}).get("Value") or [{}]
+                have = str(self._val(items[0], tag))
+            else:
+                have = str(self._val(ds, key))
+                if isinstance(self._val(ds, key), dict):
+                    have = self._val(ds, key).get("Alphabetic", "")
+            if "-" in want and len(want) in (9, 17):
+                lo, hi = want.split("-", 1)
+                if not ((lo or "00000000") <= have <= (hi or "99999999")):
+                    return False
+            elif want and have != want:
+                return False
+        return True
+
+    def _make_app(self):
+        app = Flask("stub_archive")
+        stub = self
+
+        @app.get("/dcm4chee-arc/aets/<aet>/rs/patients")
+        def patients_get(aet):
+            err = stub._enter("GET", "patients")
+            if err: return err
+            pid = request.args.get("PatientID")
+            with stub.lock:
+                if pid is not None:
+                    found = [stub.patients[pid]] if pid in stub.patients else []
+                else:
+                    found = list(stub.patients.values())
+            offset = int(request.args.get("offset", 0))
+            limit = int(request.args.get("limit", 0) or 0)
+            found = found[offset:offset + limit] if limit else found[offset:]
+            if not found:
+                return Response(status=204)
+            return jsonify(found)
+
+        @app.post("/dcm4chee-arc/aets/<aet>/rs/patients")
+        def patients_post(aet):
+            err = stub._enter("POST", "patients")
+            if err: return err
+            ds = request.get_json(force=True)
+            with stub.lock:
+                stub.patients[str(stub._val(ds, "00100020"))] = ds
+            return jsonify({})
+
+        @app.get("/dcm4chee-arc/aets/<aet>/rs/mwlitems")
+        def mwl_get(aet):
+            err = stub._enter("GET", "mwlitems")
+            if err: return err
+            with stub.lock:
+                items = [ds for ds in stub.mwl.values() if stub._match_mwl(ds, request.args)]
+            offset = int(request.args.get("offset", 0))
+            limit = int(request.args.get("limit", 0) or 0)
+            items = items[offset:offset + limit] if limit else items[offset:]
+            if not items:
+                return Response(status=204)
+            return Response(json.dumps(items), mimetype="application/dicom+json")
+
+        @app.post("/dcm4chee-arc/aets/<aet>/rs/mwlitems")
+        def mwl_post(aet):
+            err = stub._enter("POST", "mwlitems")
+            if err: return err
+            ds = request.get_json(force=True)
+            uid = stub._val(ds, "0020000D")
+            if not uid:
+                uid = f"2.25.{uuid.uuid4().int}"
+                ds["0020000D"] = {"vr": "UI", "Value": [uid]}
+            with stub.lock:
+                pat = stub.patients.get(str(stub._val(ds, "00100020")))
+                if pat and "00100030" in pat:
+                    ds.setdefault("00100030", pat["00100030"])
+                for item in (ds.get("00400100") or {}).get("Value") or []:
+                    sps = stub._val(item, "00400009")
+                    one = dict(ds)
+                    one["00400100"] = {"vr": "SQ", "Value": [item]}
+                    stub.mwl[(uid, sps)] = one
+            return jsonify({"0020000D": ds["0020000D"]})
+
+        @app.delete("/dcm4chee-arc/aets/<aet>/rs/mwlitems/<uid>/<sps>")
+        def mwl_delete(aet, uid, sps):
+            err = stub._enter("DELETE", "mwlitems")
+            if err: return err
+            with stub.lock:
+                found = stub.mwl.pop((uid, sps), None)
+            if found is None:
+                return jsonify({"errorMessage": "MWLItem does not exist"}), 404
+            return Response(status=204)
+
+        return app
+
+    # --- strežnik ---
+    def start(self, host="127.0.0.1", port=0):
+        self.server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, name="stub-archive", daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/dcm4chee-arc"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+# ---------- Testni PDF dnevnega programa ----------
+def _pdf_escape(s):
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_day_program_pdf(rows=40, date=None):
+    """Enostranski PDF z vrsticami v obliki, ki jo pričakuje /api/import_pdf."""
+    date = date or time.strftime("%d.%m.%Y")
+    lines = ["St. Termin Priimek Ime Telefon Dat. rojstva Opomba"]
+    for i in range(rows):
+        lines.append(f"{i + 1} {date} {8 + i // 4:02d}:{(i % 4) * 15:02d} PRIIMEK{i} IME{i} 041000{i:03d} 01.02.1980 Doppler karotid")
+    text = ["BT /F1 9 Tf 11 TL 30 810 Td"]
+    for ln in lines:
+        text.append(f"({_pdf_escape(ln)}) Tj T*")
+    text.append("ET")
+    content = "\n".join(text).encode("latin-1")
+
+    objs = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs, start=1):
+        offsets.append(out.tell())
+        out.write(f"{i} 0 obj\n".encode() + obj + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode())
+    for off in offsets:
+        out.write(f"{off:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+# ---------- Testni HL7 pošiljatelj ----------
+def make_orm(i, date=None):
+    date = date or time.strftime("%Y%m%d")
+    return "\r".join([
+        f"MSH|^~\\&|RIS|BOLNISNICA|MWL|UZ|{date}080000||ORM^O01|MSG{i:06d}|P|2.5",
+        f"PID|1||HL7P{i:06d}||PRIIMEK{i}^IME{i}||19800101|F",
+        f"ORC|NW|ORD{i:06d}",
+        f"OBR|1|ORD{i:06d}||US001^Doppler karotid|||||||||||||||||UZ1|||US|||^^^{date}{8 + i % 8:02d}{(i % 3) * 20:02d}",
+    ]) + "\r"
+
+class HL7Sender:
+    """Enostaven MLLP odjemalec (ena povezava, sporočilo za sporočilom)."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.buf = b""
+
+    def send(self, msg: str) -> str:
+        self.sock.sendall(b"\x0b" + msg.encode("utf-8") + b"\x1c\x0d")
+        while b"\x1c\x0d" not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("MLLP povezava zaprta")
+            self.buf += chunk
+        frame, self.buf = self.buf.split(b"\x1c\x0d", 1)
+        return frame.lstrip(b"\x0b").decode("utf-8")
+
+    def close(self):
+        self.sock.close()
+
+
+# ---------- Merjenje ----------
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(p / 100.0 * (len(s) - 1)))))
+    return s[k]
+
+def _create_body(i):
+    return {
+        "patientSurname": f"BENCH{i}", "patientGiven": "TEST", "birthDate_da": "19800101",
+        "autoPID": True, "autoACC": True, "modality": "US", "procDesc": "Doppler karotid",
+        "schedDate_da": time.strftime("%Y%m%d"), "schedTime_tm": f"{8 + i % 8:02d}0000",
+        "stationAET": "UZ1" if i % 2 else "UZ2", "ignoreConflict": True,
+    }
+
+_hl7_server = None
+
+def run_op(stub, op, n, concurrency):
+    """Izvede n operacij `op` in vrne slovar z rezultati."""
+    client_local = threading.local()
+
+    def client():
+        c = getattr(client_local, "c", None)
+        if c is None:
+            c = client_local.c = mwl_app.app.test_client()
+        return c
+
+    pdf = make_day_program_pdf() if op == "import_pdf" else None
+    targets = []
+    if op == "hl7":
+        global _hl7_server
+        if _hl7_server is None:
+            _hl7_server = mwl_app.start_hl7_listener(0, "127.0.0.1")
+        port = _hl7_server.server_address[1]
+    if op == "remove":
+        with stub.lock:
+            targets = [sps for (_uid, sps) in stub.mwl.keys()][:n]
+        n = len(targets)
+
+    def sender():
+        snd = getattr(client_local, "hl7", None)
+        if snd is None:
+            snd = client_local.hl7 = HL7Sender("127.0.0.1", port)
+        return snd
+
+    def one(i):
+        c = client()
+        if op == "remove_all":
+            stub.seed_worklist(50)
+        t0 = time.perf_counter()
+        if op == "create":
+            r = c.post("/api/create", json=_create_body(i))
+        elif op == "list":
+            r = c.get("/api/list")
+        elif op == "remove":
+            r = c.post("/api/remove", json={"spsid": targets[i]})
+        elif op == "remove_all":
+            r = c.post("/api/remove_all")
+        elif op == "import_pdf":
+            r = c.post("/api/import_pdf", data={"file": (io.BytesIO(pdf), "program.pdf")},
+                       content_type="multipart/form-data")
+        elif op == "hl7":
+            ack = sender().send(make_orm(i))
+            return time.perf_counter() - t0, "MSA|AA" in ack
+        else:
+            raise ValueError(f"Neznana operacija: {op}")
+        return time.perf_counter() - t0, r.status_code < 400
+
+    stub.reset_calls()
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        results = list(ex.map(one, range(n)))
+    if op == "hl7":
+        # ACK pride takoj; počakamo, da paketni vpis izprazni vrsto
+        while mwl_app._hl7_queue.unfinished_tasks:
+            time.sleep(0.01)
+    elapsed = time.perf_counter() - t_start
+    lat = [r[0] for r in results]
+    return {
+        "op": op,
+        "n": n,
+        "errors": sum(1 for r in results if not r[1]),
+        "ops_per_sec": n / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _percentile(lat, 50) * 1000,
+        "p99_ms": _percentile(lat, 99) * 1000,
+        "mean_ms": (statistics.mean(lat) * 1000) if lat else 0.0,
+        "archive_calls_per_op": stub.total_calls() / n if n else 0.0,
+    }
+
+def run_encode_bench(n):
+    """
+    Kodiranje MWL telesa brez arhiva: build_dicom_mwl + json (kot prej v
+    requests) proti encode_dicom_mwl. Vrne dve vrstici za poročilo.
+    """
+    forms = []
+    for i in range(n):
+        f = _create_body(i)
+        f.update({"patientName": f"BENCH{i}^TEST", "accession": f"ACC{i:06d}"})
+        forms.append(f)
+    encoders = [
+        ("enc_dict", lambda f, pid: json.dumps(mwl_app.build_dicom_mwl(f, pid)).encode("utf-8")),
+        ("enc_tpl", mwl_app.encode_dicom_mwl),
+    ]
+    rows = []
+    for name, enc in encoders:
+        lat = []
+        t_start = time.perf_counter()
+        for i, f in enumerate(forms):
+            t0 = time.perf_counter()
+            enc(f, f"PID{i}")
+            lat.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - t_start
+        rows.append({
+            "op": name, "n": n, "errors": 0,
+            "ops_per_sec": n / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": _percentile(lat, 50) * 1000,
+            "p99_ms": _percentile(lat, 99) * 1000,
+            "mean_ms": statistics.mean(lat) * 1000,
+            "archive_calls_per_op": 0.0,
+        })
+    return rows
+
+def print_report(rows):
+    print(f"{'operacija':<12}{'n':>6}{'napake':>8}{'op/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'arhiv/op':>10}")
+    for r in rows:
+        print(f"{r['op']:<12}{r['n']:>6}{r['errors']:>8}{r['ops_per_sec']:>10.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['archive_calls_per_op']:>10.2f}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Merjenje mwl_app proti lokalnemu nadomestku arhiva")
+    ap.add_argument("--ops", default="create,list,remove,remove_all,import_pdf,hl7,encode")
+    ap.add_argument("--n", type=int, default=100, help="število operacij na vrsto")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--dataset", type=int, default=500, help="začetno število MWL elementov")
+    ap.add_argument("--latency-ms", type=float, default=2.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--slow-rate", type=float, default=0.0)
+    ap.add_argument("--slow-ms", type=float, default=0.0)
+    ap.add_argument("--arc-rps", type=float, default=0.0, help="ARC_RPS aplikacije (0 = brez omejitve)")
+    ap.add_argument("--json", action="store_true", help="izpis v JSON")
+    ap.add_argument("--workdir", default=None, help="mapa za števce in ostale datoteke (privzeto začasna)")
+    args = ap.parse_args(argv)
+
+    # števci PID/ACC in seznam postaj naj ne pristanejo v delovni mapi aplikacije
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="mwl_bench_"))
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    stub = StubArchive(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                       slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    stub.seed_worklist(args.dataset)
+    base = stub.start()
+    mwl_app.CFG.update({"server_base": base, "aet": "WORKLIST", "allow_self_signed": True})
+    mwl_app.ARC_RPS = args.arc_rps
+
+    rows = []
+    try:
+        for op in [o.strip() for o in args.ops.split(",") if o.strip()]:
+            if op == "encode":
+                rows.extend(run_encode_bench(args.n * 100))
+            elif op == "remove_all":
+                rows.append(run_op(stub, op, max(1, args.n // 10), 1))
+            else:
+                rows.append(run_op(stub, op, args.n, args.concurrency))
+    finally:
+        stub.stop()
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_report(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mwl_app
+import mwl_bench
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """Nadomestni arhiv na naključnih vratih; datoteke aplikacije gredo v tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    stub = mwl_bench.StubArchive()
+    base = stub.start()
+    monkeypatch.setitem(mwl_app.CFG, "server_base", base)
+    monkeypatch.setitem(mwl_app.CFG, "aet", "WORKLIST")
+    monkeypatch.setitem(mwl_app.CFG, "allow_self_signed", True)
+    mwl_app._BREAKERS.clear()
+    mwl_app._ADMISSION.clear()
+    mwl_app._ARC_LATENCY.clear()
+    with mwl_app._IDEM_LOCK:
+        mwl_app._IDEM.clear()
+        monkeypatch.setattr(mwl_app, "_idem_loaded", False)
+        monkeypatch.setattr(mwl_app, "_idem_lines", 0)
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def client(archive):
+    return mwl_app.app.test_client()
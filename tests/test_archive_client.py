@@ -0,0 +1,113 @@
+import time
+
+import mwl_app
+
+
+def _state():
+    with mwl_app._ARC_LOCK:
+        return dict(mwl_app._breaker(mwl_app.CFG["server_base"].rstrip("/")))
+
+
+def _expire_cooldown():
+    with mwl_app._ARC_LOCK:
+        b = mwl_app._breaker(mwl_app.CFG["server_base"].rstrip("/"))
+        b["openedAt"] = time.monotonic() - mwl_app.BREAKER_COOLDOWN - 1
+
+
+def _get():
+    return mwl_app.arc_request("GET", "/aets/WORKLIST/rs/patients?limit=1", headers={"Accept": "application/json"})
+
+
+def test_breaker_opens_after_threshold_and_fails_fast(archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 3)
+    archive.error_rate = 1.0
+    for _ in range(3):
+        assert _get().status_code == 503
+    assert _state()["state"] == "open"
+    assert not mwl_app.archive_available()
+
+    archive.reset_calls()
+    r = _get()
+    assert r.status_code == 503 and r.arc_unavailable
+    assert archive.total_calls() == 0
+
+
+def test_half_open_trial_closes_or_reopens(archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 1)
+    archive.error_rate = 1.0
+    _get()
+    assert _state()["state"] == "open"
+
+    _expire_cooldown()
+    _get()                                   # poskus ne uspe: spet odprta
+    assert _state()["state"] == "open"
+
+    archive.error_rate = 0.0
+    _expire_cooldown()
+    assert _get().ok
+    assert _state() == {**_state(), "state": "closed", "failures": 0}
+    assert mwl_app.archive_available()
+
+
+def test_shed_trial_returns_breaker_to_open(archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 1)
+    archive.error_rate = 1.0
+    _get()
+    archive.error_rate = 0.0
+    _expire_cooldown()
+
+    monkeypatch.setattr(mwl_app, "ARC_QUEUE_MAX", 0)     # sprejem zavrne vse
+    r = _get()
+    assert getattr(r, "arc_shed", False)
+    st = _state()
+    assert st["state"] == "open"
+    assert time.monotonic() - st["openedAt"] < 5
+
+    monkeypatch.setattr(mwl_app, "ARC_QUEUE_MAX", 200)
+    _expire_cooldown()
+    assert _get().ok
+    assert _state()["state"] == "closed"
+
+
+def test_shed_does_not_count_as_failure(archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 1)
+    monkeypatch.setattr(mwl_app, "ARC_QUEUE_MAX", 0)
+    for _ in range(3):
+        assert getattr(_get(), "arc_shed", False)
+    assert _state()["state"] == "closed"
+
+
+def test_half_open_is_not_available(archive):
+    with mwl_app._ARC_LOCK:
+        mwl_app._breaker(mwl_app.CFG["server_base"].rstrip("/"))["state"] = "half-open"
+    assert not mwl_app.archive_available()
+
+
+def test_open_after_cooldown_is_available(archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 1)
+    archive.error_rate = 1.0
+    _get()
+    assert not mwl_app.archive_available()
+    _expire_cooldown()
+    assert mwl_app.archive_available()
+
+
+CREATE = {"patientSurname": "NOVAK", "patientGiven": "JANEZ", "stationAET": "UZ1",
+          "schedDate": "21.10.2026", "schedTime": "08:00", "ignoreConflict": True}
+
+
+def test_create_while_half_open_is_503_without_archive_calls(client, archive):
+    with mwl_app._ARC_LOCK:
+        mwl_app._breaker(mwl_app.CFG["server_base"].rstrip("/"))["state"] = "half-open"
+    archive.reset_calls()
+    r = client.post("/api/create", json=CREATE)
+    assert r.status_code == 503
+    assert archive.total_calls() == 0
+
+
+def test_create_refused_by_breaker_maps_to_503(client, archive, monkeypatch):
+    monkeypatch.setattr(mwl_app, "BREAKER_THRESHOLD", 1)
+    archive.error_rate = 1.0
+    r = client.post("/api/create", json=CREATE)
+    assert r.status_code == 503
+    assert r.get_json()["napaka"] == "Arhiv trenutno ni dosegljiv."
@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+import mwl_app
+
+
+def _fresh_index():
+    return {"loaded": False, "date": {}, "acc": {}, "pid": {}, "dates": [], "refs": set()}
+
+
+@pytest.fixture
+def audit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mwl_app, "_AUDIT_IDX", _fresh_index())
+
+
+def _rec(i, acc="ACC1"):
+    return {"ts": f"2026-10-19T08:{i // 60:02d}:{i % 60:02d}.000", "action": "create",
+            "accession": acc, "patientId": f"PID{i}"}
+
+
+def test_index_lookup_by_accession_and_date(audit):
+    mwl_app._write_audit_batch([_rec(0), _rec(1, "ACC2"), _rec(2)])
+    assert [r["patientId"] for r in mwl_app.query_audit(accession="ACC1")] == ["PID2", "PID0"]
+    assert len(mwl_app.query_audit(d_from="20261019", d_to="20261019")) == 3
+    assert mwl_app.query_audit(d_from="20261020") == []
+
+
+def test_records_written_after_load_are_indexed_once(audit):
+    mwl_app._write_audit_batch([_rec(0)])
+    mwl_app._load_audit_index()
+    mwl_app._write_audit_batch([_rec(1)])
+    assert len(mwl_app.query_audit(accession="ACC1")) == 2
+
+
+def test_index_add_skips_known_offsets(audit):
+    with mwl_app._AUDIT_LOCK:
+        mwl_app._audit_index_add("20261019", "202610", "ACC1", "PID1", 0)
+        mwl_app._audit_index_add("20261019", "202610", "ACC1", "PID1", 0)
+    assert len(mwl_app._AUDIT_IDX["acc"]["ACC1"]) == 1
+
+
+def test_concurrent_load_and_write_has_no_duplicates(audit, monkeypatch):
+    n = 200
+    writer = threading.Thread(target=lambda: [mwl_app._write_audit_batch([_rec(i)]) for i in range(n)])
+    writer.start()
+    while writer.is_alive():
+        monkeypatch.setattr(mwl_app, "_AUDIT_IDX", _fresh_index())
+        mwl_app._load_audit_index()
+    writer.join()
+    items = mwl_app.query_audit(accession="ACC1", limit=1000)
+    assert len(items) == n
+    assert len({r["patientId"] for r in items}) == n
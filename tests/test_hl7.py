@@ -0,0 +1,113 @@
+import socket
+import time
+
+import pytest
+
+import mwl_app
+
+def _segment(name, values):
+    fields = [name] + [""] * max(values)
+    for n, v in values.items():
+        fields[n] = v
+    return "|".join(fields)
+
+
+ORM = "\r".join([
+    "MSH|^~\\&|RIS|BOLNICA|MWL|RTG|20261019080000||ORM^O01|MSG0001|P|2.5",
+    _segment("PID", {1: "1", 3: "P12345", 5: "NOVAK^JANEZ", 7: "19500201", 8: "M"}),
+    _segment("ORC", {1: "NW", 2: "ORD1"}),
+    _segment("OBR", {1: "1", 2: "ORD1", 4: "US01^UZ TREBUHA", 18: "ACC777", 21: "UZ1", 24: "US",
+                     27: "^^^20261021083000"}),
+]) + "\r"
+
+
+def _msa(ack: bytes):
+    seg = [ln for ln in ack.decode("utf-8").split("\r") if ln.startswith("MSA")][0]
+    return seg.split("|")
+
+
+@pytest.fixture
+def hl7(archive, monkeypatch, tmp_path):
+    monkeypatch.setattr(mwl_app, "_hl7_queue", mwl_app.queue.Queue(maxsize=2))
+    monkeypatch.setattr(mwl_app, "_hl7_retry", [])
+    monkeypatch.setattr(mwl_app, "HL7_STATS", dict.fromkeys(mwl_app.HL7_STATS, 0))
+    return archive
+
+
+def test_orm_is_acked_aa_and_queued(hl7):
+    msa = _msa(mwl_app.handle_hl7_message(ORM.encode("utf-8")))
+    assert msa[1:3] == ["AA", "MSG0001"]
+    form = mwl_app._hl7_queue.get_nowait()
+    assert form["patientId"] == "P12345" and form["accession"] == "ACC777"
+    assert form["stationAET"] == "UZ1" and form["schedDate"] == "20261021" and form["schedTime"] == "083000"
+
+
+def test_invalid_and_unsupported_messages(hl7):
+    assert _msa(mwl_app.handle_hl7_message(b"garbage"))[1] == "AE"
+    adt = ORM.replace("ORM^O01", "ADT^A01")
+    assert _msa(mwl_app.handle_hl7_message(adt.encode()))[1] == "AA"
+    assert mwl_app.HL7_STATS["ignored"] == 1
+    assert mwl_app._hl7_queue.empty()
+
+
+def test_full_queue_is_rejected_ar(hl7, monkeypatch):
+    monkeypatch.setattr(mwl_app.queue.Queue, "put",
+                        lambda self, item, timeout=None: (_ for _ in ()).throw(mwl_app.queue.Full()))
+    assert _msa(mwl_app.handle_hl7_message(ORM.encode()))[1] == "AR"
+    assert mwl_app.HL7_STATS["rejected"] == 1
+
+
+def test_batch_submit_creates_mwl(hl7):
+    mwl_app.handle_hl7_message(ORM.encode())
+    mwl_app.process_hl7_batch([mwl_app._hl7_queue.get_nowait()])
+    assert mwl_app.HL7_STATS["submitted"] == 1
+    assert len(hl7.mwl) == 1
+
+
+def test_transient_failure_is_retried_then_dead_lettered(hl7, monkeypatch):
+    monkeypatch.setattr(mwl_app, "HL7_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(mwl_app, "HL7_RETRY_BASE", 0.0)
+    hl7.error_rate = 1.0
+    mwl_app.handle_hl7_message(ORM.encode())
+    form = mwl_app._hl7_queue.get_nowait()
+
+    mwl_app.process_hl7_batch([form])
+    assert mwl_app.HL7_STATS["retried"] == 1
+    retry = mwl_app._hl7_due_retries(10)
+    assert retry == [form] and form["_attempts"] == 2
+
+    mwl_app.process_hl7_batch(retry)
+    assert mwl_app.HL7_STATS["failed"] == 1
+    dead = mwl_app.read_hl7_dead_letters()
+    assert dead[0]["order"]["accession"] == "ACC777" and dead[0]["attempts"] == 2
+
+
+def test_retry_succeeds_once_archive_is_back(hl7, monkeypatch):
+    monkeypatch.setattr(mwl_app, "HL7_RETRY_BASE", 0.0)
+    hl7.error_rate = 1.0
+    mwl_app.handle_hl7_message(ORM.encode())
+    mwl_app.process_hl7_batch([mwl_app._hl7_queue.get_nowait()])
+    hl7.error_rate = 0.0
+    mwl_app._BREAKERS.clear()
+    mwl_app.process_hl7_batch(mwl_app._hl7_due_retries(10))
+    assert mwl_app.HL7_STATS["submitted"] == 1
+    assert len(hl7.mwl) == 1
+
+
+def test_mllp_round_trip(hl7, client):
+    server = mwl_app.start_hl7_listener(0, host="127.0.0.1")
+    try:
+        with socket.create_connection(server.server_address, timeout=5) as sock:
+            sock.sendall(mwl_app.MLLP_START + ORM.encode() + mwl_app.MLLP_END)
+            data = b""
+            while not data.endswith(mwl_app.MLLP_END):
+                data += sock.recv(4096)
+        assert _msa(data.strip(b"\x0b\x1c\r"))[1] == "AA"
+        deadline = time.monotonic() + 5
+        while not hl7.mwl and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert len(hl7.mwl) == 1
+        assert client.get("/api/hl7/status").get_json()["submitted"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
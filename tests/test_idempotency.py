@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import mwl_app
+
+FORM = {"patientSurname": "NOVAK", "patientGiven": "JANEZ", "stationAET": "UZ1",
+        "schedDate": "21.10.2026", "schedTime": "08:00"}
+
+
+def _post(client, form, key):
+    return client.post("/api/create", json=form, headers={"Idempotency-Key": key})
+
+
+def test_replay_returns_first_response_without_archive_calls(client, archive):
+    first = _post(client, FORM, "k1")
+    assert first.status_code == 200 and "Idempotent-Replayed" not in first.headers
+    archive.reset_calls()
+
+    again = _post(client, {**FORM, "ignoreConflict": True}, "k1")
+    assert again.status_code == 200
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.get_json() == first.get_json()
+    assert archive.total_calls() == 0
+
+
+def test_request_key_field_is_accepted(client, archive):
+    first = client.post("/api/create", json={**FORM, "requestKey": "k2"})
+    again = client.post("/api/create", json={**FORM, "requestKey": "k2"})
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.get_json()["dodeljeniSPS"] == first.get_json()["dodeljeniSPS"]
+
+
+def test_concurrent_duplicates_create_once(archive):
+    archive.latency_ms = 30
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        resps = list(ex.map(lambda _: _post(mwl_app.app.test_client(), FORM, "k3"), range(4)))
+    assert [r.status_code for r in resps] == [200] * 4
+    assert sum("Idempotent-Replayed" not in r.headers for r in resps) == 1
+    assert len({tuple(r.get_json()["dodeljeniSPS"]) for r in resps}) == 1
+    assert archive.calls[("POST", "mwlitems")] == 1
+
+
+def test_same_key_different_payload_is_422(client, archive):
+    assert _post(client, FORM, "k4").status_code == 200
+    r = _post(client, {**FORM, "schedTime": "10:00"}, "k4")
+    assert r.status_code == 422 and r.get_json()["napaka"]
+
+
+def test_over_long_key_is_400(client, archive):
+    r = _post(client, FORM, "x" * (mwl_app.IDEMPOTENCY_KEY_MAX + 1))
+    assert r.status_code == 400
+    assert archive.total_calls() == 0
+
+
+def test_failed_create_is_not_stored(client, archive):
+    archive.error_rate = 1.0
+    assert _post(client, FORM, "k5").status_code != 200
+    archive.error_rate = 0.0
+    mwl_app._BREAKERS.clear()
+    r = _post(client, FORM, "k5")
+    assert r.status_code == 200 and "Idempotent-Replayed" not in r.headers
+
+
+def test_keys_reload_from_disk(client, archive, monkeypatch):
+    first = _post(client, FORM, "k6")
+    with mwl_app._IDEM_LOCK:
+        mwl_app._IDEM.clear()
+        monkeypatch.setattr(mwl_app, "_idem_loaded", False)
+        monkeypatch.setattr(mwl_app, "_idem_lines", 0)
+    archive.reset_calls()
+    again = _post(client, FORM, "k6")
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.get_json() == first.get_json()
+    assert archive.total_calls() == 0
@@ -0,0 +1,47 @@
+import pytest
+
+import mwl_app
+
+pydicom = pytest.importorskip("pydicom")
+from pydicom.dataset import Dataset
+
+
+def _query():
+    ident = Dataset()
+    ident.PatientID = ""
+    ident.PatientSex = "M"                       # element tega nima
+    sps = Dataset()
+    sps.ScheduledStationAETitle = "UZ1"
+    sps.ScheduledProcedureStepLocation = "SOBA 3"  # element tega nima
+    ident.ScheduledProcedureStepSequence = [sps]
+    return ident
+
+
+def test_missing_attributes_are_returned_empty(client):
+    r = client.post("/api/create", json={"patientSurname": "NOVAK", "patientGiven": "JANEZ",
+                                         "stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "08:00"})
+    pid = r.get_json()["dodeljenID"]
+    mwl_app.refresh_worklist_cache()
+    row = mwl_app.find_worklist_rows(station="UZ1")[0]
+
+    rsp = mwl_app._mwl_response(_query(), row)
+    assert rsp.PatientID == pid
+    assert "PatientSex" in rsp and not rsp.PatientSex
+    item = rsp.ScheduledProcedureStepSequence[0]
+    assert item.ScheduledStationAETitle == "UZ1"
+    assert "ScheduledProcedureStepLocation" in item and not item.ScheduledProcedureStepLocation
+
+
+def test_status_patch_reaches_cfind_response(client):
+    client.post("/api/create", json={"patientSurname": "NOVAK", "patientGiven": "JANEZ",
+                                     "stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "08:00"})
+    mwl_app.refresh_worklist_cache()
+    row = mwl_app.find_worklist_rows(station="UZ1")[0]
+    query = _query()
+    query.ScheduledProcedureStepSequence[0].ScheduledProcedureStepStatus = ""
+    first = mwl_app._mwl_response(query, row)
+    assert first.ScheduledProcedureStepSequence[0].ScheduledProcedureStepStatus == "SCHEDULED"
+
+    assert mwl_app.patch_worklist_status({row["spsid"]: "COMPLETED"}) == 1
+    second = mwl_app._mwl_response(query, row)
+    assert second.ScheduledProcedureStepSequence[0].ScheduledProcedureStepStatus == "COMPLETED"
@@ -0,0 +1,40 @@
+import threading
+import time
+
+import mwl_app
+
+
+def _wait_idle(client, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        state = client.get("/api/prewarm").get_json()
+        if not state["running"]:
+            return state
+        time.sleep(0.05)
+    raise AssertionError("predgretje se ni končalo")
+
+
+def test_manual_run_is_async_and_reports_via_status(client, archive):
+    archive.seed_worklist(4)
+    r = client.post("/api/prewarm/run")
+    assert r.status_code == 202 and r.get_json()["running"]
+    state = _wait_idle(client)
+    assert state["reason"] == "manual"
+    assert state["steps"]["connections"]["ok"] and state["steps"]["worklist"]["ok"]
+    assert len(mwl_app.cached_worklist_state()["items"]) == 4
+
+
+def test_concurrent_runs_start_once(client, archive):
+    archive.latency_ms = 50
+    codes = []
+
+    def post():
+        codes.append(mwl_app.app.test_client().post("/api/prewarm/run").status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(codes) == [202, 409, 409, 409]
+    _wait_idle(client)
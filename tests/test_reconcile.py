@@ -0,0 +1,82 @@
+import mwl_app
+
+DAY = "20261021"
+
+
+def _seed(archive, n, name, tm, status="SCHEDULED", desc="Doppler karotid"):
+    uid = f"2.25.{n}"
+    archive.mwl[(uid, f"SPS{n}")] = {
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": name}]},
+        "00100020": {"vr": "LO", "Value": [f"PID{n}"]},
+        "00100030": {"vr": "DA", "Value": ["19800101"]},
+        "00321060": {"vr": "LO", "Value": [desc]},
+        "0020000D": {"vr": "UI", "Value": [uid]},
+        "00400100": {"vr": "SQ", "Value": [{
+            "00080060": {"vr": "CS", "Value": ["US"]},
+            "00400001": {"vr": "AE", "Value": ["UZ1"]},
+            "00400002": {"vr": "DA", "Value": [DAY]},
+            "00400003": {"vr": "TM", "Value": [tm]},
+            "00400009": {"vr": "SH", "Value": [f"SPS{n}"]},
+            "00400020": {"vr": "CS", "Value": [status]},
+        }]},
+    }
+
+
+def _row(surname, given, tm, desc="Doppler karotid", date="21.10.2026"):
+    return {"surname": surname, "given": given, "birthDate": "01.01.1980", "examDate": date,
+            "examTime": tm, "station": "UZ1", "desc": desc}
+
+
+ROWS = [
+    _row("NOVAK", "JANEZ", "08:00"),        # nespremenjen
+    _row("KRANJC", "ANA", "10:00"),         # prestavljen z 09:00
+    _row("NOVAK", "MAJA", "13:00"),         # nov
+    _row("ZUPAN", "EVA", "14:00", date=""),  # neveljaven datum
+]
+
+
+def _day(archive):
+    _seed(archive, 1, "NOVAK^JANEZ", "080000")
+    _seed(archive, 2, "KRANJC^ANA", "090000")
+    _seed(archive, 3, "HORVAT^MIHA", "110000")
+    _seed(archive, 4, "ZUPAN^EVA", "120000", status="STARTED")
+
+
+def test_plan_classifies_rows(client, archive):
+    _day(archive)
+    archive.reset_calls()
+    plan = client.post("/api/import/reconcile", json={"rows": ROWS, "stations": ["UZ1"]}).get_json()
+    assert plan["ok"] and plan["unchanged"] == 1 and plan["locked"] == 1
+    assert [(m["spsid"], m["from"]["time"], m["to"]["time"]) for m in plan["reschedule"]] == [("SPS2", "0900", "1000")]
+    assert [(c["patientName"], c["schedTime"]) for c in plan["create"]] == [("NOVAK^MAJA", "130000")]
+    assert [d["spsid"] for d in plan["delete"]] == ["SPS3"]
+    assert [s["row"] for s in plan["skipped"]] == [3]
+    assert ("POST", "mwlitems") not in archive.calls and ("DELETE", "mwlitems") not in archive.calls
+
+
+def test_apply_rejects_stale_plan_with_409(client, archive):
+    _day(archive)
+    plan = client.post("/api/import/reconcile", json={"rows": ROWS, "stations": ["UZ1"]}).get_json()
+    _seed(archive, 5, "KOS^LUKA", "150000")     # lista se je med pregledom spremenila
+    r = client.post("/api/import/reconcile/apply", json={"rows": ROWS, "stations": ["UZ1"], "planId": plan["planId"]})
+    assert r.status_code == 409
+    doc = r.get_json()
+    assert doc["planId"] != plan["planId"]
+    assert [d["spsid"] for d in doc["delete"]] == ["SPS3", "SPS5"]
+    assert ("2.25.3", "SPS3") in archive.mwl
+
+
+def test_apply_then_plan_converges(client, archive):
+    _day(archive)
+    body = {"rows": ROWS, "stations": ["UZ1"]}
+    plan = client.post("/api/import/reconcile", json=body).get_json()
+    r = client.post("/api/import/reconcile/apply", json={**body, "planId": plan["planId"]})
+    assert r.status_code == 200
+    doc = r.get_json()
+    assert (doc["deleted"], doc["rescheduled"], doc["created"], doc["errors"]) == (1, 1, 1, [])
+    assert ("2.25.3", "SPS3") not in archive.mwl
+    assert archive._val(archive.mwl[("2.25.2", "SPS2")]["00400100"]["Value"][0], "00400003") == "100000"
+
+    again = client.post("/api/import/reconcile", json=body).get_json()
+    assert again["unchanged"] == 3 and again["locked"] == 1
+    assert (again["create"], again["reschedule"], again["delete"]) == ([], [], [])
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import mwl_app
+
+
+def _wait_idle(client, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        state = client.get("/api/retention").get_json()
+        if not state["running"]:
+            return state
+        time.sleep(0.05)
+    raise AssertionError("čiščenje se ni končalo")
+
+
+def test_run_is_async_and_reports_via_status(client, archive):
+    archive.seed_worklist(6, date="20200101")
+    archive.seed_worklist(2, date="20991231")
+    r = client.post("/api/retention/run", json={"days": 30})
+    assert r.status_code == 202 and r.get_json()["running"]
+    state = _wait_idle(client)
+    assert state["found"] == 6 and state["deletedCount"] == 6
+    assert len(archive.mwl) == 2
+
+
+def test_concurrent_runs_start_once(client, archive):
+    archive.seed_worklist(20, date="20200101")
+    archive.latency_ms = 20
+    codes = []
+
+    def post():
+        codes.append(mwl_app.app.test_client().post("/api/retention/run", json={"days": 30}).status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(codes) == [202, 409, 409, 409]
+    _wait_idle(client)
+
+
+def test_dry_run_deletes_nothing(client, archive):
+    archive.seed_worklist(3, date="20200101")
+    assert client.post("/api/retention/run", json={"days": 30, "dryRun": True}).status_code == 202
+    state = _wait_idle(client)
+    assert state["dryRun"] and state["found"] == 3 and len(state["deleted"]) == 3
+    assert len(archive.mwl) == 3
+
+
+def test_invalid_days_is_400(client):
+    assert client.post("/api/retention/run", json={"days": "x"}).status_code == 400
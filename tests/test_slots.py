@@ -0,0 +1,69 @@
+import mwl_app
+
+FORM = {"patientSurname": "NOVAK", "patientGiven": "JANEZ", "stationAET": "UZ1",
+        "schedDate": "21.10.2026", "schedTime": "08:00"}
+
+
+def test_overlapping_create_is_409_with_suggestion(client):
+    first = client.post("/api/create", json=FORM)
+    assert first.status_code == 200
+    sps = first.get_json()["dodeljeniSPS"][0]
+
+    r = client.post("/api/create", json={**FORM, "patientSurname": "KRANJC", "schedTime": "08:05"})
+    assert r.status_code == 409
+    doc = r.get_json()
+    assert doc["konflikti"] == [{"spsId": sps, "schedTime": "080000"}]
+    assert doc["predlog"] == {"schedDate": "20261021", "schedTime": "081500"}
+
+
+def test_other_station_and_ignore_conflict_pass(client):
+    assert client.post("/api/create", json=FORM).status_code == 200
+    assert client.post("/api/create", json={**FORM, "stationAET": "UZ2"}).status_code == 200
+    assert client.post("/api/create", json={**FORM, "ignoreConflict": True}).status_code == 200
+
+
+def test_reservation_survives_index_rebuild(archive, client):
+    client.get("/api/list")
+    res = mwl_app.reserve_slot("UZ1", "20261021", "080000", "SPENDING1")
+    assert res["ok"]
+
+    archive.seed_worklist(2, date="20261022")      # drugačen odgovor arhiva -> nov indeks
+    assert mwl_app.refresh_worklist_cache() is not None
+    res = mwl_app.reserve_slot("UZ1", "20261021", "081000", "SPENDING2")
+    assert not res["ok"]
+    assert res["konflikti"][0]["spsId"] == "SPENDING1"
+
+    mwl_app.release_slot("UZ1", "20261021", "080000", "SPENDING1")
+    assert "SPENDING1" not in mwl_app._PENDING_SLOTS
+    assert mwl_app.reserve_slot("UZ1", "20261021", "081000", "SPENDING3")["ok"]
+    mwl_app.release_slot("UZ1", "20261021", "081000", "SPENDING3")
+
+
+def test_pending_reservation_dropped_once_archived(client):
+    sps = client.post("/api/create", json=FORM).get_json()["dodeljeniSPS"][0]
+    assert sps in mwl_app._PENDING_SLOTS
+    mwl_app.refresh_worklist_cache()
+    assert sps not in mwl_app._PENDING_SLOTS
+    r = client.post("/api/create", json={**FORM, "schedTime": "08:10"})
+    assert r.status_code == 409
+
+
+def test_failed_create_releases_slot(client, archive):
+    client.get("/api/list")
+    archive.error_rate = 1.0
+    assert not client.post("/api/create", json=FORM).get_json()["ok"]
+    archive.error_rate = 0.0
+    mwl_app._BREAKERS.clear()
+    assert client.post("/api/create", json=FORM).status_code == 200
+
+
+def test_batch_check_sees_overlaps_within_batch(client):
+    client.post("/api/create", json=FORM)
+    r = client.post("/api/slots/check", json={"items": [
+        {"stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "09:00"},
+        {"stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "09:10"},
+        {"stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "08:00"},
+    ]})
+    doc = r.get_json()
+    assert [x["ok"] for x in doc["rezultati"]] == [True, False, False]
+    assert doc["konfliktov"] == 2
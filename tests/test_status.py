@@ -0,0 +1,55 @@
+import mwl_app
+
+FORM = {"patientSurname": "NOVAK", "patientGiven": "JANEZ", "stationAET": "UZ1", "modality": "US",
+        "schedDate": "21.10.2026", "schedTime": "08:00"}
+
+
+def _created(client):
+    sps = client.post("/api/create", json=FORM).get_json()["dodeljeniSPS"][0]
+    assert client.get("/api/list").status_code == 200
+    return sps
+
+
+def _list_status(client, sps):
+    for it in client.get("/api/list").get_json():
+        for s in it["scheduledProcedureStep"]:
+            if s["scheduledProcedureStepID"] == sps:
+                return s["scheduledProcedureStepStatus"]
+
+
+def test_status_patches_index_without_rebuild(client, archive, monkeypatch):
+    sps = _created(client)
+    idx = mwl_app.worklist_index()
+    etag = mwl_app.cached_worklist_state()["etag"]
+    monkeypatch.setattr(mwl_app, "build_worklist_index", lambda arr: (_ for _ in ()).throw(AssertionError("rebuild")))
+
+    assert mwl_app.patch_worklist_status({sps: "STARTED"}) == 1
+    assert mwl_app.patch_worklist_status({sps: "STARTED"}) == 0
+    assert mwl_app.worklist_index() is idx
+    row = idx["by_sps"][sps]
+    assert row["status"] == "STARTED" and row in idx["by_station"]["UZ1"] and row in idx["by_date"]["20261021"]
+    state = mwl_app.cached_worklist_state()
+    assert state["etag"] != etag
+    assert b'"STARTED"' in state["body"]
+    stats = client.get("/api/stats").get_json()
+    assert stats["byStatus"].get("STARTED") == 1 and "SCHEDULED" not in stats["byStatus"]
+
+
+def test_canceled_step_frees_and_rescheduled_retakes_slot(client, archive):
+    sps = _created(client)
+    def free():
+        items = [{"stationAET": "UZ1", "schedDate": "21.10.2026", "schedTime": "08:05"}]
+        return client.post("/api/slots/check", json={"items": items}).get_json()["konfliktov"] == 0
+
+    assert not free()
+    mwl_app.patch_worklist_status({sps: "CANCELED"})
+    assert free()
+    mwl_app.patch_worklist_status({sps: "SCHEDULED"})
+    assert not free()
+
+
+def test_active_view_follows_status(client, archive):
+    sps = _created(client)
+    assert len(client.get("/api/list?active=1").get_json()) == 1
+    mwl_app.patch_worklist_status({sps: "COMPLETED"})
+    assert client.get("/api/list?active=1").get_json() == []
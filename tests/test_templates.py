@@ -0,0 +1,76 @@
+import pytest
+
+import mwl_app
+
+BASE = {"name": "UZ1 dopoldne", "stationAET": "UZ1", "dateFrom": "19.10.2026", "dateTo": "23.10.2026",
+        "start": "08:00", "end": "10:00", "intervalMin": 30}
+
+
+def test_expand_weekdays_and_slots():
+    entries = mwl_app.expand_schedule_template(BASE)
+    assert len(entries) == 5 * 4
+    assert {e["schedTime"] for e in entries} == {"080000", "083000", "090000", "093000"}
+    assert entries[0]["schedDate"] == "20261019"
+
+
+def test_expand_every_days_for_follow_ups():
+    tpl = {**BASE, "dateTo": "09.11.2026", "intervalMin": 0, "everyDays": 7, "patientSurname": "NOVAK"}
+    entries = mwl_app.expand_schedule_template(tpl)
+    assert [e["schedDate"] for e in entries] == ["20261019", "20261026", "20261102", "20261109"]
+    assert all(e["patientName"] == "NOVAK^" for e in entries)
+
+
+@pytest.mark.parametrize("change, message", [
+    ({"start": "25:00"}, "start"),
+    ({"end": "7:00"}, "end"),
+    ({"end": "99:99"}, "end"),
+    ({"weekdays": 3}, "weekdays"),
+    ({"weekdays": [0, 8]}, "weekdays"),
+    ({"weekdays": ["pon"]}, "weekdays"),
+    ({"intervalMin": "pol ure"}, "intervalMin"),
+    ({"intervalMin": -15}, "intervalMin"),
+    ({"everyDays": 0}, "everyDays"),
+    ({"dateFrom": ""}, "dateFrom"),
+])
+def test_expand_rejects_invalid_input(change, message):
+    with pytest.raises(ValueError, match=message):
+        mwl_app.expand_schedule_template({**BASE, **change})
+
+
+@pytest.mark.parametrize("change", [{"start": "25:00"}, {"weekdays": 3}, {"intervalMin": "x"}])
+def test_preview_and_save_return_400(client, change):
+    tpl = {**BASE, **change}
+    r = client.post("/api/templates/preview", json={"template": tpl})
+    assert r.status_code == 400 and r.get_json()["napaka"]
+    r = client.post("/api/templates", json=tpl)
+    assert r.status_code == 400
+
+
+def test_apply_submits_batch(client, archive):
+    tpl = {**BASE, "dateTo": "19.10.2026"}
+    r = client.post("/api/templates/apply", json={"template": tpl})
+    assert r.status_code == 200
+    assert r.get_json()["count"] == 4
+    assert len(archive.mwl) == 4
+
+
+def test_apply_twice_is_409_with_conflicts(client, archive):
+    tpl = {**BASE, "dateTo": "19.10.2026"}
+    assert client.post("/api/templates/apply", json={"template": tpl}).status_code == 200
+    r = client.post("/api/templates/apply", json={"template": tpl})
+    assert r.status_code == 409
+    doc = r.get_json()
+    assert doc["konfliktov"] == 4
+    assert [c["schedTime"] for c in doc["konflikti"]] == ["080000", "083000", "090000", "093000"]
+    assert len(archive.mwl) == 4
+
+    r = client.post("/api/templates/apply", json={"template": tpl, "ignoreConflict": True})
+    assert r.status_code == 200 and len(archive.mwl) == 8
+
+
+def test_apply_rejects_overlap_within_template(client, archive):
+    tpl = {**BASE, "dateTo": "19.10.2026", "intervalMin": 5, "end": "08:10"}
+    r = client.post("/api/templates/apply", json={"template": tpl})
+    assert r.status_code == 409
+    assert [c["schedTime"] for c in r.get_json()["konflikti"]] == ["080500"]
+    assert archive.mwl == {}